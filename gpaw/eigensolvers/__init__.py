@@ -3,6 +3,8 @@
 from gpaw.eigensolvers.rmm_diis import RMM_DIIS
 from gpaw.eigensolvers.cg import CG
 from gpaw.eigensolvers.davidson import Davidson
+from gpaw.eigensolvers.lobpcg import LOBPCG
+from gpaw.eigensolvers.chebyshev import ChebyshevFilter
 from gpaw.lcao.eigensolver import LCAO
 
 
@@ -17,12 +19,14 @@ def get_eigensolver(name, mode, convergence=None):
         eigensolver = {'rmm-diis':  RMM_DIIS,
                        'cg':        CG,
                        'dav':       Davidson,
+                       'lobpcg':    LOBPCG,
+                       'chebyshev': ChebyshevFilter,
                        'lcao':      LCAO
                        }[name]()
     else:
         eigensolver = name
     
-    if isinstance(eigensolver, CG):
+    if not isinstance(eigensolver, LCAO):
         eigensolver.tolerance = convergence['eigenstates']
 
     assert isinstance(eigensolver, LCAO) == (mode == 'lcao')
@@ -7,7 +7,7 @@ from numpy import dot # avoid the dotblas bug!
 
 from gpaw.utilities.blas import axpy, rk, r2k, gemm
 from gpaw.utilities import unpack
-from gpaw.eigensolvers.eigensolver import Eigensolver
+from gpaw.eigensolvers.eigensolver import Eigensolver, block_dots
 
 
 class CG(Eigensolver):
@@ -24,8 +24,8 @@ class CG(Eigensolver):
     * Conjugate gradient steps
     """
 
-    def __init__(self, niter=4):
-        Eigensolver.__init__(self)
+    def __init__(self, niter=4, freeze=None):
+        Eigensolver.__init__(self, freeze=freeze)
         self.niter = niter
 
     def initialize(self, wfs):
@@ -64,16 +64,23 @@ class CG(Eigensolver):
         self.timer.start('CG')
         vt_G = hamiltonian.vt_sG[kpt.s]
 
+        r_n = block_dots(R_nG, R_nG)
+        self.gd.comm.sum(r_n)
+        frozen_n = self.get_frozen_bands(r_n)
+        self.nupdates += self.nbands
+
         total_error = 0.0
         for n in range(self.nbands):
             R_G = R_nG[n]
             Htpsit_G = self.Htpsit_nG[n]
             gamma_old = 1.0
             phi_old_G[:] = 0.0
-            error = self.gd.comm.sum(np.vdot(R_G, R_G).real)
+            error = r_n[n]
             for nit in range(niter):
-                if error < self.tolerance / self.nbands:
+                if error < self.tolerance / self.nbands or frozen_n[n]:
                     # print >> self.f, "cg:iters", n, nit
+                    if nit == 0:
+                        self.nskipped += 1
                     break
 
                 pR_G = self.preconditioner(R_G, kpt)
@@ -182,6 +189,7 @@ class CG(Eigensolver):
             # if nit == 3:
             #   print >> self.f, "cg:iters", n, nit+1
                 
+        kpt.residual_n = r_n
         self.timer.stop('CG')
         return total_error
         
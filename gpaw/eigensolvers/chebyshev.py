@@ -0,0 +1,187 @@
+"""Module defining  ``Eigensolver`` classes."""
+
+import numpy as np
+
+from gpaw.utilities.lapack import diagonalize
+from gpaw.utilities import unpack
+from gpaw.eigensolvers.eigensolver import Eigensolver, block_dots
+
+
+class ChebyshevFilter(Eigensolver):
+    """Chebyshev-filtered subspace iteration eigensolver
+
+    It is expected that the trial wave functions are orthonormal
+    and the integrals of projector functions and wave functions
+    ``nucleus.P_uni`` are already calculated.
+
+    Solution steps are:
+
+    * Subspace diagonalization
+    * Calculation of residuals (only used for the error)
+    * Estimate the upper bound of the spectrum with a few Lanczos steps
+    * Apply a Chebyshev polynomial of degree *degree* in S^-1 H to all
+      bands, *blocksize* bands at a time.  The polynomial damps the
+      interval from the highest Ritz value up to the upper bound.
+    * Orthonormalization
+
+    The wave functions are orthonormalized only once per SCF step, and
+    the domain reductions of a k-point are the ones of the subspace
+    diagonalization, the orthonormalization, the Lanczos steps and a
+    single sum of all band errors."""
+
+    def __init__(self, degree=8, nlanczos=6, blocksize=16):
+        Eigensolver.__init__(self, True, blocksize)
+        self.degree = degree
+        self.nlanczos = nlanczos
+
+    def initialize(self, wfs):
+        Eigensolver.initialize(self, wfs)
+        B = min(self.blocksize, self.mynbands)
+        self.work_xG = self.gd.empty((2, B), self.dtype)
+
+    def estimate_memory(self, mem, gd, dtype, mynbands, nbands):
+        Eigensolver.estimate_memory(self, mem, gd, dtype, mynbands, nbands)
+        gridmem = gd.bytecount(dtype)
+        B = min(self.blocksize, mynbands)
+        mem.subnode('work_xG', 2 * B * gridmem)
+        mem.subnode('Lanczos', 3 * gridmem)
+
+    def iterate_one_k_point(self, hamiltonian, wfs, kpt):
+        """Do a single filtering step for the kpoint"""
+
+        self.subspace_diagonalize(hamiltonian, wfs, kpt)
+
+        self.timer.start('Chebyshev')
+        dH_aii = dict([(a, unpack(dH_sp[kpt.s]))
+                       for a, dH_sp in hamiltonian.dH_asp.items()])
+
+        if self.keep_htpsit:
+            R_nG = self.Htpsit_nG
+            self.calculate_residuals(kpt, wfs, hamiltonian, kpt.psit_nG,
+                                     kpt.P_ani, kpt.eps_n, R_nG)
+
+        # Damped interval [ecut, emax] and lower end emin for scaling:
+        emin = self.band_comm.min(float(kpt.eps_n.min()))
+        ecut = self.band_comm.max(float(kpt.eps_n.max()))
+        self.timer.start('Lanczos')
+        emax = self.estimate_upper_bound(hamiltonian, wfs, kpt, dH_aii)
+        self.timer.stop('Lanczos')
+        if emax <= ecut:
+            emax = 2 * ecut - emin
+        e = 0.5 * (emax - ecut)
+        c = 0.5 * (emax + ecut)
+
+        B = self.work_xG.shape[1]
+        P_axi = self.get_projection_buffer(wfs, B)
+        r_n = np.empty(wfs.bd.mynbands)
+        for n1 in range(0, wfs.bd.mynbands, B):
+            n2 = n1 + B
+            if n2 > wfs.bd.mynbands:
+                n2 = wfs.bd.mynbands
+                B = n2 - n1
+                P_axi = dict([(a, P_xi[:B]) for a, P_xi in P_axi.items()])
+
+            X_xG = kpt.psit_nG[n1:n2]
+            Y_xG = self.work_xG[0, :B]
+            if self.keep_htpsit:
+                Y_xG[:] = R_nG[n1:n2]
+            else:
+                wfs.apply_pseudo_hamiltonian(kpt, hamiltonian, X_xG, Y_xG)
+                self.calculate_residuals(kpt, wfs, hamiltonian, X_xG,
+                                         dict([(a, P_ni[n1:n2]) for a, P_ni
+                                               in kpt.P_ani.items()]),
+                                         kpt.eps_n[n1:n2], Y_xG,
+                                         range(n1, n2))
+            r_n[n1:n2] = block_dots(Y_xG, Y_xG)
+
+            # First step: S^-1 H X = S^-1 R + eps X
+            self.apply_inverse_overlap(wfs, kpt, Y_xG, P_axi)
+            shape = (B,) + (1,) * (X_xG.ndim - 1)
+            sigma = e / (emin - c)
+            Y_xG += (kpt.eps_n[n1:n2] - c).reshape(shape) * X_xG
+            Y_xG *= sigma / e
+
+            # Three-term recurrence:
+            #
+            #   Y   = 2 s   / e (S^-1 H - c) Y  - s s   Y
+            #    k+1     k+1                  k      k+1  k-1
+            #
+            old_xG = X_xG
+            new_xG = self.work_xG[1, :B]
+            sigma1 = sigma
+            for k in range(1, self.degree):
+                sigma2 = 1.0 / (2.0 / sigma1 - sigma)
+                self.apply_operator(hamiltonian, wfs, kpt, Y_xG, new_xG,
+                                    P_axi, dH_aii)
+                new_xG -= c * Y_xG
+                new_xG *= 2.0 * sigma2 / e
+                new_xG -= (sigma * sigma2) * old_xG
+                old_xG, Y_xG, new_xG = Y_xG, new_xG, old_xG
+                sigma = sigma2
+
+            if Y_xG is not X_xG:
+                X_xG[:] = Y_xG
+
+        self.gd.comm.sum(r_n)
+        kpt.residual_n = r_n
+        error = np.dot(self.get_weights(wfs, kpt), r_n)
+        self.timer.stop('Chebyshev')
+        return error
+
+    def apply_operator(self, hamiltonian, wfs, kpt, a_xG, b_xG, P_axi,
+                       dH_aii):
+        """Calculate b_xG = S^-1 H a_xG."""
+        wfs.apply_pseudo_hamiltonian(kpt, hamiltonian, a_xG, b_xG)
+        wfs.pt.integrate(a_xG, P_axi, kpt.q)
+        c_axi = dict([(a, np.dot(P_xi, dH_aii[a]))
+                      for a, P_xi in P_axi.items()])
+        wfs.pt.add(b_xG, c_axi, kpt.q)
+        self.apply_inverse_overlap(wfs, kpt, b_xG, P_axi)
+
+    def apply_inverse_overlap(self, wfs, kpt, a_xG, P_axi):
+        """Apply approximate inverse overlap operator in place."""
+        wfs.pt.integrate(a_xG, P_axi, kpt.q)
+        c_axi = dict([(a, np.dot(P_xi, wfs.setups[a].dC_ii))
+                      for a, P_xi in P_axi.items()])
+        wfs.pt.add(a_xG, c_axi, kpt.q)
+
+    def estimate_upper_bound(self, hamiltonian, wfs, kpt, dH_aii):
+        """Estimate upper bound of the spectrum of S^-1 H.
+
+        A few Lanczos steps are done starting from a random vector.
+        The bound is the largest eigenvalue of the tridiagonal matrix
+        plus the norm of the last residual vector."""
+
+        gd = self.gd
+        k = self.nlanczos
+        v_xG = gd.empty(3, self.dtype)
+        v_G, f_G, v0_G = v_xG
+        rng = np.random.RandomState(42 + gd.comm.rank)
+        v_G[:] = rng.random_sample(v_G.shape) - 0.5
+        if self.dtype == complex:
+            v_G += 1j * (rng.random_sample(v_G.shape) - 0.5)
+        P_axi = wfs.pt.dict(1)
+        T_kk = np.zeros((k, k))
+
+        def norm(a_G):
+            return gd.comm.sum(np.vdot(a_G, a_G).real)**0.5
+
+        v_G /= norm(v_G)
+        beta = 0.0
+        for j in range(k):
+            self.apply_operator(hamiltonian, wfs, kpt, v_xG[:1], v_xG[1:2],
+                                P_axi, dH_aii)
+            if j > 0:
+                f_G -= beta * v0_G
+            alpha = gd.comm.sum(np.vdot(v_G, f_G).real)
+            f_G -= alpha * v_G
+            T_kk[j, j] = alpha
+            beta = norm(f_G)
+            if j < k - 1:
+                T_kk[j + 1, j] = beta
+                v0_G[:] = v_G
+                v_G[:] = f_G / beta
+
+        eps_k = np.empty(k)
+        diagonalize(T_kk, eps_k)
+        return eps_k[-1] + beta
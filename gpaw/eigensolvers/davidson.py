@@ -5,7 +5,7 @@ import numpy as np
 from gpaw.utilities.blas import axpy, rk, r2k, gemm
 from gpaw.utilities.lapack import diagonalize, general_diagonalize
 from gpaw.utilities import unpack
-from gpaw.eigensolvers.eigensolver import Eigensolver
+from gpaw.eigensolvers.eigensolver import Eigensolver, block_dots
 
 
 class Davidson(Eigensolver):
@@ -22,8 +22,8 @@ class Davidson(Eigensolver):
     * Add preconditioned residuals to the subspace and diagonalize 
     """
 
-    def __init__(self, niter=2):
-        Eigensolver.__init__(self)
+    def __init__(self, niter=2, freeze=None):
+        Eigensolver.__init__(self, freeze=freeze)
         self.niter = niter
 
     def initialize(self, wfs):
@@ -53,11 +53,9 @@ class Davidson(Eigensolver):
         nbands = self.nbands
 
         self.subspace_diagonalize(hamiltonian, wfs, kpt)
-                    
-        H_2n2n = self.H_2n2n
-        S_2n2n = self.S_2n2n
-        eps_2n = self.eps_2n
+
         psit2_nG = wfs.matrixoperator.suggest_temporary_buffer()
+        weight_n = self.get_weights(wfs, kpt)
 
         self.timer.start('Davidson')
         R_nG = self.Htpsit_nG 
@@ -65,73 +63,93 @@ class Davidson(Eigensolver):
                                  kpt.P_ani, kpt.eps_n, R_nG)
 
         for nit in range(niter):
+            r_n = block_dots(R_nG, R_nG)
+            self.gd.comm.sum(r_n)
+            error = np.dot(weight_n, r_n)
+            if nit == 0:
+                kpt.residual_n = r_n
+
+            # Only bands that are not frozen are added to the subspace:
+            frozen_n = self.get_frozen_bands(r_n)
+            n_m = np.arange(nbands)[np.logical_not(frozen_n)]
+            nm = len(n_m)
+            self.nskipped += nbands - nm
+            self.nupdates += nbands
+            if nm == 0:
+                break
+
+            if nm == nbands:
+                H_2n2n = self.H_2n2n
+                S_2n2n = self.S_2n2n
+                eps_2n = self.eps_2n
+                H_nn = H_mm = self.H_nn
+                S_nn = S_mm = self.S_nn
+            else:
+                H_2n2n = np.empty((nbands + nm, nbands + nm), self.dtype)
+                S_2n2n = np.empty((nbands + nm, nbands + nm), self.dtype)
+                eps_2n = np.empty(nbands + nm)
+                H_nn = np.zeros((nm, nbands), self.dtype)
+                S_nn = np.zeros((nm, nbands), self.dtype)
+                H_mm = np.zeros((nm, nm), self.dtype)
+                S_mm = np.zeros((nm, nm), self.dtype)
             H_2n2n[:] = 0.0
             S_2n2n[:] = 0.0
 
-            error = 0.0
             for n in range(nbands):
-                if kpt.f_n is None:
-                    weight = kpt.weight
-                else:
-                    weight = kpt.f_n[n]
-                if self.nbands_converge != 'occupied':
-                    if n < self.nbands_converge:
-                        weight = kpt.weight
-                    else:
-                        weight = 0.0
-                error += weight * np.vdot(R_nG[n], R_nG[n]).real
-
                 H_2n2n[n,n] = kpt.eps_n[n]
                 S_2n2n[n,n] = 1.0
-                psit2_nG[n] = self.preconditioner(R_nG[n], kpt)
-            
+            for m, n in enumerate(n_m):
+                psit2_nG[m] = self.preconditioner(R_nG[n], kpt)
+            psit2_mG = psit2_nG[:nm]
+            Htpsit_mG = self.Htpsit_nG[:nm]
+
             # Calculate projections
-            P2_ani = wfs.pt.dict(nbands)
-            wfs.pt.integrate(psit2_nG, P2_ani, kpt.q)
+            P2_ami = wfs.pt.dict(nm)
+            wfs.pt.integrate(psit2_mG, P2_ami, kpt.q)
             
             # Hamiltonian matrix
             # <psi2 | H | psi>
-            wfs.kin.apply(psit2_nG, self.Htpsit_nG, kpt.phase_cd)
-            hamiltonian.apply_local_potential(psit2_nG, self.Htpsit_nG, kpt.s)
-            gemm(self.gd.dv, kpt.psit_nG, self.Htpsit_nG, 0.0, self.H_nn, 'c')
+            wfs.kin.apply(psit2_mG, Htpsit_mG, kpt.phase_cd)
+            hamiltonian.apply_local_potential(psit2_mG, Htpsit_mG, kpt.s)
+            gemm(self.gd.dv, kpt.psit_nG, Htpsit_mG, 0.0, H_nn, 'c')
 
             for a, P_ni in kpt.P_ani.items():
-                P2_ni = P2_ani[a]
+                P2_mi = P2_ami[a]
                 dH_ii = unpack(hamiltonian.dH_asp[a][kpt.s])
-                self.H_nn += np.dot(P2_ni, np.dot(dH_ii, P_ni.T.conj()))
+                H_nn += np.dot(P2_mi, np.dot(dH_ii, P_ni.T.conj()))
 
-            self.gd.comm.sum(self.H_nn, 0)
-            H_2n2n[nbands:, :nbands] = self.H_nn
+            self.gd.comm.sum(H_nn, 0)
+            H_2n2n[nbands:, :nbands] = H_nn
 
             # <psi2 | H | psi2>
-            r2k(0.5 * self.gd.dv, psit2_nG, self.Htpsit_nG, 0.0, self.H_nn)
-            for a, P2_ni in P2_ani.items():
+            r2k(0.5 * self.gd.dv, psit2_mG, Htpsit_mG, 0.0, H_mm)
+            for a, P2_mi in P2_ami.items():
                 dH_ii = unpack(hamiltonian.dH_asp[a][kpt.s])
-                self.H_nn += np.dot(P2_ni, np.dot(dH_ii, P2_ni.T.conj()))
+                H_mm += np.dot(P2_mi, np.dot(dH_ii, P2_mi.T.conj()))
 
-            self.gd.comm.sum(self.H_nn, 0)
-            H_2n2n[nbands:, nbands:] = self.H_nn
+            self.gd.comm.sum(H_mm, 0)
+            H_2n2n[nbands:, nbands:] = H_mm
 
             # Overlap matrix
             # <psi2 | S | psi>
-            gemm(self.gd.dv, kpt.psit_nG, psit2_nG, 0.0, self.S_nn, "c")
+            gemm(self.gd.dv, kpt.psit_nG, psit2_mG, 0.0, S_nn, "c")
         
             for a, P_ni in kpt.P_ani.items():
-                P2_ni = P2_ani[a]
+                P2_mi = P2_ami[a]
                 dO_ii = wfs.setups[a].dO_ii
-                self.S_nn += np.dot(P2_ni, np.inner(dO_ii, P_ni.conj()))
+                S_nn += np.dot(P2_mi, np.inner(dO_ii, P_ni.conj()))
 
-            self.gd.comm.sum(self.S_nn, 0)
-            S_2n2n[nbands:, :nbands] = self.S_nn
+            self.gd.comm.sum(S_nn, 0)
+            S_2n2n[nbands:, :nbands] = S_nn
 
             # <psi2 | S | psi2>
-            rk(self.gd.dv, psit2_nG, 0.0, self.S_nn)
-            for a, P2_ni in P2_ani.items():
+            rk(self.gd.dv, psit2_mG, 0.0, S_mm)
+            for a, P2_mi in P2_ami.items():
                 dO_ii = wfs.setups[a].dO_ii
-                self.S_nn += np.dot(P2_ni, np.dot(dO_ii, P2_ni.T.conj()))
+                S_mm += np.dot(P2_mi, np.dot(dO_ii, P2_mi.T.conj()))
 
-            self.gd.comm.sum(self.S_nn, 0)
-            S_2n2n[nbands:, nbands:] = self.S_nn
+            self.gd.comm.sum(S_mm, 0)
+            S_2n2n[nbands:, nbands:] = S_mm
 
             if self.gd.comm.rank == 0:
                 general_diagonalize(H_2n2n, eps_2n, S_2n2n)
@@ -144,15 +162,15 @@ class Davidson(Eigensolver):
             # Rotate psit_nG
             gemm(1.0, kpt.psit_nG, H_2n2n[:nbands, :nbands],
                  0.0, self.Htpsit_nG)
-            gemm(1.0, psit2_nG, H_2n2n[:nbands, nbands:],
+            gemm(1.0, psit2_mG, H_2n2n[:nbands, nbands:],
                  1.0, self.Htpsit_nG)
             kpt.psit_nG, self.Htpsit_nG = self.Htpsit_nG, kpt.psit_nG
 
             # Rotate P_uni:
             for a, P_ni in kpt.P_ani.items():
-                P2_ni = P2_ani[a]
+                P2_mi = P2_ami[a]
                 gemm(1.0, P_ni.copy(), H_2n2n[:nbands, :nbands], 0.0, P_ni)
-                gemm(1.0, P2_ni, H_2n2n[:nbands, nbands:], 1.0, P_ni)
+                gemm(1.0, P2_mi, H_2n2n[:nbands, nbands:], 1.0, P_ni)
 
             if nit < niter - 1 :
                 wfs.kin.apply(kpt.psit_nG, self.Htpsit_nG, kpt.phase_cd)
@@ -163,10 +181,4 @@ class Davidson(Eigensolver):
                                          kpt.P_ani, kpt.eps_n, R_nG)
 
         self.timer.stop('Davidson')
-        error = self.gd.comm.sum(error)
         return error
-
-
-
-
-    
@@ -11,12 +11,25 @@ from gpaw.utilities import unpack
 
 
 class Eigensolver:
-    def __init__(self, keep_htpsit=True, blocksize=1):
+    """Base class for iterative eigensolvers.
+
+    freeze: float or None
+        Bands with a squared residual norm below freeze * tolerance are
+        not updated (they are still rotated in the subspace
+        diagonalization).  The number of skipped and possible band
+        updates of the last iteration are in *nskipped* and *nupdates*.
+    """
+
+    def __init__(self, keep_htpsit=True, blocksize=1, freeze=None):
         self.keep_htpsit = keep_htpsit
         self.initialized = False
         self.Htpsit_nG = None
         self.error = np.inf
         self.blocksize = blocksize
+        self.P_axi = None
+        self.freeze = freeze
+        self.nskipped = 0
+        self.nupdates = 0
         
     def initialize(self, wfs):
         self.timer = wfs.timer
@@ -65,12 +78,44 @@ class Eigensolver:
             wfs.orthonormalize()
             
         error = 0.0
+        self.nskipped = 0
+        self.nupdates = 0
         for kpt in wfs.kpt_u:
             error += self.iterate_one_k_point(hamiltonian, wfs, kpt)
 
         wfs.orthonormalize()
 
         self.error = self.band_comm.sum(self.kpt_comm.sum(error))
+        self.nskipped = self.band_comm.sum(
+            self.kpt_comm.sum(int(self.nskipped)))
+        self.nupdates = self.band_comm.sum(
+            self.kpt_comm.sum(int(self.nupdates)))
+
+    def get_projection_buffer(self, wfs, nbands):
+        """Return work dict for projections of nbands bands.
+
+        The dict is reused until the atoms move to other domains."""
+        if (self.P_axi is None or
+            sorted(self.P_axi.keys()) != sorted(wfs.pt.my_atom_indices)):
+            self.P_axi = wfs.pt.dict(nbands)
+        return self.P_axi
+
+    def get_frozen_bands(self, r_n):
+        """Return mask of bands that need no update.
+
+        r_n holds the squared norms of the residuals."""
+        if self.freeze is None:
+            return np.zeros(len(r_n), bool)
+        return r_n < self.freeze * self.tolerance
+
+    def get_weights(self, wfs, kpt):
+        """Weights of the band residuals in the error."""
+        if self.nbands_converge != 'occupied':
+            n_n = wfs.bd.global_index(np.arange(wfs.bd.mynbands))
+            return kpt.weight * (n_n < self.nbands_converge)
+        if kpt.f_n is None:
+            return np.zeros(wfs.bd.mynbands) + kpt.weight
+        return kpt.f_n
 
     def iterate_one_k_point(self, hamiltonian, kpt):
         """Implemented in subclasses."""
@@ -178,5 +223,13 @@ class Eigensolver:
         mem.subnode('eps_N', nbands*mem.floatsize)
         mem.subnode('Preconditioner', 4 * gridmem)
         mem.subnode('Work', gridmem)
-        
 
+
+def block_dots(a_xG, b_xG):
+    """Real part of <a_x|b_x> for all x (local contribution only)."""
+    a_xg = a_xG.reshape((len(a_xG), -1))
+    b_xg = b_xG.reshape((len(b_xG), -1))
+    if a_xg.dtype == complex:
+        a_xg = a_xg.view(float)
+        b_xg = b_xg.view(float)
+    return np.array([np.dot(a_g, b_g) for a_g, b_g in zip(a_xg, b_xg)])
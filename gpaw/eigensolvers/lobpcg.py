@@ -0,0 +1,232 @@
+"""Module defining  ``Eigensolver`` classes."""
+
+import numpy as np
+
+from gpaw.utilities.blas import gemm
+from gpaw.utilities.lapack import general_diagonalize
+from gpaw.utilities import unpack
+from gpaw.eigensolvers.eigensolver import Eigensolver, block_dots
+
+
+class LOBPCG(Eigensolver):
+    """Locally optimal block preconditioned conjugate gradient eigensolver
+
+    It is expected that the trial wave functions are orthonormal
+    and the integrals of projector functions and wave functions
+    ``nucleus.P_uni`` are already calculated.
+
+    Solution steps are:
+
+    * Subspace diagonalization
+    * For each block of *blocksize* bands, *niter* times:
+
+      - Calculate residuals of the block
+      - Rayleigh-Ritz step in the space spanned by the block, the
+        preconditioned residuals and the previous search directions
+
+    * Orthonormalization
+
+    New search directions are kept orthogonal to the bands of the
+    lower blocks.  Bands with a residual below tolerance / nbands are
+    soft locked: they stay in the Rayleigh-Ritz space, but get no new
+    search directions.  Only the preconditioned residuals are operated
+    on with the Hamiltonian.
+
+    Band parallelization is not supported, since the lower bands must
+    be available for projecting out."""
+
+    # Smallest eigenvalue of the overlap matrix of the normalized basis
+    # vectors for which the Rayleigh-Ritz step is done:
+    overlap_threshold = 1e-10
+
+    def __init__(self, niter=3, blocksize=8):
+        Eigensolver.__init__(self, True, blocksize)
+        self.niter = niter
+
+    def initialize(self, wfs):
+        Eigensolver.initialize(self, wfs)
+        assert self.band_comm.size == 1, 'LOBPCG: no band parallelization'
+        B = min(self.blocksize, self.mynbands)
+        # Block, search directions and preconditioned residuals:
+        self.V_xG = self.gd.empty(3 * B, self.dtype)
+        self.HV_xG = self.gd.empty(3 * B, self.dtype)
+        self.work_xG = self.gd.zeros(2 * B, self.dtype)
+
+    def estimate_memory(self, mem, gd, dtype, mynbands, nbands):
+        Eigensolver.estimate_memory(self, mem, gd, dtype, mynbands, nbands)
+        gridmem = gd.bytecount(dtype)
+        B = min(self.blocksize, mynbands)
+        mem.subnode('V_xG', 3 * B * gridmem)
+        mem.subnode('HV_xG', 3 * B * gridmem)
+        mem.subnode('work_xG', 2 * B * gridmem)
+
+    def iterate_one_k_point(self, hamiltonian, wfs, kpt):
+        """Do LOBPCG iterations for the kpoint"""
+
+        self.subspace_diagonalize(hamiltonian, wfs, kpt)
+
+        self.timer.start('LOBPCG')
+        weight_n = self.get_weights(wfs, kpt)
+        r_n = np.empty(wfs.bd.mynbands)
+        B = len(self.V_xG) // 3
+        error = 0.0
+        for n1 in range(0, wfs.bd.mynbands, B):
+            n2 = min(n1 + B, wfs.bd.mynbands)
+            error += self.iterate_block(hamiltonian, wfs, kpt, n1, n2,
+                                        weight_n[n1:n2], r_n[n1:n2])
+        kpt.residual_n = r_n
+        self.timer.stop('LOBPCG')
+        return error
+
+    def iterate_block(self, hamiltonian, wfs, kpt, n1, n2, weight_x, r_x):
+        """Do LOBPCG iterations for bands n1 to n2.
+
+        Returns the weighted error of the bands before the update.  The
+        squared norms of their residuals are put in r_x."""
+
+        B = n2 - n1
+        V_xG = self.V_xG
+        HV_xG = self.HV_xG
+        P_axi = self.get_projection_buffer(wfs, len(V_xG))
+        dH_aii = dict([(a, unpack(hamiltonian.dH_asp[a][kpt.s]))
+                       for a in P_axi])
+        eps_x = kpt.eps_n[n1:n2]
+        n_x = range(n1, n2)
+
+        V_xG[:B] = kpt.psit_nG[n1:n2]
+        if self.keep_htpsit:
+            HV_xG[:B] = self.Htpsit_nG[n1:n2]
+        else:
+            wfs.apply_pseudo_hamiltonian(kpt, hamiltonian, V_xG[:B],
+                                         HV_xG[:B])
+        for a, P_xi in P_axi.items():
+            P_xi[:B] = kpt.P_ani[a][n1:n2]
+
+        # V_xG holds the block (B), the search directions (nd) and the
+        # preconditioned residuals (na) in that order:
+        nd = 0
+        error = 0.0
+        for nit in range(self.niter):
+            m = B + nd
+            R_xG = V_xG[m:m + B]
+            R_xG[:] = HV_xG[:B]
+            self.calculate_residuals(kpt, wfs, hamiltonian, V_xG[:B],
+                                     slice_dict(P_axi, 0, B), eps_x, R_xG,
+                                     n_x)
+            rnew_x = block_dots(R_xG, R_xG)
+            self.gd.comm.sum(rnew_x)
+            if nit == 0:
+                r_x[:] = rnew_x
+                error = np.dot(weight_x, r_x)
+
+            # Soft locking:
+            active_x = rnew_x > self.tolerance / self.nbands
+            na = active_x.sum()
+            self.nskipped += B - na
+            self.nupdates += B
+            if na == 0:
+                break
+
+            self.timer.start('precondition')
+            if na < B:
+                R_xG = R_xG[active_x]
+            W_xG = V_xG[m:m + na]
+            W_xG[:] = self.preconditioner(R_xG, kpt)
+            self.timer.stop('precondition')
+
+            P_yi = slice_dict(P_axi, m, m + na)
+            wfs.pt.integrate(W_xG, P_yi, kpt.q)
+            if n1 > 0:
+                self.project_out(wfs, kpt, n1, W_xG, P_yi)
+            wfs.apply_pseudo_hamiltonian(kpt, hamiltonian, W_xG,
+                                         HV_xG[m:m + na])
+            m += na
+
+            self.timer.start('Rayleigh-Ritz')
+            C_mm, eps_m = self.rayleigh_ritz(wfs, P_axi, dH_aii, m)
+            self.timer.stop('Rayleigh-Ritz')
+            if C_mm is None:
+                # Linearly dependent basis: keep the current block
+                break
+
+            # New block and search directions:
+            C_xm = C_mm[:B]
+            C_ym = C_xm[active_x, B:].copy()
+            eps_x[:] = eps_m[:B]
+            for A_xG in [V_xG, HV_xG]:
+                work_xG = self.work_xG
+                gemm(1.0, A_xG[:m], C_xm, 0.0, work_xG[:B])
+                gemm(1.0, A_xG[B:m], C_ym, 0.0, work_xG[B:B + na])
+                A_xG[:B + na] = work_xG[:B + na]
+            for P_xi in P_axi.values():
+                P_yi = np.dot(C_ym, P_xi[B:m])
+                P_xi[:B] = np.dot(C_xm, P_xi[:m])
+                P_xi[B:B + na] = P_yi
+            nd = na
+
+        kpt.psit_nG[n1:n2] = V_xG[:B]
+        for a, P_xi in P_axi.items():
+            kpt.P_ani[a][n1:n2] = P_xi[:B]
+        return error
+
+    def project_out(self, wfs, kpt, n1, W_xG, P_axi):
+        """Remove the components of the first n1 bands from W_xG.
+
+        This keeps blocks of higher bands from collapsing onto the
+        lower bands, which have already been updated."""
+
+        psit_nG = kpt.psit_nG[:n1]
+        C_xn = np.zeros((len(W_xG), n1), self.dtype)
+        gemm(self.gd.dv, psit_nG, W_xG, 0.0, C_xn, 'c')
+        for a, P_xi in P_axi.items():
+            dO_ii = wfs.setups[a].dO_ii
+            gemm(1.0, kpt.P_ani[a][:n1], np.dot(P_xi, dO_ii), 1.0, C_xn,
+                 'c')
+        self.gd.comm.sum(C_xn)
+        gemm(-1.0, psit_nG, C_xn, 1.0, W_xG)
+        for a, P_xi in P_axi.items():
+            gemm(-1.0, kpt.P_ani[a][:n1], C_xn, 1.0, P_xi)
+
+    def rayleigh_ritz(self, wfs, P_axi, dH_aii, m):
+        """Solve the eigenvalue problem in the space of the first m vectors.
+
+        Returns the eigenvectors (in the rows) and the eigenvalues or
+        (None, None) if the basis vectors are (nearly) linearly
+        dependent or one of them is zero."""
+
+        H_mm = np.zeros((m, m), self.dtype)
+        S_mm = np.zeros((m, m), self.dtype)
+        eps_m = np.empty(m)
+        gemm(self.gd.dv, self.V_xG[:m], self.HV_xG[:m], 0.0, H_mm, 'c')
+        gemm(self.gd.dv, self.V_xG[:m], self.V_xG[:m], 0.0, S_mm, 'c')
+        for a, P_xi in P_axi.items():
+            P_mi = P_xi[:m]
+            gemm(1.0, P_mi, np.dot(P_mi, dH_aii[a]), 1.0, H_mm, 'c')
+            gemm(1.0, P_mi, np.dot(P_mi, wfs.setups[a].dO_ii), 1.0, S_mm,
+                 'c')
+        self.gd.comm.sum(H_mm, 0)
+        self.gd.comm.sum(S_mm, 0)
+
+        if self.gd.comm.rank == 0:
+            s_m = S_mm.diagonal().real
+            if (s_m > 0.0).all():
+                # Scale the basis vectors to unit norm:
+                d_m = s_m**-0.5
+                H_mm *= np.outer(d_m, d_m)
+                S_mm *= np.outer(d_m, d_m)
+            if ((s_m > 0.0).all() and
+                np.linalg.eigvalsh(S_mm)[0] > self.overlap_threshold):
+                general_diagonalize(H_mm, eps_m, S_mm)
+                H_mm *= d_m
+            else:
+                eps_m[:] = np.nan
+
+        self.gd.comm.broadcast(H_mm, 0)
+        self.gd.comm.broadcast(eps_m, 0)
+        if np.isnan(eps_m[0]):
+            return None, None
+        return H_mm, eps_m
+
+
+def slice_dict(P_axi, x1, x2):
+    return dict([(a, P_xi[x1:x2]) for a, P_xi in P_axi.items()])
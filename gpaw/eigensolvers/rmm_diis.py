@@ -2,10 +2,7 @@
 
 import numpy as np
 
-from gpaw.utilities.blas import axpy
-from gpaw.eigensolvers.eigensolver import Eigensolver
-from gpaw.utilities import unpack
-from gpaw.mpi import run
+from gpaw.eigensolvers.eigensolver import Eigensolver, block_dots
 
 
 class RMM_DIIS(Eigensolver):
@@ -20,10 +17,35 @@ class RMM_DIIS(Eigensolver):
     * Subspace diagonalization
     * Calculation of residuals
     * Improvement of wave functions:  psi' = psi + lambda PR + lambda PR'
-    * Orthonormalization"""
+    * Orthonormalization
 
-    def __init__(self, keep_htpsit=True, blocksize=1):
-        Eigensolver.__init__(self, keep_htpsit, blocksize)
+    Bands are treated in blocks of *blocksize* bands.  All band-wise
+    inner products of a block are summed over domains in a single
+    reduction, and the work arrays are allocated only once.
+
+    With *freeze*, bands with small residuals are skipped.  This is
+    only done when Htpsit_nG is kept, since the residuals of all bands
+    are then known before the update."""
+
+    def __init__(self, keep_htpsit=True, blocksize=1, freeze=None):
+        Eigensolver.__init__(self, keep_htpsit, blocksize, freeze)
+
+    def initialize(self, wfs):
+        Eigensolver.initialize(self, wfs)
+        B = min(self.blocksize, self.mynbands)
+        self.dR_xG = self.gd.empty(B, self.dtype)
+        if self.keep_htpsit:
+            self.R_xG = None
+        else:
+            self.R_xG = self.gd.empty(B, self.dtype)
+
+    def estimate_memory(self, mem, gd, dtype, mynbands, nbands):
+        Eigensolver.estimate_memory(self, mem, gd, dtype, mynbands, nbands)
+        gridmem = gd.bytecount(dtype)
+        B = min(self.blocksize, mynbands)
+        mem.subnode('dR_xG', B * gridmem)
+        if not (self.keep_htpsit and mynbands == nbands):
+            mem.subnode('R_xG', B * gridmem)
 
     def iterate_one_k_point(self, hamiltonian, wfs, kpt):
         """Do a single RMM-DIIS iteration for the kpoint"""
@@ -31,46 +53,52 @@ class RMM_DIIS(Eigensolver):
         self.subspace_diagonalize(hamiltonian, wfs, kpt)
 
         self.timer.start('RMM-DIIS')
+        mynbands = wfs.bd.mynbands
+        weight_n = self.get_weights(wfs, kpt)
+        r_n = np.empty(mynbands)
+        error = 0.0
         if self.keep_htpsit:
             R_nG = self.Htpsit_nG
             self.calculate_residuals(kpt, wfs, hamiltonian, kpt.psit_nG,
                                      kpt.P_ani, kpt.eps_n, R_nG)
 
-        B = self.blocksize
-        dR_xG = self.gd.empty(B, wfs.dtype)
-        P_axi = wfs.pt.dict(B)
-        error = 0.0
-        for n1 in range(0, wfs.bd.mynbands, B):
-            n2 = n1 + B
-            if n2 > wfs.bd.mynbands:
-                n2 = wfs.bd.mynbands
-                B = n2 - n1
+        # Freezing needs the residuals of all bands before the update:
+        if self.freeze is not None and self.keep_htpsit:
+            r_n[:] = block_dots(R_nG, R_nG)
+            self.gd.comm.sum(r_n)
+            frozen_n = self.get_frozen_bands(r_n)
+            error += np.dot(weight_n[frozen_n], r_n[frozen_n])
+            n_m = np.arange(mynbands)[np.logical_not(frozen_n)]
+        else:
+            n_m = np.arange(mynbands)
+        self.nskipped += mynbands - len(n_m)
+        self.nupdates += mynbands
+
+        B = len(self.dR_xG)
+        dR_xG = self.dR_xG
+        P_axi = self.get_projection_buffer(wfs, B)
+        for m1 in range(0, len(n_m), B):
+            n_x = n_m[m1:m1 + B]
+            if len(n_x) < B:
+                B = len(n_x)
                 P_axi = dict([(a, P_xi[:B]) for a, P_xi in P_axi.items()])
                 dR_xG = dR_xG[:B]
-                
-            n_x = range(n1, n2)
-            
+
+            # Use views when the bands are consecutive:
+            if n_x[-1] - n_x[0] == B - 1:
+                x = slice(n_x[0], n_x[-1] + 1)
+            else:
+                x = n_x
+
             if self.keep_htpsit:
-                R_xG = R_nG[n_x]
+                R_xG = R_nG[x]
             else:
-                R_xG = self.gd.empty(B, wfs.dtype)
-                psit_xG = kpt.psit_nG[n_x]
+                R_xG = self.R_xG[:B]
+                psit_xG = kpt.psit_nG[x]
                 wfs.apply_pseudo_hamiltonian(kpt, hamiltonian, psit_xG, R_xG)
                 wfs.pt.integrate(psit_xG, P_axi, kpt.q)
                 self.calculate_residuals(kpt, wfs, hamiltonian, psit_xG,
-                                         P_axi, kpt.eps_n[n_x], R_xG, n_x)
-
-            for n in n_x:
-                if kpt.f_n is None:
-                    weight = kpt.weight
-                else:
-                    weight = kpt.f_n[n]
-                if self.nbands_converge != 'occupied':
-                    if wfs.bd.global_index(n) < self.nbands_converge:
-                        weight = kpt.weight
-                    else:
-                        weight = 0.0
-                error += weight * np.vdot(R_xG[n - n1], R_xG[n - n1]).real
+                                         P_axi, kpt.eps_n[x], R_xG, n_x)
 
             # Precondition the residual:
             self.timer.start('precondition')
@@ -81,27 +109,32 @@ class RMM_DIIS(Eigensolver):
             wfs.apply_pseudo_hamiltonian(kpt, hamiltonian, dpsit_xG, dR_xG)
             wfs.pt.integrate(dpsit_xG, P_axi, kpt.q)
             self.calculate_residuals(kpt, wfs, hamiltonian, dpsit_xG,
-                                     P_axi, kpt.eps_n[n_x], dR_xG, n_x,
+                                     P_axi, kpt.eps_n[x], dR_xG, n_x,
                                      calculate_change=True)
-            
+
+            # <R|R>, <dR|R> and <dR|dR> for all bands of the block:
+            c_ix = np.empty((3, B))
+            c_ix[0] = block_dots(R_xG, R_xG)
+            c_ix[1] = block_dots(dR_xG, R_xG)
+            c_ix[2] = block_dots(dR_xG, dR_xG)
+            self.gd.comm.sum(c_ix)
+            r_n[x] = c_ix[0]
+            error += np.dot(weight_n[x], c_ix[0])
+
             # Find lam that minimizes the norm of R'_G = R_G + lam dR_G
-            RdR_x = np.array([np.vdot(dR_G, R_G).real
-                              for R_G, dR_G in zip(R_xG, dR_xG)])
-            dRdR_x = np.array([np.vdot(dR_G, dR_G).real for dR_G in dR_xG])
-            self.gd.comm.sum(RdR_x)
-            self.gd.comm.sum(dRdR_x)
+            lam_x = -c_ix[1] / c_ix[2]
 
-            lam_x = -RdR_x / dRdR_x
             # Calculate new psi'_G = psi_G + lam pR_G + lam pR'_G
             #                      = psi_G + p(2 lam R_G + lam**2 dR_G)
-            for lam, R_G, dR_G in zip(lam_x, R_xG, dR_xG):
-                R_G *= 2.0 * lam
-                axpy(lam**2, dR_G, R_G)  # R_G += lam**2 * dR_G
-                
+            shape = (B,) + (1,) * (R_xG.ndim - 1)
+            R_xG *= (2.0 * lam_x).reshape(shape)
+            dR_xG *= (lam_x**2).reshape(shape)
+            R_xG += dR_xG
+
             self.timer.start('precondition')
-            kpt.psit_nG[n1:n2] += self.preconditioner(R_xG, kpt)
+            kpt.psit_nG[x] += self.preconditioner(R_xG, kpt)
             self.timer.stop('precondition')
-            
+
+        kpt.residual_n = r_n
         self.timer.stop('RMM-DIIS')
-        error = self.gd.comm.sum(error)
         return error
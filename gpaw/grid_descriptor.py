@@ -574,10 +574,13 @@ class RadialGridDescriptor:
         self.dv_g = 4 * pi * r_g**2 * dr_g
 
     def derivative(self, n_g, dndr_g):
-        """Finite-difference derivative of radial function."""
-        dndr_g[0] = n_g[1] - n_g[0]
-        dndr_g[1:-1] = 0.5 * (n_g[2:] - n_g[:-2])
-        dndr_g[-1] = n_g[-1] - n_g[-2]
+        """Finite-difference derivative of radial function.
+
+        Works on the last axis, so a stack of radial functions can be
+        differentiated in one go."""
+        dndr_g[..., 0] = n_g[..., 1] - n_g[..., 0]
+        dndr_g[..., 1:-1] = 0.5 * (n_g[..., 2:] - n_g[..., :-2])
+        dndr_g[..., -1] = n_g[..., -1] - n_g[..., -2]
         dndr_g /= self.dr_g
 
     def derivative2(self, a_g, b_g):
@@ -587,11 +590,11 @@ class RadialGridDescriptor:
         to the `derivative` method."""
         
         c_g = a_g / self.dr_g
-        b_g[0] = 0.5 * c_g[1] + c_g[0]
-        b_g[1] = 0.5 * c_g[2] - c_g[0]
-        b_g[1:-1] = 0.5 * (c_g[2:] - c_g[:-2])
-        b_g[-2] = c_g[-1] - 0.5 * c_g[-3]
-        b_g[-1] = -c_g[-1] - 0.5 * c_g[-2]
+        b_g[..., 0] = 0.5 * c_g[..., 1] + c_g[..., 0]
+        b_g[..., 1] = 0.5 * c_g[..., 2] - c_g[..., 0]
+        b_g[..., 1:-1] = 0.5 * (c_g[..., 2:] - c_g[..., :-2])
+        b_g[..., -2] = c_g[..., -1] - 0.5 * c_g[..., -3]
+        b_g[..., -1] = -c_g[..., -1] - 0.5 * c_g[..., -2]
 
     def integrate(self, f_g):
         """Integrate over a radial grid."""
@@ -206,6 +206,16 @@ class Hamiltonian:
             V[nn:nn+2*l+1,nn:nn+2*l+1]=+lq[-1]
             return A,V
 
+    def group_atoms(self, a_x):
+        """Group atom indices by setup.
+
+        Returns a list of lists of atom indices - one list for each
+        setup (in the order of their first atom)."""
+        a_ix = {}
+        for a in sorted(a_x):
+            a_ix.setdefault(id(self.setups[a]), []).append(a)
+        return sorted(a_ix.values())
+
     def update(self, density):
         """Calculate effective potential.
 
@@ -269,76 +279,91 @@ class Hamiltonian:
             W_aL[a] = np.empty((self.setups[a].lmax + 1)**2)
         density.ghat.integrate(self.vHt_g, W_aL)
         self.dH_asp = {}
-        for a, D_sp in density.D_asp.items():
-            W_L = W_aL[a]
-            setup = self.setups[a]
 
-            D_p = D_sp.sum(0)
-            dH_p = (setup.K_p + setup.M_p +
-                    setup.MB_p + 2.0 * np.dot(setup.M_pp, D_p) +
-                    np.dot(setup.Delta_pL, W_L))
-            Ekin += np.dot(setup.K_p, D_p) + setup.Kc
-            Ebar += setup.MB + np.dot(setup.MB_p, D_p)
-            Epot += setup.M + np.dot(D_p, (setup.M_p +
-                                           np.dot(setup.M_pp, D_p)))
-
-            if self.vext_g is not None:
-                vext = self.vext_g.get_taylor(spos_c=self.spos_ac[a, :])
-                # Tailor expansion to the zeroth order
-                Eext += vext[0][0] * (sqrt(4 * pi) * density.Q_aL[a][0]
-                                      + setup.Z)
-                dH_p += vext[0][0] * sqrt(4 * pi) * setup.Delta_pL[:, 0]
-                if len(vext) > 1:
-                    # Tailor expansion to the first order
-                    Eext += sqrt(4 * pi / 3) * np.dot(vext[1],
-                                                      density.Q_aL[a][1:4])
-                    # there must be a better way XXXX
-                    Delta_p1 = np.array([setup.Delta_pL[:, 1],
-                                          setup.Delta_pL[:, 2],
-                                          setup.Delta_pL[:, 3]])
-                    dH_p += sqrt(4 * pi / 3) * np.dot(vext[1], Delta_p1)
-
-            self.dH_asp[a] = dH_sp = np.zeros_like(D_sp)
+        # All atoms of a species are done in one go:
+        species = []
+        for a_x in self.group_atoms(density.D_asp):
+            setup = self.setups[a_x[0]]
+            natoms = len(a_x)
+            D_xsp = np.array([density.D_asp[a] for a in a_x])
+            D_xp = D_xsp.sum(1)
+            W_xL = np.array([W_aL[a] for a in a_x])
+            MD_xp = np.dot(D_xp, setup.M_pp.T)
+            dH_xp = (setup.K_p + setup.M_p +
+                     setup.MB_p + 2.0 * MD_xp +
+                     np.dot(W_xL, setup.Delta_pL.T))
+            D_p = D_xp.sum(0)
+            Ekin += np.dot(setup.K_p, D_p) + natoms * setup.Kc
+            Ebar += natoms * setup.MB + np.dot(setup.MB_p, D_p)
+            Epot += natoms * setup.M + np.vdot(D_xp, setup.M_p + MD_xp)
+
+            dH_xsp = np.zeros_like(D_xsp)
             self.timer.start('XC Correction')
-            Exc += setup.xc_correction.calculate(self.xc, D_sp, dH_sp, a)
+            Exc += setup.xc_correction.calculate_many(self.xc, D_xsp, dH_xsp,
+                                                      a_x).sum()
             self.timer.stop('XC Correction')
-
-            if setup.HubU is not None:
-                nspins = len(D_sp)
+            for a, dH_sp in zip(a_x, dH_xsp):
+                self.dH_asp[a] = dH_sp
+            species.append((setup, a_x, D_xsp, dH_xsp, dH_xp))
+
+        for setup, a_x, D_xsp, dH_xsp, dH_xp in species:
+            if self.vext_g is not None or setup.HubU is not None:
+                for a, dH_p in zip(a_x, dH_xp):
+                    D_sp = density.D_asp[a]
+                    if self.vext_g is not None:
+                        vext = self.vext_g.get_taylor(
+                            spos_c=self.spos_ac[a, :])
+                        # Tailor expansion to the zeroth order
+                        Eext += vext[0][0] * (sqrt(4 * pi) *
+                                              density.Q_aL[a][0] + setup.Z)
+                        dH_p += (vext[0][0] * sqrt(4 * pi) *
+                                 setup.Delta_pL[:, 0])
+                        if len(vext) > 1:
+                            # Tailor expansion to the first order
+                            Eext += sqrt(4 * pi / 3) * np.dot(
+                                vext[1], density.Q_aL[a][1:4])
+                            # there must be a better way XXXX
+                            Delta_p1 = np.array([setup.Delta_pL[:, 1],
+                                                  setup.Delta_pL[:, 2],
+                                                  setup.Delta_pL[:, 3]])
+                            dH_p += sqrt(4 * pi / 3) * np.dot(vext[1],
+                                                              Delta_p1)
+
+                    if setup.HubU is not None:
+                        nspins = len(D_sp)
                 
-                l_j = setup.l_j
-                l   = setup.Hubl
-                nl  = np.where(np.equal(l_j,l))[0]
-                nn  = (2*np.array(l_j)+1)[0:nl[0]].sum()
+                        l_j = setup.l_j
+                        l   = setup.Hubl
+                        nl  = np.where(np.equal(l_j,l))[0]
+                        nn  = (2*np.array(l_j)+1)[0:nl[0]].sum()
                 
-                for D_p, H_p in zip(D_sp, self.dH_asp[a]):
-                    [N_mm,V] =self.aoom(unpack2(D_p),a,l)
-                    N_mm = N_mm / 2 * nspins
+                        for D_p, H_p in zip(D_sp, self.dH_asp[a]):
+                            [N_mm,V] =self.aoom(unpack2(D_p),a,l)
+                            N_mm = N_mm / 2 * nspins
                      
-                    Eorb = setup.HubU / 2. * (N_mm - np.dot(N_mm,N_mm)).trace()
-                    Vorb = setup.HubU * (0.5 * np.eye(2*l+1) - N_mm)
-                    Exc += Eorb
-                    if nspins == 1:
-                        # add contribution of other spin manyfold
-                        Exc += Eorb
+                            Eorb = setup.HubU / 2. * (N_mm - np.dot(N_mm,N_mm)).trace()
+                            Vorb = setup.HubU * (0.5 * np.eye(2*l+1) - N_mm)
+                            Exc += Eorb
+                            if nspins == 1:
+                                # add contribution of other spin manyfold
+                                Exc += Eorb
                     
-                    if len(nl)==2:
-                        mm  = (2*np.array(l_j)+1)[0:nl[1]].sum()
+                            if len(nl)==2:
+                                mm  = (2*np.array(l_j)+1)[0:nl[1]].sum()
                         
-                        V[nn:nn+2*l+1,nn:nn+2*l+1] *= Vorb
-                        V[mm:mm+2*l+1,nn:nn+2*l+1] *= Vorb
-                        V[nn:nn+2*l+1,mm:mm+2*l+1] *= Vorb
-                        V[mm:mm+2*l+1,mm:mm+2*l+1] *= Vorb
-                    else:
-                        V[nn:nn+2*l+1,nn:nn+2*l+1] *= Vorb
+                                V[nn:nn+2*l+1,nn:nn+2*l+1] *= Vorb
+                                V[mm:mm+2*l+1,nn:nn+2*l+1] *= Vorb
+                                V[nn:nn+2*l+1,mm:mm+2*l+1] *= Vorb
+                                V[mm:mm+2*l+1,mm:mm+2*l+1] *= Vorb
+                            else:
+                                V[nn:nn+2*l+1,nn:nn+2*l+1] *= Vorb
                     
-                    Htemp = unpack(H_p)
-                    Htemp += V
-                    H_p[:] = pack2(Htemp)
-
-            dH_sp += dH_p
+                            Htemp = unpack(H_p)
+                            Htemp += V
+                            H_p[:] = pack2(Htemp)
 
-            Ekin -= (D_sp * dH_sp).sum()
+            dH_xsp += dH_xp[:, np.newaxis]
+            Ekin -= np.vdot(D_xsp, dH_xsp)
 
         self.timer.stop('Atomic')
 
@@ -14,10 +14,27 @@ from ase.atoms import Atoms
 import numpy as np
 
 import gpaw.mpi as mpi
+from gpaw import extra_parameters
 import os,time,tempfile
 
-def open(filename, mode='r', comm=mpi.world):
-    if filename.endswith('.nc'):
+def open(filename, mode='r', comm=mpi.world, parallel=False, **kwargs):
+    """Open restart file.
+
+    parallel=True selects parallel reading and writing of .gpw files
+    where all ranks of comm read and write their own slabs of the
+    distributed arrays.
+
+    Files ending with .gpwz are chunked and compressed.  The keyword
+    arguments are passed on to their writer (codec, level, chunksize
+    and single_precision, see gpaw.io.chunked.Writer)."""
+
+    if filename.endswith('.gpwz'):
+        import gpaw.io.chunked as io
+        if mode == 'r':
+            return io.Reader(filename, comm, parallel=parallel)
+        elif mode == 'w':
+            return io.Writer(filename, comm, **kwargs)
+    elif filename.endswith('.nc'):
         import gpaw.io.netcdf as io
     elif filename.endswith('.db'):
         import gpaw.io.cmr_io as io
@@ -27,6 +44,11 @@ def open(filename, mode='r', comm=mpi.world):
         if not filename.endswith('.gpw'):
             filename += '.gpw'
         import gpaw.io.tar as io
+        if parallel:
+            if mode == 'r':
+                return io.Reader(filename, comm, parallel=True)
+            elif mode == 'w':
+                return io.Writer(filename, comm, parallel=True, **kwargs)
 
     if mode == 'r':
         return io.Reader(filename, comm)
@@ -43,7 +65,8 @@ def wave_function_name_template(mode):
         template = 'wfs/psit_Gs%dk%dn%d'
     return ftype, template
 
-def write(paw, filename, mode, cmr_params=None, **kwargs):
+def write(paw, filename, mode, cmr_params=None, parallel=None,
+          background=False, **kwargs):
     """Write state to file.
     
     The `mode` argument should be one of:
@@ -64,6 +87,23 @@ def write(paw, filename, mode, cmr_params=None, **kwargs):
     (Computational Materials Repository)
 
     Please note: mode argument is ignored by for CMR.
+
+    Files ending with .gpwz are chunked and compressed; the keyword
+    arguments codec, level, chunksize and single_precision are passed
+    on to gpaw.io.chunked.Writer.
+
+    With parallel=True, .gpw files are written by all ranks: every
+    domain/band/k-point rank writes its own part of the projections,
+    the pseudo density and potential and the wave functions directly
+    into the file instead of gathering them on the master.  The default
+    is taken from the parallel_io extra parameter
+    (``--gpaw=parallel_io=True``).
+
+    background=True implies parallel=True.  All data is copied when
+    written, and the copies are written to disk by background threads
+    while the calculation continues.  The writer is returned, and the
+    file is complete when w.wait() has returned on all ranks (see
+    Checkpoint).
     """
 
     wfs = paw.wfs
@@ -84,9 +124,23 @@ def write(paw, filename, mode, cmr_params=None, **kwargs):
     magmom_a = paw.get_magnetic_moments()
 
     hdf5 = filename.endswith('.hdf5')
-
-    if master or hdf5:
-        w = open(filename, 'w', world)
+    if parallel is None:
+        parallel = extra_parameters.get('parallel_io', False)
+    parallel = parallel or background
+    # Slab-wise writing of .gpw files:
+    pwrite = (parallel and not hdf5 and not filename.endswith('.db') and
+              not filename.endswith('.nc') and not filename.endswith('.gpwz'))
+    parallel = hdf5 or pwrite
+    background = background and pwrite
+
+    if master or parallel:
+        if filename.endswith('.gpwz'):
+            # Options for the chunked writer:
+            w = open(filename, 'w', world, **kwargs)
+        elif background:
+            w = open(filename, 'w', world, parallel=True, background=True)
+        else:
+            w = open(filename, 'w', world, parallel=pwrite)
         
         w['history'] = 'GPAW restart file'
         w['version'] = '0.8'
@@ -238,14 +292,22 @@ def write(paw, filename, mode, cmr_params=None, **kwargs):
         w = None
 
     # Write projections:
-    if master or hdf5:
+    if master or parallel:
         w.add('Projections', ('nspins', 'nibzkpts', 'nbands', 'nproj'),
-              dtype=dtype)
-    for s in range(wfs.nspins):
-        for k in range(wfs.nibzkpts):
-            all_P_ni = wfs.collect_projections(k, s)
-            if master:
-                w.fill(all_P_ni, s, k)
+              dtype=dtype, parallel=pwrite)
+    if pwrite:
+        # Each rank writes the projections of its own atoms and bands:
+        i1_a = np.cumsum([0] + [setup.ni for setup in wfs.setups])
+        for kpt in wfs.kpt_u:
+            for a, P_ni in kpt.P_ani.items():
+                w.fill(P_ni, kpt.s, kpt.k, wfs.bd.get_slice(),
+                       slice(i1_a[a], i1_a[a + 1]))
+    else:
+        for s in range(wfs.nspins):
+            for k in range(wfs.nibzkpts):
+                all_P_ni = wfs.collect_projections(k, s)
+                if master:
+                    w.fill(all_P_ni, s, k)
 
     # Write atomic density matrices and non-local part of hamiltonian:
     if master:
@@ -275,18 +337,18 @@ def write(paw, filename, mode, cmr_params=None, **kwargs):
                 domain_comm.send(density.D_asp[a], 0, 207)
                 domain_comm.send(hamiltonian.dH_asp[a], 0, 2071)
 
-    if master or hdf5:
+    if master or parallel:
         w.add('AtomicDensityMatrices', ('nspins', 'nadm'), dtype=float)
     if master:
         w.fill(all_D_sp)
-    if master or hdf5:
+    if master or parallel:
         w.add('NonLocalPartOfHamiltonian', ('nspins', 'nadm'), dtype=float)
     if master:
         w.fill(all_H_sp)
 
     # Write the eigenvalues and occupation numbers:
     for name, var in [('Eigenvalues', 'eps_n'), ('OccupationNumbers', 'f_n')]:
-        if master or hdf5:
+        if master or parallel:
             w.add(name, ('nspins', 'nibzkpts', 'nbands'), dtype=float)
         for s in range(wfs.nspins):
             for k in range(wfs.nibzkpts):
@@ -302,7 +364,7 @@ def write(paw, filename, mode, cmr_params=None, **kwargs):
 
     # Write the linear expansion coefficients for Delta SCF:
     if mode == 'all' and norbitals is not None:
-        if master or hdf5:
+        if master or parallel:
             w.dimension('norbitals', norbitals)
             w.add('LinearExpansionOccupations', ('nspins',
                   'nibzkpts', 'norbitals'), dtype=float)
@@ -312,7 +374,7 @@ def write(paw, filename, mode, cmr_params=None, **kwargs):
                 if master:
                     w.fill(ne_o, s, k)
 
-        if master or hdf5:
+        if master or parallel:
             w.add('LinearExpansionCoefficients', ('nspins',
                   'nibzkpts', 'norbitals', 'nbands'), dtype=complex)
         for s in range(wfs.nspins):
@@ -323,13 +385,14 @@ def write(paw, filename, mode, cmr_params=None, **kwargs):
                         w.fill(c_n, s, k, o)
 
     # Write the pseudodensity on the coarse grid:
-    if master or hdf5:
+    if master or parallel:
         w.add('PseudoElectronDensity',
-              ('nspins', 'ngptsx', 'ngptsy', 'ngptsz'), dtype=float)
+              ('nspins', 'ngptsx', 'ngptsy', 'ngptsz'), dtype=float,
+              parallel=pwrite)
 
     for s in range(wfs.nspins):
-        if hdf5:
-            do_write = (kpt_comm.rank == 0)
+        if parallel:
+            do_write = (kpt_comm.rank == 0 and band_comm.rank == 0)
             indices = [s,] +  wfs.gd.get_slice()
             w.fill(density.nt_sG[s], parallel=True, write=do_write,
                    *indices)
@@ -339,13 +402,14 @@ def write(paw, filename, mode, cmr_params=None, **kwargs):
                 w.fill(nt_sG, s)
 
     # Write the pseudopotential on the coarse grid:
-    if master or hdf5:
+    if master or parallel:
         w.add('PseudoPotential',
-              ('nspins', 'ngptsx', 'ngptsy', 'ngptsz'), dtype=float)
+              ('nspins', 'ngptsx', 'ngptsy', 'ngptsz'), dtype=float,
+              parallel=pwrite)
 
     for s in range(wfs.nspins):
-        if hdf5:
-            do_write = (kpt_comm.rank == 0)
+        if parallel:
+            do_write = (kpt_comm.rank == 0 and band_comm.rank == 0)
             indices = [s,] + wfs.gd.get_slice()
             w.fill(hamiltonian.vt_sG[s], parallel=True, write=do_write, 
                    *indices)
@@ -402,7 +466,7 @@ def write(paw, filename, mode, cmr_params=None, **kwargs):
     elif cmr_params is not None and 'db' in cmr_params:
         db = cmr_params['db']
 
-    if master or hdf5:
+    if master or parallel:
         # Close the file here to ensure that the last wave function is
         # written to disk:
         w.close()
@@ -416,6 +480,47 @@ def write(paw, filename, mode, cmr_params=None, **kwargs):
         #Write a db copy to the database
         write(paw, '.db', mode='', cmr_params=cmr_params, **kwargs)
 
+    if background:
+        return w
+
+
+class Checkpoint:
+    """Restart file written in the background.
+
+    At most one checkpoint is being written at any time, and the file
+    is written under a temporary name that is renamed to the real name
+    when all ranks have finished writing, so the last completed
+    checkpoint is always valid on disk.  Files not ending with .gpw
+    are written synchronously."""
+
+    def __init__(self, paw, filename):
+        self.paw = paw
+        if not os.path.splitext(filename)[1]:
+            filename += '.gpw'
+        self.filename = filename
+        self.tmpfilename = filename[:-4] + '.tmp.gpw'
+        self.writer = None
+
+    def write(self, mode='all'):
+        self.wait()
+        if not self.filename.endswith('.gpw'):
+            write(self.paw, self.filename, mode)
+            return
+        self.writer = write(self.paw, self.tmpfilename, mode,
+                            background=True)
+
+    def wait(self):
+        """Wait for the checkpoint in progress to be completed."""
+        if self.writer is None:
+            return
+        self.writer.wait()
+        self.writer = None
+        world = self.paw.wfs.world
+        world.barrier()
+        if world.rank == 0:
+            os.rename(self.tmpfilename, self.filename)
+        world.barrier()
+
 
 def read(paw, reader):
     r = reader
@@ -434,6 +539,8 @@ def read(paw, reader):
     version = r['version']
 
     hdf5 = hasattr(r, 'hdf5_reader')
+    # Each rank reads only its own slabs of the distributed arrays:
+    parallel = hdf5 or getattr(r, 'parallel', False)
 
     # Verify setup fingerprints and count projectors and atomic matrices:
     for setup in wfs.setups.setups.values():
@@ -474,7 +581,7 @@ def read(paw, reader):
     # Read pseudoelectron density on the coarse grid
     # and distribute out to nodes:
     nt_sG = wfs.gd.empty(density.nspins)
-    if hdf5:
+    if parallel:
         indices = [slice(0, density.nspins),] + wfs.gd.get_slice()
         nt_sG[:] = r.get('PseudoElectronDensity', *indices)
     else:
@@ -492,7 +599,7 @@ def read(paw, reader):
     # and distribute out to nodes:
     if version > 0.3:
         hamiltonian.vt_sG = wfs.gd.empty(hamiltonian.nspins)
-        if hdf5:
+        if parallel:
             indices = [slice(0, hamiltonian.nspins), ] + wfs.gd.get_slice()
             hamiltonian.vt_sG[:] = r.get('PseudoPotential', *indices)
         else:
@@ -609,7 +716,7 @@ def read(paw, reader):
         if (r.has_array('PseudoWaveFunctions') and
             paw.input_parameters.mode == 'fd'):
             
-            if band_comm.size == 1 and not hdf5:
+            if band_comm.size == 1 and not parallel:
                 # We may not be able to keep all the wave
                 # functions in memory - so psit_nG will be a special type of
                 # array that is really just a reference to a file:
@@ -620,7 +727,7 @@ def read(paw, reader):
             else:
                 for kpt in wfs.kpt_u:
                     kpt.psit_nG = wfs.gd.empty(wfs.mynbands, wfs.dtype)
-                    if hdf5:
+                    if parallel:
                         indices = [kpt.s, kpt.k]
                         indices.append(wfs.bd.get_slice())
                         indices += wfs.gd.get_slice()
@@ -0,0 +1,183 @@
+"""Chunked and compressed restart files.
+
+Every array is cut into chunks of a fixed number of elements, and each
+chunk is compressed and stored as a separate member (``name.0``,
+``name.1``, ...) of a tar-file.  The tar-file index is the chunk index:
+reading part of an array only decompresses the chunks that are
+touched.  Wave functions can optionally be stored in single precision
+when they are only needed as a starting guess for the SCF cycle.
+"""
+
+import zlib
+import bz2
+
+import numpy as np
+
+from gpaw.io import tar
+from gpaw.io.tar import TarFileReference, hyperslab
+
+codecs = {None: (lambda string, level: string, lambda string: string),
+          'zlib': (zlib.compress, zlib.decompress),
+          'bz2': (bz2.compress, bz2.decompress)}
+
+wave_function_names = ['PseudoWaveFunctions', 'WaveFunctionCoefficients']
+
+single_precision_dtypes = {np.float64: np.float32,
+                           np.complex128: np.complex64}
+
+
+class Writer(tar.Writer):
+    """Writer for chunked files.
+
+    codec: str or None
+        Compression: 'zlib' (default), 'bz2' or None.
+    level: int
+        Compression level (1 is fastest).
+    chunksize: int
+        Size of uncompressed chunks in bytes.
+    single_precision: bool
+        Store wave functions as float32/complex64."""
+
+    def __init__(self, name, comm=None, codec='zlib', level=1,
+                 chunksize=2**22, single_precision=False):
+        tar.Writer.__init__(self, name, comm)
+        self.compress = codecs[codec][0]
+        self.codec = codec
+        self.level = level
+        self.chunksize = chunksize
+        self.single_precision = single_precision
+
+    def add(self, name, shape, array=None, dtype=None, units=None,
+            parallel=False):
+        if array is not None:
+            array = np.asarray(array)
+
+        self.dtype, type, itemsize = self.get_data_type(array, dtype)
+        if self.single_precision and name in wave_function_names:
+            self.dtype = np.dtype(single_precision_dtypes[self.dtype.type])
+        self.shape = [self.dims[dim] for dim in shape]
+        self.nelements = int(np.prod(self.shape, dtype=int))
+        self.nchunk = max(1, self.chunksize // self.dtype.itemsize)
+        self.name = name
+        self.nfilled = 0
+        self.nchunks = 0
+        self.buffer_x = []
+        self.nbuffer = 0
+
+        self.xml2 += ['  <array name="%s" type="%s" storage="%s" codec="%s" '
+                      'chunk="%d">' % (name, type, self.dtype.name,
+                                       self.codec, self.nchunk)]
+        self.xml2 += ['    <dimension length="%s" name="%s"/>' %
+                      (self.dims[dim], dim)
+                      for dim in shape]
+        self.xml2 += ['  </array>']
+        if array is not None:
+            self.fill(array)
+
+    def fill(self, array, *indices, **kwargs):
+        """Append data to the current array.
+
+        Complete chunks are compressed and written as soon as they are
+        full."""
+        a_x = np.asarray(array, self.dtype).ravel()
+        self.buffer_x.append(a_x)
+        self.nbuffer += len(a_x)
+        while (self.nbuffer >= self.nchunk or
+               (self.nbuffer > 0 and
+                self.nfilled + self.nbuffer == self.nelements)):
+            a_x = np.concatenate(self.buffer_x)
+            self.write_chunk(a_x[:self.nchunk])
+            self.buffer_x = [a_x[self.nchunk:]]
+            self.nbuffer = len(self.buffer_x[0])
+
+    def write_chunk(self, a_x):
+        string = self.compress(a_x.tostring(), self.level)
+        self.write_header('%s.%d' % (self.name, self.nchunks), len(string))
+        self.write(string)
+        self.nchunks += 1
+        self.nfilled += len(a_x)
+
+
+class Reader(tar.Reader):
+    """Reader for chunked files.
+
+    The last decompressed chunk is kept, so that reading an array piece
+    by piece (say, band by band) decompresses every chunk only once."""
+
+    def __init__(self, name, comm=None, parallel=False):
+        self.storage = {}
+        self.codecs = {}
+        self.nchunk = {}
+        self.chunk = (None, None)
+        tar.Reader.__init__(self, name, comm, parallel)
+
+    def startElement(self, tag, attrs):
+        tar.Reader.startElement(self, tag, attrs)
+        if tag == 'array':
+            name = attrs['name']
+            self.storage[name] = np.dtype(str(attrs['storage']))
+            codec = attrs['codec']
+            if codec == 'None':
+                codec = None
+            self.codecs[name] = codecs[codec][1]
+            self.nchunk[name] = int(attrs['chunk'])
+
+    def get(self, name, *indices):
+        """Read (part of) array.
+
+        The indices can be integers or slices.  Only the chunks holding
+        the selected elements are decompressed."""
+
+        offset_r, nrun, shape = hyperslab(self.shapes[name], indices)
+        nchunk = self.nchunk[name]
+        array = np.empty((len(offset_r), nrun), self.storage[name])
+        for offset, a_x in zip(offset_r, array):
+            i = 0
+            while i < nrun:
+                c, j = divmod(offset + i, nchunk)
+                n = min(nrun - i, nchunk - j)
+                a_x[i:i + n] = self.get_chunk(name, c)[j:j + n]
+                i += n
+
+        dtype = self.get_data_type(name)[0]
+        if dtype == np.int32:
+            dtype = int
+        array = np.asarray(array, dtype).reshape(shape)
+        if shape == ():
+            return array.item()
+        else:
+            return array
+
+    def get_chunk(self, name, c):
+        key = (name, c)
+        if self.chunk[0] != key:
+            string = self.tar.extractfile('%s.%d' % key).read()
+            dtype = self.storage[name]
+            if self.byteswap:
+                dtype = dtype.newbyteorder()
+            a_x = np.fromstring(self.codecs[name](string), dtype)
+            self.chunk = (key, a_x)
+        return self.chunk[1]
+
+    def get_reference(self, name, *indices):
+        return ChunkedFileReference(self, name, indices)
+
+
+class ChunkedFileReference(TarFileReference):
+    """Reference to array in chunked file.
+
+    Indexing with integers and slices reads and decompresses only the
+    chunks that are needed."""
+
+    def __init__(self, reader, name, indices):
+        self.reader = reader
+        self.name = name
+        self.indices = tuple(indices)
+        self.shape = tuple(reader.shapes[name][len(indices):])
+        self.dtype = reader.get_data_type(name)[0]
+        self.itemsize = self.dtype.itemsize
+
+    def __getitem__(self, indices):
+        if not isinstance(indices, tuple):
+            indices = (indices,)
+        return self.reader.get(self.name, *(self.indices + indices))
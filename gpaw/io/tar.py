@@ -1,6 +1,7 @@
 import os
 import time
 import tarfile
+import threading
 import xml.sax
 
 import numpy as np
@@ -11,18 +12,97 @@ floatsize = np.array([1], float).itemsize
 complexsize = np.array([1], complex).itemsize
 itemsizes = {'int': intsize, 'float': floatsize, 'complex': complexsize}
 
-    
+
+def hyperslab(shape, indices):
+    """Locate a hyperslab of a C-ordered array.
+
+    The indices can be integers or slices (one per leading dimension;
+    missing trailing dimensions are taken in full).  Returns the element
+    offsets of the contiguous runs making up the hyperslab, the length
+    of each run and the shape of the hyperslab (dimensions indexed by
+    an integer are dropped)."""
+
+    start_d = []
+    count_d = []
+    step_d = []
+    slabshape = []
+    for d, n in enumerate(shape):
+        if d >= len(indices):
+            start, stop, step = 0, n, 1
+        elif isinstance(indices[d], slice):
+            start, stop, step = indices[d].indices(n)
+        else:
+            start, stop, step = indices[d], indices[d] + 1, 1
+        count = max(0, (stop - start + step - 1) // step)
+        if d >= len(indices) or isinstance(indices[d], slice):
+            slabshape.append(count)
+        start_d.append(start)
+        count_d.append(count)
+        step_d.append(step)
+
+    stride_d = [int(np.prod(shape[d + 1:], dtype=int))
+                for d in range(len(shape))]
+
+    # Dimensions j, j + 1, ... are selected in full:
+    j = len(shape)
+    while j > 0 and count_d[j - 1] == shape[j - 1] and step_d[j - 1] == 1:
+        j -= 1
+
+    if j > 0 and step_d[j - 1] == 1:
+        # Runs cover a part of dimension j - 1 and all of the rest:
+        j -= 1
+        nrun = count_d[j] * stride_d[j]
+        offset_r = np.array(start_d[j] * stride_d[j])
+    else:
+        nrun = int(np.prod(shape[j:], dtype=int))
+        offset_r = np.array(0)
+
+    for d in range(j):
+        offset_r = np.add.outer(offset_r, (start_d[d] + step_d[d] *
+                                           np.arange(count_d[d])) *
+                                stride_d[d])
+    return offset_r.ravel(), nrun, tuple(slabshape)
+
+
 class Writer:
-    def __init__(self, name, comm=None):
+    """Writer for tar files.
+
+    With parallel=True all ranks of comm take part in writing the file.
+    The master writes all headers and reserves the space for every
+    array, and each rank writes its own slabs of arrays added with
+    parallel=True directly at their offsets in the file - no data is
+    gathered on the master.  The resulting file is an ordinary tar-file
+    that can be read with Reader.
+
+    With background=True (parallel mode only), the slabs are copied
+    when filled in and written to disk by a background thread started
+    by close().  No communication takes place in the thread.  Use
+    wait() to make sure this rank has finished writing."""
+
+    def __init__(self, name, comm=None, parallel=False, background=False):
         self.dims = {}
         self.files = {}
         self.xml1 = ['<gpaw_io version="0.1" endianness="%s">' %
                      ('big', 'little')[int(np.little_endian)]]
         self.xml2 = []
-        if os.path.isfile(name):
-            os.rename(name, name[:-4] + '.old'+name[-4:])
-        self.tar = tarfile.open(name, 'w')
+        self.parallel = parallel
+        self.comm = comm
+        self.master = not parallel or comm.rank == 0
+        if self.master:
+            if os.path.isfile(name):
+                os.rename(name, name[:-4] + '.old'+name[-4:])
+            self.tar = tarfile.open(name, 'w')
         self.mtime = int(time.time())
+        if parallel:
+            # The file must exist before the slaves can open it:
+            comm.barrier()
+            self.fileobj = open(name, 'r+b')
+            self.offset = 0  # offset of next header
+            self.data_offset = None  # offset of data of current array
+        assert parallel or not background
+        self.background = background
+        self.slabs = []  # slabs waiting to be written by the thread
+        self.thread = None
         
     def dimension(self, name, value):
         if name in self.dims.keys() and self.dims[name] != value:
@@ -34,7 +114,13 @@ class Writer:
         self.xml1 += ['  <parameter %-20s value="%s"/>' %
                       ('name="%s"' % name, value)]
         
-    def add(self, name, shape, array=None, dtype=None, units=None):
+    def add(self, name, shape, array=None, dtype=None, units=None,
+            parallel=False):
+        """Add array.
+
+        In parallel mode, parallel=True means that this call is
+        collective and that all ranks will fill in slabs of the array."""
+
         if array is not None:
             array = np.asarray(array)
 
@@ -46,9 +132,14 @@ class Writer:
         self.xml2 += ['  </array>']
         self.shape = [self.dims[dim] for dim in shape]
         size = itemsize * np.product([self.dims[dim] for dim in shape])
-        self.write_header(name, size)
-        if array is not None:
-            self.fill(array)
+        if self.parallel:
+            self.reserve(name, size, parallel)
+            if array is not None and self.master:
+                self.fill(array)
+        else:
+            self.write_header(name, size)
+            if array is not None:
+                self.fill(array)
 
     def get_data_type(self, array=None, dtype=None):
         if dtype is None:
@@ -64,8 +155,53 @@ class Writer:
 
         return dtype, type, dtype.itemsize
 
-    def fill(self, array, *indices):
-        self.write(np.asarray(array, self.dtype).tostring())
+    def fill(self, array, *indices, **kwargs):
+        """Fill in array data.
+
+        In serial mode the data is appended to the current array and
+        the indices are ignored.  In parallel mode the indices (integers
+        or slices) locate the slab to be written, and write=False can be
+        used to take part in a parallel fill without writing anything.
+        Without indices, the data is appended to the current array also
+        in parallel mode."""
+
+        if not self.parallel:
+            self.write(np.asarray(array, self.dtype).tostring())
+        elif kwargs.get('write', True):
+            self.write_slab(array, indices)
+
+    def write_slab(self, array, indices):
+        assert self.data_offset is not None, 'Array not added in parallel'
+        if indices:
+            offset_r, nrun = hyperslab(self.shape, indices)[:2]
+        else:
+            # Append at the end of what has been filled in so far:
+            nrun = int(np.prod(np.shape(array), dtype=int))
+            offset_r = np.array([self.fill_offset])
+            self.fill_offset += nrun
+            assert self.fill_offset <= np.prod(self.shape, dtype=int)
+        if self.background:
+            # Take a snapshot:
+            array = np.array(array, self.dtype)
+        else:
+            array = np.ascontiguousarray(array, self.dtype)
+        assert array.size == len(offset_r) * nrun
+        offset_r = self.data_offset + offset_r * self.dtype.itemsize
+        a_rx = array.reshape((len(offset_r), nrun))
+        if self.background:
+            self.slabs.append((offset_r, a_rx))
+        else:
+            self.write_runs(offset_r, a_rx)
+
+    def write_runs(self, offset_r, a_rx):
+        for offset, a_x in zip(offset_r, a_rx):
+            self.fileobj.seek(offset)
+            self.fileobj.write(a_x.tostring())
+
+    def flush_slabs(self):
+        while self.slabs:
+            self.write_runs(*self.slabs.pop(0))
+        self.fileobj.close()
 
     def write_header(self, name, size):
         assert name not in self.files.keys()
@@ -77,6 +213,36 @@ class Writer:
         self.n = 0
         self.tar.addfile(tarinfo)
 
+    def reserve(self, name, size, parallel):
+        """Write header and reserve space for data (parallel mode)."""
+        tarinfo = tarfile.TarInfo(name)
+        tarinfo.mtime = self.mtime
+        tarinfo.size = size
+        self.offset += len(tarinfo.tobuf())
+        data_offset = self.offset
+        self.offset += -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+        self.fill_offset = 0  # number of elements appended so far
+        if self.master:
+            assert name not in self.files.keys()
+            self.files[name] = tarinfo
+            self.tar.addfile(tarinfo)
+            assert self.tar.offset == data_offset
+            # Skip the data - it is written through self.fileobj:
+            self.tar.fileobj.seek(self.offset)
+            self.tar.offset = self.offset
+            self.data_offset = data_offset
+        elif parallel:
+            self.data_offset = data_offset
+        else:
+            # Only the master knows where this array goes:
+            self.data_offset = None
+        if parallel:
+            # Make sure everybody agrees on the offset (the master may
+            # have added arrays that the slaves don't know about):
+            offset_a = np.array([data_offset, self.offset])
+            self.comm.broadcast(offset_a, 0)
+            self.data_offset, self.offset = [int(x) for x in offset_a]
+
     def write(self, string):
         self.tar.fileobj.write(string)
         self.n += len(string)
@@ -90,19 +256,48 @@ class Writer:
     def close(self):
         self.xml2 += ['</gpaw_io>\n']
         string = '\n'.join(self.xml1 + self.xml2)
+        if self.background:
+            self.thread = threading.Thread(target=self.flush_slabs)
+            self.thread.start()
+        elif self.parallel:
+            self.fileobj.close()
+        if not self.master:
+            return
         self.write_header('info.xml', len(string))
         self.write(string)
         self.tar.close()
 
+    def wait(self):
+        """Wait for background writing to finish on this rank."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
 
 class Reader(xml.sax.handler.ContentHandler):
-    def __init__(self, name, comm=None):
+    """Reader for tar files.
+
+    Uncompressed files are memory-mapped, so that only the parts of the
+    arrays that are actually used are read from disk.
+
+    With parallel=True, gpaw.io.read() will let each rank read only its
+    own slabs of the distributed arrays (see get())."""
+
+    def __init__(self, name, comm=None, parallel=False):
+        self.parallel = parallel
         self.dims = {}
         self.shapes = {}
         self.dtypes = {}
         self.parameters = {}
         xml.sax.handler.ContentHandler.__init__(self)
-        self.tar = tarfile.open(name, 'r')
+        try:
+            self.tar = tarfile.open(name, 'r:')
+        except tarfile.ReadError:
+            # Compressed file:
+            self.tar = tarfile.open(name, 'r')
+            self.memory = None
+        else:
+            self.memory = np.memmap(name, np.uint8, 'r')
         f = self.tar.extractfile('info.xml')
         xml.sax.parse(f, self)
 
@@ -137,6 +332,26 @@ class Reader(xml.sax.handler.ContentHandler):
         return name in self.shapes
     
     def get(self, name, *indices):
+        """Read array.
+
+        The indices can be integers or slices with or without a step
+        (e.g. from gd.get_slice()).  Only the selected part of the array
+        is read from the file."""
+
+        if self.memory is not None:
+            array = self.get_view(name, indices)
+            if array.dtype.kind == 'i':
+                array = np.array(array, int)
+            else:
+                array = np.array(array, array.dtype.newbyteorder('='))
+            if array.shape == ():
+                return array.item()
+            else:
+                return array
+
+        for index in indices:
+            if isinstance(index, slice):
+                return self.get_slab(name, indices)
         fileobj, shape, size, dtype = self.get_file_object(name, indices)
         array = np.fromstring(fileobj.read(size), dtype)
         if self.byteswap:
@@ -149,7 +364,39 @@ class Reader(xml.sax.handler.ContentHandler):
         else:
             return array
     
+    def get_slab(self, name, indices):
+        dtype, type, itemsize = self.get_data_type(name)
+        offset_r, nrun, shape = hyperslab(self.shapes[name], indices)
+        offset0 = self.tar.getmember(name).offset_data
+        fileobj = self.tar.fileobj
+        array = np.empty((len(offset_r), nrun), dtype)
+        for offset, a_x in zip(offset_r, array):
+            fileobj.seek(offset0 + offset * itemsize)
+            a_x[:] = np.fromstring(fileobj.read(nrun * itemsize), dtype)
+        if self.byteswap:
+            array = array.byteswap()
+        if dtype == np.int32:
+            array = np.asarray(array, int)
+        return array.reshape(shape)
+
+    def get_view(self, name, indices):
+        """Return read-only view of array in memory-mapped file.
+
+        Nothing is read from disk here, and the bytes are not swapped."""
+        dtype, type, itemsize = self.get_data_type(name)
+        if self.byteswap:
+            dtype = dtype.newbyteorder()
+        shape = self.shapes[name]
+        size = itemsize * np.prod(shape, dtype=int)
+        offset = self.tar.getmember(name).offset_data
+        array = np.asarray(self.memory[offset:offset + size])
+        return array.view(dtype).reshape(shape)[tuple(indices)]
+
     def get_reference(self, name, *indices):
+        if self.memory is not None:
+            array = self.get_view(name, indices)
+            assert array.dtype.kind != 'i'
+            return MemoryMappedTarFileReference(array)
         fileobj, shape, size, dtype = self.get_file_object(name, indices)
         assert dtype != np.int32
         return TarFileReference(fileobj, shape, dtype, self.byteswap)
@@ -180,6 +427,8 @@ class Reader(xml.sax.handler.ContentHandler):
 
     def close(self):
         self.tar.close()
+        # Existing references keep the memory map alive:
+        self.memory = None
 
 class TarFileReference:
     def __init__(self, fileobj, shape, dtype, byteswap):
@@ -228,3 +477,25 @@ class TarFileReference:
 
     def __array__(self):
         return self[::]
+
+
+class MemoryMappedTarFileReference(TarFileReference):
+    """Reference to array in uncompressed tar-file.
+
+    Any numpy indexing is allowed.  The result is a read-only view of
+    the memory-mapped file, so only the pages touched are read from
+    disk.  Data is copied only if the bytes need to be swapped, and then
+    only for the part that was asked for."""
+
+    def __init__(self, array):
+        self.array = array
+        self.shape = array.shape
+        self.dtype = array.dtype.newbyteorder('=')
+        self.itemsize = self.dtype.itemsize
+        self.byteswap = not array.dtype.isnative
+
+    def __getitem__(self, indices):
+        array = self.array[indices]
+        if self.byteswap:
+            array = array.astype(self.dtype)
+        return array
@@ -86,6 +86,7 @@ class KPoint:
         self.eps_n = None
         self.f_n = None
         self.P_ani = None
+        self.residual_n = None  # squared norms of residuals
 
         # Only one of these two will be used:
         self.psit_nG = None  # wave functions on 3D grid
@@ -50,6 +50,17 @@ class LrTDDFT(ExcitationList):
     derivative_level:
     0: use Exc, 1: use vxc, 2: use fxc  if available
 
+    direct:
+    Do not build the Omega matrix (RPA only, not with force_ApmB or
+    hybrid functionals).  The lowest excitations
+    are then obtained with diagonalize(nexcitations=...)
+
+    restart:
+    File to store the rows of the Omega matrix as soon as they are
+    calculated.  An interrupted calculation started again with the same
+    file only calculates the missing rows.  Files written for another xc
+    functional or other Kohn-Sham singles are refused.
+
     filename:
     read from a file
     """
@@ -67,7 +78,9 @@ class LrTDDFT(ExcitationList):
                  filename=None,
                  finegrid=2,
                  force_ApmB=False, # for tests
-                 eh_comm=None # parallelization over eh-pairs
+                 eh_comm=None, # parallelization over eh-pairs
+                 direct=False,
+                 restart=None
                  ):
 
         self.nspins = None
@@ -91,6 +104,8 @@ class LrTDDFT(ExcitationList):
         self.numscale = numscale
         self.finegrid = finegrid
         self.force_ApmB = force_ApmB
+        self.direct = direct
+        self.restart = restart
 
         if eh_comm is None:
             eh_comm = mpi.serial_comm
@@ -179,22 +194,30 @@ class LrTDDFT(ExcitationList):
         else:
             Om = ApmB
             name = 'LrTDDFThyb'
+        if self.direct and Om is ApmB:
+            raise NotImplementedError('direct is only available for RPA '
+                                      'without Hartree-Fock exchange')
         self.Om = Om(self.calculator, self.kss,
                      self.xc, self.derivative_level, self.numscale,
                      finegrid=self.finegrid, eh_comm=self.eh_comm,
-                     txt=self.txt)
+                     txt=self.txt, direct=self.direct,
+                     restart=self.restart)
         self.name = name
 ##        self.diagonalize()
 
-    def diagonalize(self, istart=None, jend=None, energy_range=None):
+    def diagonalize(self, istart=None, jend=None, energy_range=None,
+                    nexcitations=None):
+        """Calculate the excitations.
+
+        Only the lowest nexcitations are calculated if given."""
         self.istart = istart
         self.jend = jend
-        self.Om.diagonalize(istart, jend, energy_range)
+        self.Om.diagonalize(istart, jend, energy_range, nexcitations)
         
         # remove old stuff
         while len(self): self.pop()
 
-        for j in range(len(self.Om.kss)):
+        for j in range(len(self.Om.eigenvalues)):
             self.append(LrTDDFTExcitation(self.Om,j))
 
     def get_Om(self):
@@ -294,7 +317,7 @@ class LrTDDFT(ExcitationList):
         string += self.kss.__str__()
         return string
 
-    def write(self, filename=None, fh=None):
+    def write(self, filename=None, fh=None, binary=False):
         """Write current state to a file.
 
         'filename' is the filename. If the filename ends in .gz,
@@ -302,6 +325,9 @@ class LrTDDFT(ExcitationList):
 
         'fh' is a filehandle. This can be used to write into already
         opened files. 
+
+        'binary' writes the Kohn-Sham singles and the Omega matrix in
+        npy format.  Files are read independent of this choice.
         """
         if mpi.rank == mpi.MASTER:
             if fh is None:
@@ -324,8 +350,8 @@ class LrTDDFT(ExcitationList):
             f.write(xc + '\n')
             f.write('%g %d %g %d' % (self.eps, int(self.derivative_level),
                                      self.numscale, int(self.finegrid)) + '\n')
-            self.kss.write(fh=f)
-            self.Om.write(fh=f)
+            self.kss.write(fh=f, binary=binary)
+            self.Om.write(fh=f, binary=binary)
 
             if len(self):
                 f.write('# Eigenvalues\n')
@@ -9,7 +9,8 @@ from numpy.linalg import inv
 from ase.units import Hartree
 
 import gpaw.mpi as mpi
-from gpaw.lrtddft.omega_matrix import OmegaMatrix
+from gpaw.lrtddft.omega_matrix import OmegaMatrix, davidson
+from gpaw.lrtddft.omega_matrix import read_matrix, write_matrix
 from gpaw.pair_density import PairDensity
 from gpaw.utilities import pack
 from gpaw.utilities.lapack import diagonalize, gemm, sqrt_matrix
@@ -227,22 +228,21 @@ class ApmB(OmegaMatrix):
         st+='%d'%ti+'s'
         return st
 
-    def diagonalize(self, istart=None, jend=None, energy_range=None):
+    def diagonalize(self, istart=None, jend=None, energy_range=None,
+                    nexcitations=None):
         """Evaluate Eigenvectors and Eigenvalues:"""
 
+        if self.direct:
+            raise NotImplementedError('direct is not available for ApmB')
+
         map, kss = self.get_map(istart, jend, energy_range)
         nij = len(kss)
         if map is None:
             ApB = self.ApB.copy()
             AmB = self.AmB.copy()
-            nij = len(kss)
         else:
-            ApB = np.empty((nij, nij))
-            AmB = np.empty((nij, nij))
-            for ij in range(nij):
-                for kq in range(nij):
-                    ApB[ij,kq] = self.ApB[map[ij],map[kq]]
-                    AmB[ij,kq] = self.AmB[map[ij],map[kq]]
+            ApB = self.ApB[np.ix_(map, map)]
+            AmB = self.AmB[np.ix_(map, map)]
 
         # the occupation matrix
         C = np.empty((nij,))
@@ -258,8 +258,15 @@ class ApmB(OmegaMatrix):
         self.eigenvectors = np.zeros(ApB.shape)
         gemm(1.0, S, M, 0.0, self.eigenvectors)
         
-        self.eigenvalues = np.zeros((len(kss)))
         self.kss = kss
+        if nexcitations is not None:
+            Om = self.eigenvectors
+            e_x = np.array([ks.get_energy() for ks in kss])
+            self.eigenvalues, self.eigenvectors = davidson(
+                lambda u_nx: np.dot(u_nx, Om), e_x**2, nexcitations,
+                txt=self.txt)
+            return
+        self.eigenvalues = np.zeros((len(kss)))
         diagonalize(self.eigenvectors, self.eigenvalues)
         
     def read(self, filename=None, fh=None):
@@ -270,25 +277,8 @@ class ApmB(OmegaMatrix):
             else:
                 f = fh
 
-            f.readline()
-            nij = int(f.readline())
-            ApB = np.zeros((nij, nij))
-            for ij in range(nij):
-                l = f.readline().split()
-                for kq in range(ij, nij):
-                    ApB[ij, kq] = float(l[kq - ij])
-                    ApB[kq, ij] = ApB[ij, kq]
-            self.ApB = ApB
-
-            f.readline()
-            nij = int(f.readline())
-            AmB = np.zeros((nij, nij))
-            for ij in range(nij):
-                l = f.readline().split()
-                for kq in range(ij, nij):
-                    AmB[ij, kq] = float(l[kq - ij])
-                    AmB[kq, ij] = AmB[ij, kq]
-            self.AmB = AmB
+            self.ApB = read_matrix(f)
+            self.AmB = read_matrix(f)
 
             if fh is None:
                 f.close()
@@ -297,7 +287,7 @@ class ApmB(OmegaMatrix):
         """weight for the coupling matrix terms"""
         return 2.
     
-    def write(self, filename=None, fh=None):
+    def write(self, filename=None, fh=None, binary=False):
         """Write current state to a file."""
         if mpi.rank == mpi.MASTER:
             if fh is None:
@@ -305,21 +295,8 @@ class ApmB(OmegaMatrix):
             else:
                 f = fh
 
-            f.write('# A+B\n')
-            nij = len(self.fullkss)
-            f.write('%d\n' % nij)
-            for ij in range(nij):
-                for kq in range(ij, nij):
-                    f.write(' %g' % self.ApB[ij, kq])
-                f.write('\n')
-            
-            f.write('# A-B\n')
-            nij = len(self.fullkss)
-            f.write('%d\n' % nij)
-            for ij in range(nij):
-                for kq in range(ij, nij):
-                    f.write(' %g' % self.AmB[ij, kq])
-                f.write('\n')
+            write_matrix(f, 'A+B', self.ApB, binary)
+            write_matrix(f, 'A-B', self.AmB, binary)
             
             if fh is None:
                 f.close()
@@ -86,6 +86,9 @@ class KSSingles(ExcitationList):
         if self.kpt_u[0].psit_nG is None:
             raise RuntimeError('No wave functions in calculator!')
 
+        # Gradients for the velocity form of the dipole matrix elements:
+        self.ddr_v = get_gradient_operators(wfs.gd, wfs.dtype)
+
         # here, we need to take care of the spins also for
         # closed shell systems (Sz=0)
         # vspin is the virtual spin of the wave functions,
@@ -112,15 +115,15 @@ class KSSingles(ExcitationList):
             for kpt in self.kpt_u:
                 f_n = kpt.f_n
                 eps_n = kpt.eps_n
+                ij_x = []
                 for i in range(len(f_n)):
                     for j in range(i+1, len(f_n)):
                         fij = f_n[i] - f_n[j]
                         epsij = eps_n[j] - eps_n[i]
                         if fij > eps and epsij >= emin and epsij < emax:
                             # this is an accepted transition
-                            ks = KSSingle(i, j, kpt.s, kpt, paw,
-                                          fijscale = fijscale)
-                            self.append(ks)
+                            ij_x.append((i, j))
+                self.append_singles(kpt, kpt.s, ij_x, fijscale)
         else:
             # select transitions according to band index
             for ispin in range(self.npspins):
@@ -131,19 +134,39 @@ class KSSingles(ExcitationList):
                 if jend == None: jend = len(f)-1
                 else         : jend = min(jend, len(f)-1)
 
+                ij_x = []
                 for i in range(istart, jend+1):
                     for j in range(istart, jend+1):
                         fij = f[i]-f[j]
                         if fij > eps:
                             # this is an accepted transition
-                            ks = KSSingle(i, j, ispin, 
-                                          self.kpt_u[vspin], paw,
-                                          fijscale=fijscale)
-                            self.append(ks)
+                            ij_x.append((i, j))
+                self.append_singles(self.kpt_u[vspin], ispin, ij_x, fijscale)
 
             self.istart = istart
             self.jend = jend
 
+    def append_singles(self, kpt, pspin, ij_x, fijscale):
+        """Append the transitions (i, j) in ij_x of the given k-point.
+
+        The augmentation and smooth velocity contributions to the dipole
+        matrix elements are calculated for all transitions at once."""
+        if len(ij_x) == 0:
+            return
+        paw = self.calculator
+        wfs = paw.wfs
+        i_x, j_x = np.array(ij_x).T
+        pos_av = paw.atoms.get_positions() / Bohr
+        ma_xv, mav_xv = get_augmentation_dipoles(wfs.setups, pos_av,
+                                                 kpt.P_ani, i_x, j_x)
+        wfs.gd.comm.sum(ma_xv)
+        wfs.gd.comm.sum(mav_xv)
+        mev_xv = get_smooth_velocity_dipoles(self.ddr_v, wfs.gd, kpt,
+                                             i_x, j_x)
+        for (i, j), ma_v, mav_v, mev_v in zip(ij_x, ma_xv, mav_xv, mev_xv):
+            self.append(KSSingle(i, j, pspin, kpt, paw, fijscale=fijscale,
+                                 augmentation=(ma_v, mav_v), velocity=mev_v))
+
     def read(self, filename=None, fh=None):
         """Read myself from a file"""
         if fh is None:
@@ -155,11 +178,14 @@ class KSSingles(ExcitationList):
         else:
             f = fh
 
-        f.readline()
-        n = int(f.readline())
-        for i in range(n):
-            kss = KSSingle(string = f.readline())
-            self.append(kss)
+        if f.readline().split()[-1] == 'npy':
+            for record in np.load(f):
+                self.append(KSSingle(record=record))
+        else:
+            n = int(f.readline())
+            for i in range(n):
+                kss = KSSingle(string = f.readline())
+                self.append(kss)
         self.update()
 
         if fh is None:
@@ -182,7 +208,7 @@ class KSSingles(ExcitationList):
         self.npspins = npspins
         self.nvspins = nvspins
 
-    def write(self, filename=None, fh=None):
+    def write(self, filename=None, fh=None, binary=False):
         """Write current state to a file.
 
         'filename' is the filename. If the filename ends in .gz,
@@ -190,6 +216,8 @@ class KSSingles(ExcitationList):
 
         'fh' is a filehandle. This can be used to write into already
         opened files.
+
+        'binary' writes the singles as a npy record array.
         """
         if mpi.rank == mpi.MASTER:
             if fh is None:
@@ -201,15 +229,92 @@ class KSSingles(ExcitationList):
             else:
                 f = fh
 
-            f.write('# KSSingles\n')
-            f.write('%d\n' % len(self))
-            for kss in self:
-                f.write(kss.outstring())
+            if binary:
+                f.write('# KSSingles npy\n')
+                np.save(f, np.array([kss.record() for kss in self],
+                                    KSSingle.dtype))
+            else:
+                f.write('# KSSingles\n')
+                f.write('%d\n' % len(self))
+                for kss in self:
+                    f.write(kss.outstring())
             
             if fh is None:
                 f.close()
 
  
+def get_dipole_tensors(setup):
+    """Unpacked L=0 and L=1 (x, y, z) parts of Delta_pL."""
+    ni = setup.ni
+    p_ii = np.array([[packed_index(i1, i2, ni) for i2 in range(ni)]
+                     for i1 in range(ni)])
+    Delta_iiL = setup.Delta_pL[p_ii]
+    r_iiL = np.zeros((ni, ni, 4))
+    r_iiL[:, :, 0] = Delta_iiL[:, :, 0]
+    if setup.lmax >= 1:
+        # see spherical_harmonics.py for
+        # L=1:y L=2:z; L=3:x
+        r_iiL[:, :, 1:] = Delta_iiL[:, :, [3, 1, 2]]
+    return r_iiL
+
+
+def get_augmentation_dipoles(setups, pos_av, P_ani, i_x, j_x):
+    """PAW corrections to <i|r|j> and <i|nabla|j>.
+
+    The corrections of the atoms in P_ani are calculated for all
+    transitions i_x[x] -> j_x[x] at once."""
+    nx = len(i_x)
+    ma_xv = np.zeros((nx, 3))
+    mav_xv = np.zeros((nx, 3))
+    r_siiL = {}
+    for a, P_ni in P_ani.items():
+        setup = setups[a]
+        if setup not in r_siiL:
+            r_siiL[setup] = get_dipole_tensors(setup)
+        r_iiL = r_siiL[setup]
+        Pi_xi = P_ni[i_x]
+        Pj_xi = P_ni[j_x]
+        ni = P_ni.shape[1]
+        PrP_xL = (np.dot(Pi_xi, r_iiL.reshape((ni, -1))).reshape(
+            (nx, ni, 4)) * Pj_xi[:, :, np.newaxis]).sum(axis=1)
+        ma_xv += (sqrt(4 * pi / 3) * PrP_xL[:, 1:] +
+                  sqrt(4 * pi) * PrP_xL[:, :1] * pos_av[a])
+        if setup.nabla_iiv is not None:
+            nabla_iiv = setup.nabla_iiv
+            mav_xv += (np.dot(Pi_xi, nabla_iiv.reshape((ni, -1))).reshape(
+                (nx, ni, 3)) * Pj_xi[:, :, np.newaxis]).sum(axis=1)
+    return ma_xv, mav_xv
+
+
+def get_gradient_operators(gd, dtype):
+    """Finite difference d/dx, d/dy and d/dz for wave functions."""
+    return [Gradient(gd, v, dtype=dtype).apply for v in range(3)]
+
+
+def get_smooth_velocity_dipoles(ddr_v, gd, kpt, i_x, j_x):
+    """Smooth part of <i|nabla|j>.
+
+    All transitions i_x[x] -> j_x[x] are done at once, so that the
+    gradient of every band j is calculated only once."""
+    psit_nG = kpt.psit_nG
+    dtype = psit_nG.dtype
+    if dtype == float:
+        phase_cd = None
+    else:
+        phase_cd = kpt.phase_cd
+    mev_xv = np.zeros((len(i_x), 3), dtype)
+    dpsit_vG = gd.empty(3, dtype)
+    for j in np.unique(j_x):
+        for v in range(3):
+            ddr_v[v](psit_nG[j], dpsit_vG[v], phase_cd)
+        for x in np.nonzero(j_x == j)[0]:
+            psit_G = psit_nG[i_x[x]]
+            for v in range(3):
+                mev_xv[x, v] = np.vdot(psit_G, dpsit_vG[v])
+    gd.comm.sum(mev_xv)
+    return mev_xv * gd.dv
+
+
 class KSSingle(Excitation, PairDensity):
     """Single Kohn-Sham transition containing all it's indicees
 
@@ -224,13 +329,22 @@ class KSSingle(Excitation, PairDensity):
       muv = - <i|nabla|a>/omega_ia with omega_ia>0
       m   = <i|[r x nabla]|a> / (2c)
     """
+    dtype = [('i', int), ('j', int), ('pspin', int), ('spin', int),
+             ('energy', float), ('fij', float),
+             ('mur', float, 3), ('muv', float, 3)]
+
     def __init__(self, iidx=None, jidx=None, pspin=None, kpt=None,
-                 paw=None, string=None, fijscale=1):
+                 paw=None, string=None, fijscale=1, record=None,
+                 augmentation=None, velocity=None):
         
         if string is not None: 
             self.fromstring(string)
             return None
 
+        if record is not None:
+            self.fromrecord(record)
+            return None
+
         # normal entry
         
         PairDensity.__init__(self, paw)
@@ -257,107 +371,34 @@ class KSSingle(Excitation, PairDensity):
         me = - gd.calculate_dipole_moment(self.get())
 
         # augmentation contributions
-        ma = np.zeros(me.shape)
-        pos_av = paw.atoms.get_positions() / Bohr
-        for a, P_ni in kpt.P_ani.items():
-            Ra = pos_av[a]
-            Pi_i = P_ni[self.i]
-            Pj_i = P_ni[self.j]
-            Delta_pL = wfs.setups[a].Delta_pL
-            ni=len(Pi_i)
-            ma0 = 0
-            ma1 = np.zeros(me.shape)
-            for i in range(ni):
-                for j in range(ni):
-                    pij = Pi_i[i]*Pj_i[j]
-                    ij = packed_index(i, j, ni)
-                    # L=0 term
-                    ma0 += Delta_pL[ij,0]*pij
-                    # L=1 terms
-                    if wfs.setups[a].lmax >= 1:
-                        # see spherical_harmonics.py for
-                        # L=1:y L=2:z; L=3:x
-                        ma1 += np.array([Delta_pL[ij,3], Delta_pL[ij,1],
-                                         Delta_pL[ij,2]]) * pij
-            ma += sqrt(4 * pi / 3) * ma1 + Ra * sqrt(4 * pi) * ma0
-        gd.comm.sum(ma)
-
-##        print '<KSSingle> i,j,me,ma,fac=',self.i,self.j,\
-##            me, ma,sqrt(self.energy*self.fij)
-#        print 'l: me, ma', me, ma
+        if augmentation is None:
+            pos_av = paw.atoms.get_positions() / Bohr
+            ma_xv, mav_xv = get_augmentation_dipoles(wfs.setups, pos_av,
+                                                     kpt.P_ani, [self.i],
+                                                     [self.j])
+            gd.comm.sum(ma_xv)
+            gd.comm.sum(mav_xv)
+            ma, mav = ma_xv[0], mav_xv[0]
+        else:
+            ma, mav = augmentation
+
         self.me = sqrt(self.energy * self.fij) * ( me + ma )
 
         self.mur = - ( me + ma )
-##        print '<KSSingle> mur=',self.mur,-self.fij *me
 
         # velocity form .............................
-        self.muv = np.zeros(me.shape)  # does not work XXX
-
-##         # smooth contribution
-##         dtype = self.wfj.dtype
-##         dwfdr_G = gd.empty(dtype=dtype)
-##         if not hasattr(gd, 'ddr'):
-##             gd.ddr = [Gradient(gd, c, dtype=dtype).apply for c in range(3)]
-##         for c in range(3):
-##             gd.ddr[c](self.wfj, dwfdr_G, kpt.phase_cd)
-##             me[c] = gd.integrate(self.wfi * dwfdr_G)
-
-##         # XXXX local corrections are missing here
-##         # augmentation contributions
-##         ma = np.zeros(me.shape)
-##         for a, P_ni in kpt.P_ani.items():
-##             setup = paw.wfs.setups[a]
-## #            print setup.Delta1_jj
-## #            print "l_j", setup.l_j, setup.n_j
-
-##             if not (hasattr(setup, 'j_i') and hasattr(setup, 'l_i')):
-##                 l_i = [] # map i -> l
-##                 j_i = [] # map i -> j
-##                 for j, l in enumerate(setup.l_j):
-##                     for m in range(2 * l + 1):
-##                         l_i.append(l)
-##                         j_i.append(j)
-                        
-##                 setup.l_i = l_i
-##                 setup.j_i = j_i
-
-##             Pi_i = P_ni[self.i]
-##             Pj_i = P_ni[self.j]
-##             ni = len(Pi_i)
-            
-##             ma1 = np.zeros(me.shape)
-##             for i1 in range(ni):
-##                 L1 = setup.l_i[i1]
-##                 j1 = setup.j_i[i1]
-##                 for i2 in range(ni):
-##                     L2 = setup.l_i[i2]
-##                     j2 = setup.j_i[i2]
- 
-##                     pi1i2 = Pi_i[i1] * Pj_i[i2]
-##                     p = packed_index(i1, i2, ni)
-                    
-##                     v1 = sqrt(4 * pi / 3) * np.array([G_LLL[L1, L2, 3],
-##                                                       G_LLL[L1, L2, 1],
-##                                                       G_LLL[L1, L2, 2]])
-##                     v2 = ylnyl[L1, L2, :]
-##                     ma1 += pi1i2 * (v1 * setup.Delta1_jj[j1, j2] +
-##                                     v2 * setup.Delta_pL[p, 0]      )
-##             ma += ma1
-## #        print 'v: me, ma=', me, ma
-
-##         # XXXX the weight fij is missing here
-##         self.muv = (me + ma) / self.energy
-## #        print '<KSSingle> muv=', self.muv
-
-##         # magnetic transition dipole ................
-        
-##         # m depends on how the origin is set, so we need the centre of mass
-##         # of the structure
-## #        cm = wfs
 
-## #        for i in range(3):
-## #            me[i] = gd.integrate(self.wfi*dwfdr_cg[i])
-        
+        # smooth contribution
+        if velocity is None:
+            ddr_v = get_gradient_operators(gd, wfs.dtype)
+            mev = get_smooth_velocity_dipoles(ddr_v, gd, kpt,
+                                              np.array([self.i]),
+                                              np.array([self.j]))[0]
+        else:
+            mev = velocity
+
+        self.muv = - ( mev + mav ) / self.energy
+
     def __add__(self, other):
         """Add two KSSingles"""
         result = self.copy()
@@ -407,6 +448,21 @@ class KSSingle(Excitation, PairDensity):
             self.muv = np.array([float(l.pop(0)) for i in range(3)])
         return None
 
+    def fromrecord(self, record):
+        self.i = int(record['i'])
+        self.j = int(record['j'])
+        self.pspin = int(record['pspin'])
+        self.spin = int(record['spin'])
+        self.energy = float(record['energy'])
+        self.fij = float(record['fij'])
+        self.mur = np.array(record['mur'])
+        self.me = - self.mur * sqrt(self.energy*self.fij)
+        self.muv = np.array(record['muv'])
+
+    def record(self):
+        return (self.i, self.j, self.pspin, self.spin, self.energy, self.fij,
+                self.mur, self.muv)
+
     def outstring(self):
         str = '%d %d   %d %d   %g %g' % \
                (self.i,self.j, self.pspin,self.spin, self.energy, self.fij)
@@ -1,4 +1,6 @@
+import os
 import sys
+from hashlib import md5
 from math import sqrt
 import numpy as np
 import gpaw.mpi as mpi
@@ -37,6 +39,13 @@ class OmegaMatrix:
       - txt: output stream or file name
       - finegrid: level of fine grid to use. 0: nothing, 1 for poisson only,
         2 everything on the fine grid
+      - memory: number of bytes to use for blocks of pair densities
+        and potentials in the RPA part
+      - direct: do not build the matrix, products with the matrix are
+        evaluated from the pair densities when diagonalizing (RPA only)
+      - restart: file for the rows of the matrix.  Rows are written
+        as soon as they are finished and rows found in the file are not
+        calculated again
     """
     def __init__(self,
                  calculator=None,
@@ -48,6 +57,9 @@ class OmegaMatrix:
                  txt=None,
                  finegrid=2,
                  eh_comm=None,
+                 memory=2**28,
+                 direct=False,
+                 restart=None,
                  ):
         
         if not txt and calculator:
@@ -58,6 +70,7 @@ class OmegaMatrix:
             eh_comm = mpi.serial_comm
 
         self.eh_comm = eh_comm
+        self.direct = direct
 
         if filehandle is not None:
             self.kss = kss
@@ -66,6 +79,9 @@ class OmegaMatrix:
 
         self.fullkss = kss
         self.finegrid = finegrid
+        self.memory = memory
+        self.restart = restart
+        self.rowfile = None
 
         if calculator is None:
             return
@@ -119,12 +135,27 @@ class OmegaMatrix:
              # this will be a singlet to singlet calculation only
              self.singletsinglet=True
 
+        if direct:
+            if self.xc is not None:
+                raise NotImplementedError('direct is only available for RPA')
+            return
+
         nij = len(kss)
         self.Om = np.zeros((nij,nij))
         self.get_full()
 
     def get_full(self):
 
+        if self.restart is not None:
+            if self.xc is None:
+                xcname = 'RPA'
+            else:
+                xcname = self.xc.get_name()
+            self.rowfile = RowFile(self.restart, self.fullkss, xcname)
+            for ij in range(self.eh_comm.rank, len(self.fullkss),
+                            self.eh_comm.size):
+                self.rowfile.read_row(ij, self.Om)
+
         self.paw.timer.start('Omega RPA')
         self.get_rpa()
         self.paw.timer.stop()
@@ -137,6 +168,21 @@ class OmegaMatrix:
         self.eh_comm.sum(self.Om)
         self.full = self.Om
 
+    def get_rows(self, stage):
+        """My rows that still have to be calculated.
+
+        stage is 0 for the RPA part and 1 for the xc part."""
+        rows = range(self.eh_comm.rank, len(self.fullkss), self.eh_comm.size)
+        if self.rowfile is None:
+            return rows
+        return [ij for ij in rows if not self.rowfile.done(stage, ij)]
+
+    def store_rows(self, stage, rows):
+        """Write finished rows to the restart file."""
+        if self.rowfile is not None and self.gd.comm.rank == 0:
+            for ij in rows:
+                self.rowfile.write_row(stage, ij, self.Om)
+
     def get_xc(self):
         """Add xc part of the coupling matrix"""
 
@@ -208,7 +254,7 @@ class OmegaMatrix:
         ns=self.numscale
         xc=self.xc
         print >> self.txt, 'XC',nij,'transitions'
-        for ij in range(eh_comm.rank, nij, eh_comm.size):
+        for ij in self.get_rows(1):
             print >> self.txt,'XC kss['+'%d'%ij+']' 
 
             timer = Timer()
@@ -357,6 +403,7 @@ class OmegaMatrix:
                 if ij != kq:
                     Om_xc[kq,ij] = Om_xc[ij,kq]
                 
+            self.store_rows(1, [ij])
             timer.stop()
 ##            timer2.write()
             if ij < (nij-1):
@@ -367,7 +414,13 @@ class OmegaMatrix:
 
 
     def get_rpa(self):
-        """calculate RPA part of the omega matrix"""
+        """calculate RPA part of the omega matrix
+
+        Pair densities and their potentials are calculated for blocks of
+        transitions that fit into self.memory bytes.  The smooth part of
+        a block of the matrix is then a single matrix product and the
+        atomic part is obtained from the packed pair density matrices
+        of all transitions at once."""
 
         # shorthands
         kss=self.fullkss
@@ -380,89 +433,110 @@ class OmegaMatrix:
         print >> self.txt,'RPA',nij,'transitions'
         
         Om = self.Om
-        
-        for ij in range(eh_comm.rank, nij, eh_comm.size):
-            print >> self.txt,'RPA kss['+'%d'%ij+']=', kss[ij]
 
-            timer = Timer()
-            timer.start('init')
-            timer2 = Timer()
-                      
-            # smooth density including compensation charges
-            timer2.start('with_compensation_charges 0')
-            rhot_p = kss[ij].with_compensation_charges(
-                finegrid is not 0)
-            timer2.stop()
-            
-            # integrate with 1/|r_1-r_2|
-            timer2.start('poisson')
-            phit_p = np.zeros(rhot_p.shape, rhot_p.dtype.char)
-            self.poisson.solve(phit_p, rhot_p, charge=None)
-            timer2.stop()
-
-            timer.stop()
-            t0 = timer.get_time('init')
-            timer.start(ij)
-
-            if finegrid == 1:
-                rhot = kss[ij].with_compensation_charges()
-                phit = self.gd.zeros()
-##                print "shapes 0=",phit.shape,rhot.shape
-                self.restrict(phit_p,phit)
-            else:
-                phit = phit_p
-                rhot = rhot_p
-
-            for kq in range(ij,nij):
-                if kq != ij:
-                    # smooth density including compensation charges
-                    timer2.start('kq with_compensation_charges')
-                    rhot = kss[kq].with_compensation_charges(
-                        finegrid is 2)
-                    timer2.stop()
-
-                timer2.start('integrate')
-                pre = 2.*sqrt(kss[ij].get_energy()*kss[kq].get_energy()*
-                                  kss[ij].get_weight()*kss[kq].get_weight())
-                Om[ij,kq]= pre * self.gd.integrate(rhot*phit)
-##                print "int=",Om[ij,kq]
-                timer2.stop()
+        # my rows of the matrix
+        myij_x = np.array(self.get_rows(0), int)
+        if len(myij_x) == 0:
+            return
 
-                # Add atomic corrections
-                timer2.start('integrate corrections 2')
-                Ia = 0.
-                for a, P_ni in wfs.kpt_u[kss[ij].spin].P_ani.items():
-                    Pi_i = P_ni[kss[ij].i]
-                    Pj_i = P_ni[kss[ij].j]
-                    Dij_ii = np.outer(Pi_i, Pj_i)
-                    Dij_p = pack(Dij_ii)
-                    Pkq_ni = wfs.kpt_u[kss[kq].spin].P_ani[a]
-                    Pk_i = Pkq_ni[kss[kq].i]
-                    Pq_i = Pkq_ni[kss[kq].j]
-                    Dkq_ii = np.outer(Pk_i, Pq_i)
-                    Dkq_p = pack(Dkq_ii)
-                    C_pp = wfs.setups[a].M_pp
-                    #   ----
-                    # 2 >      P   P  C    P  P
-                    #   ----    ip  jr prst ks qt
-                    #   prst
-                    Ia += 2.0*np.dot(Dkq_p,np.dot(C_pp,Dij_p))
-                timer2.stop()
-                
-                Om[ij,kq] += pre * self.gd.comm.sum(Ia)
-                    
-                if ij == kq:
-                    Om[ij,kq] += kss[ij].get_energy()**2
+        # prefactors 2 sqrt(e_ij e_kq f_ij f_kq)
+        s_x = np.array([sqrt(2. * ks.get_energy() * ks.get_weight())
+                        for ks in kss])
+
+        # atomic corrections
+        #   ----
+        # 2 >      P   P  C    P  P
+        #   ----    ip  jr prst ks qt
+        #   prst
+        timer = Timer()
+        timer.start('atomic corrections')
+        I_xx = np.zeros((len(myij_x), nij))
+        D_axp = self.get_pair_density_matrices()
+        for a, D_xp in D_axp.items():
+            C_pp = wfs.setups[a].M_pp
+            I_xx += 2.0 * np.dot(D_xp[myij_x], np.dot(C_pp, D_xp.T))
+        self.gd.comm.sum(I_xx)
+        timer.stop()
+
+        # number of transitions per block
+        nbytes = self.gd.zeros().nbytes
+        nb = max(1, min(len(myij_x), self.memory // (2 * nbytes)))
+        
+        for b0 in range(0, len(myij_x), nb):
+            ij_b = myij_x[b0:b0 + nb]
+            timer.start(b0)
+            
+            # potentials of this block of transitions
+            phit_bg = np.empty((len(ij_b),) + tuple(self.gd.n_c))
+            for phit, ij in zip(phit_bg, ij_b):
+                print >> self.txt,'RPA kss['+'%d'%ij+']=', kss[ij]
+                # smooth density including compensation charges
+                rhot_p = kss[ij].with_compensation_charges(
+                    finegrid is not 0)
+                # integrate with 1/|r_1-r_2|
+                phit_p = np.zeros(rhot_p.shape, rhot_p.dtype.char)
+                self.poisson.solve(phit_p, rhot_p, charge=None)
+                if finegrid == 1:
+                    self.restrict(phit_p, phit)
                 else:
-                    Om[kq,ij]=Om[ij,kq]
-
+                    phit[:] = phit_p
+            phit_bg.shape = (len(ij_b), -1)
+
+            # smooth part for all columns kq >= ij
+            for c0 in range(ij_b[0], nij, nb):
+                kq_c = np.arange(c0, min(c0 + nb, nij))
+                rhot_cg = np.empty((len(kq_c),) + tuple(self.gd.n_c))
+                for rhot, kq in zip(rhot_cg, kq_c):
+                    rhot[:] = kss[kq].with_compensation_charges(
+                        finegrid is 2)
+                rhot_cg.shape = (len(kq_c), -1)
+                K_bc = np.dot(phit_bg, rhot_cg.T) * self.gd.dv
+                self.gd.comm.sum(K_bc)
+
+                for K_c, x, ij in zip(K_bc, range(b0, b0 + nb), ij_b):
+                    for K, kq in zip(K_c, kq_c):
+                        if kq < ij:
+                            continue
+                        Om[ij, kq] = s_x[ij] * s_x[kq] * (K + I_xx[x, kq])
+                        if ij == kq:
+                            Om[ij, kq] += kss[ij].get_energy()**2
+                        else:
+                            Om[kq, ij] = Om[ij, kq]
+
+            self.store_rows(0, ij_b)
             timer.stop()
-##            timer2.write()
-            if ij < (nij-1):
-                t = timer.get_time(ij) # time for nij-ij calculations
-                t = .5*t*(nij-ij)  # estimated time for n*(n+1)/2, n=nij-(ij+1)
+            b1 = b0 + len(ij_b)
+            if b1 < len(myij_x):
+                # time for the rows of this block, the remaining rows are
+                # shorter on average
+                t = timer.get_time(b0) * (len(myij_x) - b1) / len(ij_b)
+                t *= (nij - myij_x[b1]) / float(nij - ij_b[0])
                 print >> self.txt,'RPA estimated time left',\
-                      self.timestring(t0*(nij-ij-1)+t)
+                      self.timestring(t)
+
+    def get_pair_density_matrices(self, kss=None):
+        """Packed pair density matrices D_xp of all transitions.
+
+        Returns a dictionary with an array D_xp for each of the atoms
+        of this domain."""
+        if kss is None:
+            kss = self.fullkss
+        wfs = self.paw.wfs
+        s_x = np.array([ks.spin for ks in kss])
+        i_x = np.array([ks.i for ks in kss])
+        j_x = np.array([ks.j for ks in kss])
+        D_axp = {}
+        for a in wfs.kpt_u[0].P_ani:
+            P_sni = np.array([kpt.P_ani[a] for kpt in wfs.kpt_u])
+            Pi_xi = P_sni[s_x, i_x]
+            Pj_xi = P_sni[s_x, j_x]
+            # same ordering as in pack()
+            i1_p, i2_p = np.triu_indices(Pi_xi.shape[1])
+            D_xp = (Pi_xi[:, i1_p] * Pj_xi[:, i2_p] +
+                    Pi_xi[:, i2_p] * Pj_xi[:, i1_p])
+            D_xp[:, i1_p == i2_p] *= 0.5
+            D_axp[a] = D_xp
+        return D_axp
 
     def singlets_triplets(self):
         """Split yourself into singlet and triplet transitions"""
@@ -560,23 +634,90 @@ class OmegaMatrix:
             
         return map, kss
 
-    def diagonalize(self, istart=None, jend=None, energy_range=None):
-        """Evaluate Eigenvectors and Eigenvalues:"""
+    def diagonalize(self, istart=None, jend=None, energy_range=None,
+                    nexcitations=None):
+        """Evaluate Eigenvectors and Eigenvalues:
+
+        If nexcitations is given, only the lowest nexcitations
+        eigenvalues and eigenvectors are determined iteratively."""
 
         map, kss = self.get_map(istart, jend, energy_range)
-        nij = len(kss)
-        if map is None:
-            evec = self.full.copy()
+        self.kss = kss
+
+        if self.direct:
+            if nexcitations is None:
+                raise RuntimeError('direct needs nexcitations')
+            D_axp = self.get_pair_density_matrices(kss)
+            def apply(u_nx):
+                return self.apply_direct(kss, D_axp, u_nx)
         else:
-            evec = np.zeros((nij,nij))
-            for ij in range(nij):
-                for kq in range(nij):
-                    evec[ij,kq] = self.full[map[ij],map[kq]]
+            if map is None:
+                Om = self.full
+            else:
+                Om = self.full[np.ix_(map, map)]
+            if nexcitations is None:
+                self.eigenvectors = Om.copy()
+                self.eigenvalues = np.zeros((len(kss)))
+                diagonalize(self.eigenvectors, self.eigenvalues)
+                return
+            def apply(u_nx):
+                return np.dot(u_nx, Om)
+
+        e_x = np.array([ks.get_energy() for ks in kss])
+        self.eigenvalues, self.eigenvectors = davidson(apply, e_x**2,
+                                                       nexcitations,
+                                                       txt=self.txt)
+
+    def apply_direct(self, kss, D_axp, u_nx):
+        """Multiply the rows of u_nx with the RPA Omega matrix.
+
+        The pair densities weighted by u are added up and the Poisson
+        equation is solved once for each row instead of once for each
+        transition."""
+        finegrid = self.finegrid
+        eh_comm = self.eh_comm
+        nij = len(kss)
+        myx_x = np.arange(eh_comm.rank, nij, eh_comm.size)
+
+        e_x = np.array([ks.get_energy() for ks in kss])
+        s_x = np.array([sqrt(2. * ks.get_energy() * ks.get_weight())
+                        for ks in kss])
+        w_nx = u_nx * s_x
+        n = len(u_nx)
+
+        # potentials of the weighted pair densities
+        rhot_ng = self.poisson.gd.zeros(n)
+        for x in myx_x:
+            rhot_p = kss[x].with_compensation_charges(finegrid is not 0)
+            for rhot_g, w_n in zip(rhot_ng, w_nx[:, x]):
+                rhot_g += w_n * rhot_p
+        eh_comm.sum(rhot_ng)
+        phit_ng = self.gd.zeros(n)
+        for phit, rhot_p in zip(phit_ng, rhot_ng):
+            phit_p = np.zeros(rhot_p.shape)
+            self.poisson.solve(phit_p, rhot_p, charge=None)
+            if finegrid == 1:
+                self.restrict(phit_p, phit)
+            else:
+                phit[:] = phit_p
+        phit_ng.shape = (n, -1)
 
-        self.eigenvectors = evec        
-        self.eigenvalues = np.zeros((len(kss)))
-        self.kss = kss
-        diagonalize(self.eigenvectors, self.eigenvalues)
+        # smooth part
+        K_nx = np.zeros((n, nij))
+        for x in myx_x:
+            rhot = kss[x].with_compensation_charges(finegrid is 2)
+            K_nx[:, x] = np.dot(phit_ng, rhot.ravel()) * self.gd.dv
+
+        # atomic corrections
+        wfs = self.paw.wfs
+        for a, D_xp in D_axp.items():
+            C_pp = wfs.setups[a].M_pp
+            K_nx[:, myx_x] += 2.0 * np.dot(np.dot(w_nx, D_xp),
+                                           np.dot(C_pp, D_xp[myx_x].T))
+        self.gd.comm.sum(K_nx)
+        eh_comm.sum(K_nx)
+
+        return u_nx * e_x**2 + K_nx * s_x
 
     def Kss(self, kss=None):
         """Set and get own Kohn-Sham singles"""
@@ -594,34 +735,27 @@ class OmegaMatrix:
         else:
             f = fh
 
-        f.readline()
-        nij = int(f.readline())
-        full = np.zeros((nij,nij))
-        for ij in range(nij):
-            l = f.readline().split()
-            for kq in range(ij,nij):
-                full[ij,kq] = float(l[kq-ij])
-                full[kq,ij] = full[ij,kq]
-        self.full = full
+        self.full = read_matrix(f)
 
         if fh is None:
             f.close()
 
-    def write(self, filename=None, fh=None):
-        """Write current state to a file."""
+    def write(self, filename=None, fh=None, binary=False):
+        """Write current state to a file.
+
+        The matrix is written in npy format if binary is True."""
         if mpi.rank == mpi.MASTER:
             if fh is None:
                 f = open(filename, 'w')
             else:
                 f = fh
 
-            f.write('# OmegaMatrix\n')
-            nij = len(self.fullkss)
-            f.write('%d\n' % nij)
-            for ij in range(nij):
-                for kq in range(ij,nij):
-                    f.write(' %g' % self.full[ij,kq])
-                f.write('\n')
+            if self.direct:
+                # there is no matrix to write
+                full = np.zeros((0, 0))
+            else:
+                full = self.full
+            write_matrix(f, 'OmegaMatrix', full, binary)
             
             if fh is None:
                 f.close()
@@ -640,6 +774,165 @@ class OmegaMatrix:
             for ev in self.eigenvalues:
                 str += ' ' + ('%f'%(sqrt(ev) * Hartree))
         return str
-    
 
 
+def davidson(apply, d_x, n, tolerance=1e-6, maxiter=100, txt=None):
+    """Lowest n eigenvalues and eigenvectors of a symmetric matrix.
+
+    apply(u_nx) has to return the products of the matrix with the rows
+    of u_nx and d_x is an approximation to the diagonal of the matrix,
+    that is used for the start vectors and for preconditioning.
+    Returns the eigenvalues and the eigenvectors as rows."""
+
+    nx = len(d_x)
+    n = min(n, nx)
+    mmax = min(nx, max(4 * n, 20))
+
+    V_m = []
+    AV_m = []
+    t_nx = np.zeros((n, nx))
+    t_nx[np.arange(n), np.argsort(d_x)[:n]] = 1.0
+    for iter in range(maxiter):
+        # add orthonormalized new directions to the subspace
+        m = len(V_m)
+        for t_x in t_nx:
+            norm = sqrt(np.dot(t_x, t_x))
+            for i in range(2):
+                for v_x in V_m:
+                    t_x -= np.dot(v_x, t_x) * v_x
+            tnorm = sqrt(np.dot(t_x, t_x))
+            if tnorm > 1e-8 * norm:
+                V_m.append(t_x / tnorm)
+        if len(V_m) == m:
+            break
+        AV_m.extend(apply(np.array(V_m[m:])))
+        V_mx = np.array(V_m)
+        AV_mx = np.array(AV_m)
+
+        # Rayleigh-Ritz
+        H_mm = np.dot(V_mx, AV_mx.T)
+        eps_m, y_mm = np.linalg.eigh(0.5 * (H_mm + H_mm.T))
+        eps_n = eps_m[:n]
+        y_mn = y_mm[:, :n]
+        X_nx = np.dot(y_mn.T, V_mx)
+        AX_nx = np.dot(y_mn.T, AV_mx)
+        R_nx = AX_nx - eps_n[:, np.newaxis] * X_nx
+        error_n = np.sqrt((R_nx**2).sum(1))
+        if txt is not None:
+            print >> txt, 'Davidson iteration %d: subspace %d, error %g' % (
+                iter, len(V_m), error_n.max())
+        if error_n.max() < tolerance:
+            break
+
+        # restart with the current approximations
+        if len(V_m) + n > mmax:
+            V_m = list(X_nx)
+            AV_m = list(AX_nx)
+
+        # preconditioned residuals of the unconverged vectors
+        c_n = error_n >= tolerance
+        denom_nx = eps_n[c_n, np.newaxis] - d_x
+        denom_nx[abs(denom_nx) < 1e-4] = 1e-4
+        t_nx = R_nx[c_n] / denom_nx
+    else:
+        if txt is not None:
+            print >> txt, 'Davidson not converged: error %g' % error_n.max()
+
+    return eps_n, X_nx
+
+
+def write_matrix(f, name, M, binary=False):
+    """Write the upper triangle of a symmetric matrix to a file.
+
+    The matrix is written as text or, if binary is True, in npy
+    format."""
+    if binary:
+        f.write('# %s npy\n' % name)
+        np.save(f, M)
+        return
+    f.write('# %s\n' % name)
+    nij = len(M)
+    f.write('%d\n' % nij)
+    for ij in range(nij):
+        for kq in range(ij,nij):
+            f.write(' %g' % M[ij,kq])
+        f.write('\n')
+
+
+def read_matrix(f):
+    """Read a symmetric matrix written by write_matrix()."""
+    if f.readline().split()[-1] == 'npy':
+        return np.load(f)
+    nij = int(f.readline())
+    M = np.zeros((nij,nij))
+    for ij in range(nij):
+        l = f.readline().split()
+        for kq in range(ij,nij):
+            M[ij,kq] = float(l[kq-ij])
+            M[kq,ij] = M[ij,kq]
+    return M
+
+
+class RowFile:
+    """Rows of the Omega matrix in a file.
+
+    The file holds the upper triangles of the matrix after the RPA
+    (stage 0) and after the xc part (stage 1).  Missing rows are NaN.
+    A row is written before its diagonal element, so that a row with a
+    finite diagonal element is complete.
+
+    The npy data is preceded by a header line with the name of the xc
+    functional and a checksum of the Kohn-Sham singles.  Files written
+    for another functional or other singles are refused."""
+
+    def __init__(self, filename, kss, xcname):
+        self.filename = filename
+        self.nij = nij = len(kss)
+        shape = (2, nij, nij)
+        header = '# Omega rows xc=%s kss=%s\n' % (xcname, checksum(kss))
+        if not os.path.isfile(filename):
+            if mpi.world.rank == MASTER:
+                f = open(filename, 'wb')
+                f.write(header)
+                np.save(f, np.zeros(shape) + np.nan)
+                f.close()
+            mpi.world.barrier()
+
+        f = open(filename, 'rb')
+        if f.readline() != header:
+            raise RuntimeError('%s: written for another xc functional or '
+                               'other Kohn-Sham singles' % filename)
+        np.lib.format.read_magic(f)
+        if np.lib.format.read_array_header_1_0(f)[0] != shape:
+            raise RuntimeError('%s: wrong shape' % filename)
+        self.offset = f.tell()
+        f.close()
+        self.M_snn = np.memmap(filename, float, 'r', self.offset, shape)
+
+    def done(self, stage, ij):
+        return np.isfinite(self.M_snn[stage, ij, ij])
+
+    def read_row(self, ij, Om):
+        """Copy row ij of the latest stage found in the file to Om."""
+        for stage in [1, 0]:
+            if self.done(stage, ij):
+                Om[ij, ij:] = self.M_snn[stage, ij, ij:]
+                Om[ij + 1:, ij] = Om[ij, ij + 1:]
+                return
+
+    def write_row(self, stage, ij, Om):
+        f = open(self.filename, 'r+b')
+        pos = self.offset + 8 * ((stage * self.nij + ij) * self.nij + ij)
+        f.seek(pos + 8)
+        f.write(np.ascontiguousarray(Om[ij, ij + 1:]).tostring())
+        f.flush()
+        f.seek(pos)
+        f.write(Om[ij, ij:ij + 1].tostring())
+        f.close()
+
+
+def checksum(kss):
+    """Checksum of the transitions and energies of Kohn-Sham singles."""
+    data = np.array([(ks.i, ks.j, ks.pspin, ks.spin, round(ks.energy, 8))
+                     for ks in kss])
+    return md5(data.tostring()).hexdigest()
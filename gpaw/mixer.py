@@ -7,7 +7,7 @@ See Kresse, Phys. Rev. B 54, 11169 (1996)
 
 import numpy as np
 
-from gpaw.utilities.blas import axpy
+from gpaw.utilities.blas import axpy, gemv
 from gpaw.fd_operators import FDOperator
 
 
@@ -35,6 +35,7 @@ class BaseMixer:
         self.weight = weight
 
         self.dNt = None
+        self.nt_xiG = None
 
         self.mix_rho = False
 
@@ -79,14 +80,23 @@ class BaseMixer:
         my_nuclei:   All nuclei in local domain.
         """
         
-        # History for Pulay mixing of densities:
-        self.nt_iG = [] # Pseudo-electron densities
-        self.R_iG = []  # Residuals
-        self.A_ii = np.zeros((0, 0))
+        # History for Pulay mixing of densities is kept in ring buffers
+        # allocated by the first call to mix().  Slot i % nmaxold holds
+        # input density number i and the residual calculated from it.
+        self.step = 0  # Number of input densities since reset
         self.dNt = None
-        
-        self.D_iap = []
-        self.dD_iap = []
+
+    def allocate(self, nt_G, D_ap):
+        """Allocate history buffers unless shapes are unchanged."""
+        shape = (2, self.nmaxold) + nt_G.shape
+        size = sum([D_x.size for D_x in D_ap])
+        if (self.nt_xiG is None or
+            self.nt_xiG.shape != shape or self.D_xip.shape[2] != size):
+            # Input densities and residuals:
+            self.nt_xiG = np.zeros(shape)
+            # All atomic density matrices and their residuals:
+            self.D_xip = np.zeros((2, self.nmaxold, size))
+            self.A_ii = np.zeros((self.nmaxold, self.nmaxold))
 
     def get_charge_sloshing(self):
         """Return number of electrons moving around.
@@ -100,81 +110,71 @@ class BaseMixer:
         self.dNt = dNt
         
     def mix(self, nt_G, D_ap):
-        iold = len(self.nt_iG)
-        if iold > 0:
-            if iold > self.nmaxold:
-                # Throw away too old stuff:
-                del self.nt_iG[0]
-                del self.R_iG[0]
-                del self.D_iap[0]
-                del self.dD_iap[0]
-                # for D_p, D_ip, dD_ip in self.D_a:
-                #     del D_ip[0]
-                #     del dD_ip[0]
-                iold = self.nmaxold
+        nmaxold = self.nmaxold
+        if self.step == 0:
+            self.allocate(nt_G, D_ap)
+        nt_iG, R_iG = self.nt_xiG
+        D_ip, dD_ip = self.D_xip
+        if self.step > 0:
+            # Slot of the previous input density:
+            i = (self.step - 1) % nmaxold
 
             # Calculate new residual (difference between input and
             # output density):
-            R_G = nt_G - self.nt_iG[-1]
+            R_G = R_iG[i]
+            np.subtract(nt_G, nt_iG[i], R_G)
             self.dNt = self.gd.integrate(np.fabs(R_G))
-            self.R_iG.append(R_G)
-            self.dD_iap.append([])
-            for D_p, D_ip in zip(D_ap, self.D_iap[-1]):
-                self.dD_iap[-1].append(D_p - D_ip)
-
-            # Update matrix:
-            A_ii = np.zeros((iold, iold))
-            i1 = 0
-            i2 = iold - 1
-            
+            pack_density_matrices(D_ap, dD_ip[i])
+            dD_ip[i] -= D_ip[i]
+
+            # Update matrix (one new row and column):
             if self.metric is None:
                 mR_G = R_G
             else:
                 mR_G = self.mR_G
                 self.metric(R_G, mR_G)
-                
-            for R_1G in self.R_iG:
-                a = self.gd.comm.sum(np.vdot(R_1G, mR_G))
-                A_ii[i1, i2] = a
-                A_ii[i2, i1] = a
-                i1 += 1
-            A_ii[:i2, :i2] = self.A_ii[-i2:, -i2:]
-            self.A_ii = A_ii
+
+            a_i = np.dot(R_iG.reshape((nmaxold, -1)), mR_G.ravel())
+            self.gd.comm.sum(a_i)
+            self.A_ii[i] = a_i
+            self.A_ii[:, i] = a_i
+
+            # Slots in use, oldest first:
+            iold = min(self.step, nmaxold)
+            i_m = np.arange(self.step - iold, self.step) % nmaxold
+            A_mm = self.A_ii[i_m][:, i_m]
 
             try:
-                B_ii = np.linalg.inv(A_ii)
+                alpha_m = np.linalg.lstsq(A_mm, np.ones(iold))[0]
             except np.linalg.LinAlgError:
-                alpha_i = np.zeros(iold)
-                alpha_i[-1] = 1.0
+                alpha_m = np.zeros(iold)
+                alpha_m[-1] = 1.0
             else:
-                alpha_i = B_ii.sum(1)
-                try:
-                    # Normalize:
-                    alpha_i /= alpha_i.sum()
-                except ZeroDivisionError:
-                    alpha_i[:] = 0.0
-                    alpha_i[-1] = 1.0
-            
-            # Calculate new input density:
-            nt_G[:] = 0.0
-            #for D_p, D_ip, dD_ip in self.D_a:
-            for D in D_ap:
-                D[:] = 0.0
-            beta = self.beta
-            for i, alpha in enumerate(alpha_i):
-                axpy(alpha, self.nt_iG[i], nt_G)
-                axpy(alpha * beta, self.R_iG[i], nt_G)
-                for D_p, D_ip, dD_ip in zip(D_ap, self.D_iap[i],
-                                            self.dD_iap[i]):
-                    axpy(alpha, D_ip, D_p)
-                    axpy(alpha * beta, dD_ip, D_p)
-
+                # Normalize:
+                norm = alpha_m.sum()
+                if norm == 0.0 or not np.isfinite(norm):
+                    alpha_m[:] = 0.0
+                    alpha_m[-1] = 1.0
+                else:
+                    alpha_m /= norm
+
+            # Calculate new input density as one linear combination of
+            # old densities and residuals:
+            c_xi = np.zeros((2, nmaxold))
+            c_xi[0, i_m] = alpha_m
+            c_xi[1, i_m] = self.beta * alpha_m
+            c_x = c_xi.ravel()
+            gemv(1.0, self.nt_xiG.reshape((2 * nmaxold,) + nt_G.shape), c_x,
+                 0.0, nt_G, 'n')
+            D_xp = self.D_xip.reshape((2 * nmaxold, D_ip.shape[1]))
+            D_p = np.dot(c_x, D_xp)
+            unpack_density_matrices(D_p, D_ap)
 
         # Store new input density (and new atomic density matrices):
-        self.nt_iG.append(nt_G.copy())
-        self.D_iap.append([])
-        for D_p in D_ap:
-            self.D_iap[-1].append(D_p.copy())
+        i = self.step % nmaxold
+        nt_iG[i] = nt_G
+        pack_density_matrices(D_ap, D_ip[i])
+        self.step += 1
 
     def estimate_memory(self, mem, gd):
         gridbytes = gd.bytecount()
@@ -187,6 +187,24 @@ class BaseMixer:
         return string
 
 
+def pack_density_matrices(D_ap, D_p):
+    """Copy atomic density matrices into one contiguous array."""
+    p1 = 0
+    for D_x in D_ap:
+        p2 = p1 + D_x.size
+        D_p[p1:p2] = D_x.ravel()
+        p1 = p2
+
+
+def unpack_density_matrices(D_p, D_ap):
+    """Copy contiguous array back into atomic density matrices."""
+    p1 = 0
+    for D_x in D_ap:
+        p2 = p1 + D_x.size
+        D_x[:] = D_p[p1:p2].reshape(D_x.shape)
+        p1 = p2
+
+
 class DummyMixer(BaseMixer):
     """Dummy mixer for TDDFT, i.e., it does not mix."""
     def mix(self, nt_G):
@@ -346,6 +346,10 @@ class PAWTextOutput:
               self.hamiltonian.npoisson)
             t('Fermi Level Found  in %d Iterations' % self.occupations.niter)
             t('Error in Wave Functions: %.13f' % eigerr)              
+            eigensolver = self.wfs.eigensolver
+            if getattr(eigensolver, 'freeze', None) is not None:
+                t('Skipped Band Updates: %d of %d' %
+                  (eigensolver.nskipped, eigensolver.nupdates))
             t()
             self.print_all_information()
 
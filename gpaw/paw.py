@@ -15,6 +15,7 @@ import gpaw.io
 import gpaw.mpi as mpi
 import gpaw.occupations as occupations
 from gpaw import dry_run, memory_estimate_depth, KohnShamConvergenceError
+from gpaw import extra_parameters
 from gpaw.hooks import hooks
 from gpaw.density import Density
 from gpaw.eigensolvers import get_eigensolver
@@ -90,7 +91,8 @@ class PAW(PAWTextOutput):
 
         if filename is not None:
             comm = kwargs.get('communicator', mpi.world)
-            reader = gpaw.io.open(filename, 'r', comm)
+            parallel = extra_parameters.get('parallel_io', False)
+            reader = gpaw.io.open(filename, 'r', comm, parallel=parallel)
             self.atoms = gpaw.io.read_atoms(reader)
             par = self.input_parameters
             par.read(reader)
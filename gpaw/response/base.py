@@ -1,5 +1,6 @@
 import sys
 from time import time, ctime
+from collections import OrderedDict
 import numpy as np
 from math import sqrt, pi
 from ase.units import Hartree, Bohr
@@ -18,6 +19,34 @@ from gpaw.response.kernel import calculate_Kxc
 from gpaw.grid_descriptor import GridDescriptor
 from gpaw.utilities.memory import maxrss
 
+class WaveFunctionCache:
+    """Least recently used cache of wave functions.
+
+    The least recently used items are dropped when the total size
+    exceeds nbytes."""
+
+    def __init__(self, nbytes):
+        self.nbytes = nbytes
+        self.size = 0
+        self.items = OrderedDict()
+
+    def get(self, key):
+        item = self.items.pop(key, None)
+        if item is not None:
+            # Move to the end (most recently used)
+            self.items[key] = item
+            return item[0]
+
+    def add(self, key, value, nbytes):
+        if nbytes > self.nbytes:
+            return
+        self.items[key] = (value, nbytes)
+        self.size += nbytes
+        while self.size > self.nbytes:
+            key, (value, nbytes) = self.items.popitem(last=False)
+            self.size -= nbytes
+
+
 class BASECHI:
     """This class is to store the basic common stuff for chi and bse."""
 
@@ -30,7 +59,8 @@ class BASECHI:
                  eta=0.2,
                  ftol=1e-5,
                  txt=None,
-                 optical_limit=False):
+                 optical_limit=False,
+                 wfcache=100):
 
         self.xc = 'LDA'
 
@@ -64,6 +94,7 @@ class BASECHI:
             assert len(ecut) == 3
             self.ecut = np.array(ecut, dtype=float)
         self.optical_limit = optical_limit
+        self.wfcache = WaveFunctionCache(wfcache * 1024**2)
 
 
     def initialize(self):
@@ -129,6 +160,11 @@ class BASECHI:
 
         # Plane wave init
         self.npw, self.Gvec_Gc, self.Gindex_G = set_Gvectors(self.acell_cv, self.bcell_cv, self.nG, self.ecut)
+        # Flat indices of the planewaves in the FFT grid, so that the
+        # planewave components can be picked with a single take():
+        self.Q_G = np.array([np.dot(self.Gindex_G[iG],
+                                    [self.nG[1] * self.nG[2], self.nG[2], 1])
+                             for iG in range(self.npw)], dtype=int)
 
         # Projectors init
         setups = calc.wfs.setups
@@ -275,6 +311,40 @@ class BASECHI:
             return psit_G
 
 
+    def get_transformed_wavefunction(self, k, n, spin=0, check_focc=True):
+        """Return wave function and projections of band n at k-point k.
+
+        k is an index into the full BZ.  The wave function is rotated
+        from the IBZ by symmetry, and the result is kept in the cache
+        so that the transformation is done only once for all pairs.
+
+        When the ground state calculation is parallel, fetching a wave
+        function is a collective operation.  All ranks must then call
+        this method in step: if any rank misses its cache, all ranks
+        fetch.  Ranks with check_focc=False only take part in the fetch
+        and get None back."""
+
+        key = (k, n, spin)
+        item = None
+        if check_focc:
+            item = self.wfcache.get(key)
+        fetch = check_focc and item is None
+        if self.calc.wfs.world.size > 1:
+            fetch = world.sum(int(fetch)) > 0
+        if fetch:
+            psitold_g = self.get_wavefunction(self.kd.kibz_k[k], n, True,
+                                              spin=spin)
+            if check_focc and item is None:
+                psit_g = self.kd.transform_wave_function(psitold_g, k)
+                P_ai = self.pt.dict()
+                self.pt.integrate(psit_g, P_ai, k)
+                item = (psit_g, P_ai)
+                nbytes = psit_g.nbytes + sum([P_i.nbytes
+                                              for P_i in P_ai.values()])
+                self.wfcache.add(key, item, nbytes)
+        return item
+
+
     def density_matrix(self,n,m,k,Gspace=True):
 
         ibzk_kc = self.ibzk_kc
@@ -286,11 +356,8 @@ class BASECHI:
         ibzkpt1 = kd.kibz_k[k]
         ibzkpt2 = kd.kibz_k[kq_k[k]]
         
-        psitold_g = self.get_wavefunction(ibzkpt1, n, True)
-        psit1_g = kd.transform_wave_function(psitold_g, k)
-        
-        psitold_g = self.get_wavefunction(ibzkpt2, m, True)
-        psit2_g = kd.transform_wave_function(psitold_g, kq_k[k])
+        psit1_g, P1_ai = self.get_transformed_wavefunction(k, n)
+        psit2_g, P2_ai = self.get_transformed_wavefunction(kq_k[k], m)
 
         if Gspace is False:
             return psit1_g, psit2_g
@@ -300,10 +367,7 @@ class BASECHI:
             rho_g = np.fft.fftn(tmp_g) * self.vol / self.nG0
     
             # Here, planewave cutoff is applied
-            rho_G = np.zeros(self.npw, dtype=complex)
-            for iG in range(self.npw):
-                index = self.Gindex_G[iG]
-                rho_G[iG] = rho_g[index[0], index[1], index[2]]
+            rho_G = rho_g.ravel().take(self.Q_G)
     
             if self.optical_limit:
                 d_c = [Gradient(gd, i, n=4, dtype=complex).apply for i in range(3)]
@@ -317,12 +381,6 @@ class BASECHI:
                 rho_G[0] = -1j * np.dot(self.qq_v, tmp)
     
             # PAW correction
-            pt = self.pt
-            P1_ai = pt.dict()
-            pt.integrate(psit1_g, P1_ai, k)
-            P2_ai = pt.dict()
-            pt.integrate(psit2_g, P2_ai, kq_k[k])
-                            
             for a, id in enumerate(self.calc.wfs.setups.id_a):
                 P_p = np.outer(P1_ai[a].conj(), P2_ai[a]).ravel()
                 gemv(1.0, self.phi_aGp[a], P_p, 1.0, rho_G)
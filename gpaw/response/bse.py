@@ -21,10 +21,11 @@ class BSE(BASECHI):
                  eta=0.2,
                  ftol=1e-5,
                  txt=None,
-                 optical_limit=False):
+                 optical_limit=False,
+                 wfcache=100):
 
         BASECHI.__init__(self, calc, nbands, w, q, ecut,
-                     eta, ftol, txt, optical_limit)
+                     eta, ftol, txt, optical_limit, wfcache)
 
 
         self.epsilon_w = None
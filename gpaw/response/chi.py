@@ -4,7 +4,8 @@ import numpy as np
 from math import sqrt, pi
 from ase.units import Hartree, Bohr
 from gpaw import extra_parameters
-from gpaw.utilities.blas import gemv, scal, axpy
+from gpaw.utilities.blas import gemv, gemm, rk
+from gpaw.utilities.tools import tri2full
 from gpaw.mpi import world, rank, size, serial_comm
 from gpaw.fd_operators import Gradient
 from gpaw.response.math_func import hilbert_transform, full_hilbert_transform
@@ -35,6 +36,13 @@ class CHI(BASECHI):
             Spectrum broadening factor.
         sigma: float
             Width for delta function.
+        mblocksize: int
+            Number of m-bands to Fourier transform together.  Larger
+            blocks are faster but need more memory.
+        wfcache: float
+            Memory (in MB) for caching symmetry transformed wave
+            functions.  Room for nbands wave functions avoids all
+            repeated transformations.
     """
 
     def __init__(self,
@@ -49,14 +57,17 @@ class CHI(BASECHI):
                  hilbert_trans=True,
                  full_response=False,
                  optical_limit=False,
-                 kcommsize=None):
+                 kcommsize=None,
+                 mblocksize=1,
+                 wfcache=100):
 
         BASECHI.__init__(self, calc, nbands, w, q, ecut,
-                     eta, ftol, txt, optical_limit)
+                     eta, ftol, txt, optical_limit, wfcache)
 
         self.hilbert_trans = hilbert_trans
         self.full_hilbert_trans = full_response
         self.kcommsize = kcommsize
+        self.mblocksize = mblocksize
         self.comm = world
         self.chi0_wGG = None
 
@@ -190,37 +201,53 @@ class CHI(BASECHI):
             for n in range(self.nstart, self.nend):
 #                print >> self.txt, k, n, t_get_wfs, time() - t0
                 t1 = time()
-                psitold_g = self.get_wavefunction(ibzkpt1, n, True, spin=spin)
+                psit1new_g, P1_ai = self.get_transformed_wavefunction(k, n, spin)
                 t_get_wfs += time() - t1
-                psit1new_g = kd.transform_wave_function(psitold_g, k)
-
-                P1_ai = pt.dict()
-                pt.integrate(psit1new_g, P1_ai, k)
 
                 psit1_g = psit1new_g.conj() * self.expqr_g
 
-                for m in range(self.nbands):
+                # Pair densities and band indices of the transitions
+                rho_xG = []
+                m_x = []
+
+                for m1 in range(0, self.nbands, self.mblocksize):
+                    m2 = min(m1 + self.mblocksize, self.nbands)
+
+                    # Collect the contributing m-bands of this block and
+                    # Fourier transform them together
+                    m_m = []
+                    psit2_mg = []
+                    P2_mai = []
+                    for m in range(m1, m2):
+                        if self.hilbert_trans:
+                            check_focc = (f_kn[ibzkpt1, n] - f_kn[ibzkpt2, m]) > self.ftol
+                        else:
+                            check_focc = np.abs(f_kn[ibzkpt1, n] - f_kn[ibzkpt2, m]) > self.ftol
 
-		    if self.hilbert_trans:
-			check_focc = (f_kn[ibzkpt1, n] - f_kn[ibzkpt2, m]) > self.ftol
-                    else:
-                        check_focc = np.abs(f_kn[ibzkpt1, n] - f_kn[ibzkpt2, m]) > self.ftol
+                        t1 = time()
+                        # Called also when not needed to keep the ranks in
+                        # step when the wave functions are distributed
+                        item = self.get_transformed_wavefunction(
+                            kq_k[k], m, spin, check_focc)
+                        if check_focc:
+                            psit2_g, P2_ai = item
+                        t_get_wfs += time() - t1
 
-                    t1 = time()
-                    psitold_g = self.get_wavefunction(ibzkpt2, m, check_focc, spin=spin)
-                    t_get_wfs += time() - t1
+                        if check_focc:
+                            m_m.append(m)
+                            psit2_mg.append(psit2_g)
+                            P2_mai.append(P2_ai)
 
-                    if check_focc:
-                        psit2_g = kd.transform_wave_function(psitold_g, kq_k[k])
-                        P2_ai = pt.dict()
-                        pt.integrate(psit2_g, P2_ai, kq_k[k])
+                    if len(m_m) == 0:
+                        continue
 
-                        # fft
-                        tmp_g = np.fft.fftn(psit2_g*psit1_g) * self.vol / self.nG0
+                    # fft
+                    tmp_mg = np.fft.fftn(np.array(psit2_mg) * psit1_g,
+                                         axes=(1, 2, 3)) * self.vol / self.nG0
+                    rho_mG = tmp_mg.reshape((len(m_m), -1)).take(self.Q_G, axis=1)
+                    del tmp_mg
 
-                        for iG in range(self.npw):
-                            index = self.Gindex_G[iG]
-                            rho_G[iG] = tmp_g[index[0], index[1], index[2]]
+                    for m, psit2_g, P2_ai, rho_G in zip(m_m, psit2_mg, P2_mai, rho_mG):
 
                         if self.optical_limit:
                             phase_cd = np.exp(2j * pi * sdisp_cd * bzk_kc[kq_k[k], :, np.newaxis])
@@ -237,35 +264,21 @@ class CHI(BASECHI):
                         if self.optical_limit:
                             rho_G[0] /= e_kn[ibzkpt2, m] - e_kn[ibzkpt1, n]
 
-                        rho_GG = np.outer(rho_G, rho_G.conj())
-                        
-                        if not self.hilbert_trans:
-                            for iw in range(self.Nw_local):
-                                w = self.w_w[iw + self.wstart] / Hartree
-                                C =  (f_kn[ibzkpt1, n] - f_kn[ibzkpt2, m]) / (
-                                     w + e_kn[ibzkpt1, n] - e_kn[ibzkpt2, m] + 1j * self.eta)
-                                axpy(C, rho_GG, chi0_wGG[iw])
-                        else:
-                            focc = f_kn[ibzkpt1,n] - f_kn[ibzkpt2,m]
-                            w0 = e_kn[ibzkpt2,m] - e_kn[ibzkpt1,n]
-                            scal(focc, rho_GG)
-
-                            # calculate delta function
-                            w0_id = int(w0 / self.dw)
-                            if w0_id + 1 < self.NwS:
-                                # rely on the self.NwS_local is equal in each node!
-                                if self.wScomm.rank == w0_id // self.NwS_local:
-                                    alpha = (w0_id + 1 - w0/self.dw) / self.dw
-                                    axpy(alpha, rho_GG, specfunc_wGG[w0_id % self.NwS_local] )
-
-                                if self.wScomm.rank == (w0_id+1) // self.NwS_local:
-                                    alpha =  (w0 / self.dw - w0_id) / self.dw
-                                    axpy(alpha, rho_GG, specfunc_wGG[(w0_id+1) % self.NwS_local] )
-
-#                            deltaw = delta_function(w0, self.dw, self.NwS, self.sigma)
-#                            for wi in range(self.NwS_local):
-#                                if deltaw[wi + self.wS1] > 1e-8:
-#                                    specfunc_wGG[wi] += tmp_GG * deltaw[wi + self.wS1]
+                        rho_xG.append(rho_G)
+                        m_x.append(m)
+
+                # Add all transitions from band n with rank-k updates
+                if len(m_x) > 0:
+                    m_x = np.array(m_x)
+                    df_x = f_kn[ibzkpt1, n] - f_kn[ibzkpt2, m_x]
+                    de_x = e_kn[ibzkpt2, m_x] - e_kn[ibzkpt1, n]
+                    if self.hilbert_trans:
+                        self.add_transitions(specfunc_wGG, np.array(rho_xG),
+                                             df_x, de_x)
+                    else:
+                        self.add_transitions(chi0_wGG, np.array(rho_xG),
+                                             df_x, de_x)
+
                 if self.nkpt == 1:
                     if n == 0:
                         dt = time() - t0
@@ -289,11 +302,14 @@ class CHI(BASECHI):
         self.printtxt('Finished summation over k')
 
         self.kcomm.barrier()
-        del rho_GG, rho_G
+        del rho_G
         # Hilbert Transform
         if not self.hilbert_trans:
             self.kcomm.sum(chi0_wGG)
         else:
+            # Only the lower triangles are updated by rk()
+            for specfunc_GG in specfunc_wGG:
+                tri2full(specfunc_GG)
             self.kcomm.sum(specfunc_wGG)
             if self.wScomm.size == 1:
                 if not self.full_hilbert_trans:
@@ -339,6 +355,49 @@ class CHI(BASECHI):
         return
 
 
+    def add_transitions(self, chi0_wGG, rho_xG, df_x, de_x):
+        """Add a block of transitions to chi0_wGG (or specfunc_wGG).
+
+        rho_xG are the pair densities, df_x the occupation differences
+        and de_x the energy differences of the transitions.  Every
+        frequency gets one weighted rank-k update (gemm or rk) instead
+        of a rank-1 update per transition."""
+
+        rhoT_Gx = rho_xG.T.copy()
+
+        if not self.hilbert_trans:
+            for iw in range(self.Nw_local):
+                w = self.w_w[iw + self.wstart] / Hartree
+                C_x = df_x / (w - de_x + 1j * self.eta)
+                gemm(1.0, rhoT_Gx, rhoT_Gx * C_x, 1.0, chi0_wGG[iw], 'c')
+            return
+
+        # calculate delta function: each transition is shared between
+        # the two nearest frequency points
+        w0_x = de_x / self.dw
+        w0id_x = w0_x.astype(int)
+        ok_x = w0id_x + 1 < self.NwS
+        w0id_x = w0id_x[ok_x]
+        x_y = np.arange(len(df_x))[ok_x].repeat(2)
+        iw_y = np.array([w0id_x, w0id_x + 1]).T.ravel()
+        alpha_y = np.array([w0id_x + 1 - w0_x[ok_x],
+                            w0_x[ok_x] - w0id_x]).T.ravel() / self.dw
+        alpha_y *= df_x[x_y]
+
+        # rely on the self.NwS_local is equal in each node!
+        mine_y = iw_y // self.NwS_local == self.wScomm.rank
+        for iw in np.unique(iw_y[mine_y]):
+            y = np.arange(len(iw_y))[iw_y == iw]
+            alpha_y1 = alpha_y[y]
+            if (alpha_y1 >= 0).all():
+                a_Gy = rhoT_Gx[:, x_y[y]] * alpha_y1**0.5
+                rk(1.0, a_Gy, 1.0, chi0_wGG[iw % self.NwS_local])
+            else:
+                a_Gy = rhoT_Gx[:, x_y[y]]
+                gemm(1.0, a_Gy, a_Gy * alpha_y1, 1.0,
+                     chi0_wGG[iw % self.NwS_local], 'c')
+
+
     def parallel_init(self):
         """Parallel initialization. By default, only use kcomm and wcomm.
 
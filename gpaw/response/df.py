@@ -21,10 +21,13 @@ class DF(CHI):
                  hilbert_trans=True,
                  full_response=False,
                  optical_limit=False,
-                 kcommsize=None):
+                 kcommsize=None,
+                 mblocksize=1,
+                 wfcache=100):
 
         CHI.__init__(self, calc, nbands, w, q, ecut,
-                     eta, ftol, txt, hilbert_trans, full_response, optical_limit, kcommsize)
+                     eta, ftol, txt, hilbert_trans, full_response, optical_limit, kcommsize,
+                     mblocksize, wfcache)
 
         self.df1_w = None
         self.df2_w = None
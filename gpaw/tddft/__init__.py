@@ -241,7 +241,8 @@ class TDDFT(GPAW):
         GPAW.read(self, reader)
 
     def propagate(self, time_step, iterations, dipole_moment_file=None,
-                  restart_file=None, dump_interval=100):
+                  restart_file=None, dump_interval=100,
+                  background_dump=False):
         """Propagates wavefunctions.
         
         Parameters
@@ -257,6 +258,11 @@ class TDDFT(GPAW):
             Name of the restart file
         dump_interval: integer
             After how many iterations restart data is dumped
+        background_dump: bool
+            Write the restart data in the background while the
+            propagation continues.  The wave functions are copied, so
+            this needs memory for one more set of wave functions.  The
+            restart file on disk is always the last completed one.
         
         """
 
@@ -278,6 +284,11 @@ class TDDFT(GPAW):
         if dipole_moment_file is not None:
             self.initialize_dipole_moment_file(dipole_moment_file)
 
+        if restart_file is not None and background_dump:
+            checkpoint = gpaw.io.Checkpoint(self, restart_file)
+        else:
+            checkpoint = None
+
         niterpropagator = 0
         maxiter = self.niter + iterations
 
@@ -317,9 +328,17 @@ class TDDFT(GPAW):
 
             # Write restart data
             if restart_file is not None and self.niter % dump_interval == 0:
-                self.write(restart_file, 'all')
+                if checkpoint is not None:
+                    self.timer.start('IO')
+                    checkpoint.write('all')
+                    self.timer.stop('IO')
+                    if self.rank == 0:
+                        print 'Writing restart file in the background.'
+                else:
+                    self.write(restart_file, 'all')
+                    if self.rank == 0:
+                        print 'Wrote restart file.'
                 if self.rank == 0:
-                    print 'Wrote restart file.'
                     print self.niter, ' iterations done. Current time is ', \
                         self.time * autime_to_attosec, ' as.' 
 
@@ -335,6 +354,9 @@ class TDDFT(GPAW):
         # Call registered callback functions
         self.call_observers(self.niter, final=True)
 
+        if checkpoint is not None:
+            checkpoint.wait()
+
         if restart_file is not None:
             self.write(restart_file, 'all')
 
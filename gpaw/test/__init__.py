@@ -93,6 +93,7 @@ tests = [
     'ds_beta.py',
     'gauss_wave.py',
     'planewavebasis.py',
+    'parallel/pw_fft.py',
     'coulomb.py',
     'timing.py',
     'lcao_density.py',
@@ -136,6 +137,8 @@ tests = [
     'plt.py',
     'parallel/hamiltonian.py',
     'restart2.py',
+    'parallel_io.py',
+    'chunked_io.py',
     'hydrogen.py',
     'H_force.py',
     'Cl_minus.py',
@@ -150,9 +153,12 @@ tests = [
     'gemv.py',
     'asewannier.py',
     'davidson.py',
+    'block_eigensolvers.py',
     'cg.py',
     'h2o_xas_recursion.py',
     'lrtddft.py',
+    'lrtddft_davidson.py',
+    'lrtddft_io.py',
     'spectrum.py',
     'lcao_bsse.py',
     'lcao_force.py',
@@ -190,6 +196,7 @@ tests = [
     'td_na2.py',
     'ldos.py',
     'exx_coarse.py',
+    'exx_fft.py',
     '2Al.py',
     'lxc_xcatom.py',
     'aedensity.py',
@@ -216,10 +223,12 @@ tests = [
     'scfsic_n2.py',
     'lb94.py',
     'aluminum_EELS_lcao.py',
+    'vdw/table.py',
     'vdw/quick.py',
     'vdw/potential.py',
     'vdw/quick_spin.py',
     'vdw/ar2.py',
+    'parallel/vdw_fft.py',
     'fd2lcao_restart.py',
 #    'eigh_perf.py', # Requires LAPACK 3.2.1 or later
     'parallel/parallel_eigh.py',
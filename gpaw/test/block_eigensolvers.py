@@ -0,0 +1,60 @@
+import numpy as np
+from ase import Atom, Atoms
+from gpaw import GPAW
+from gpaw.eigensolvers import LOBPCG, ChebyshevFilter
+from gpaw.grid_descriptor import GridDescriptor
+from gpaw.mpi import world
+from gpaw.test import equal
+
+# Rayleigh-Ritz step of LOBPCG for independent, linearly dependent and
+# zero basis vectors:
+lobpcg = LOBPCG()
+lobpcg.gd = GridDescriptor((8, 8, 8), (4.0, 4.0, 4.0), True, world)
+lobpcg.dtype = float
+np.random.seed(world.rank)
+for x, independent in [(None, True), (1, False), (2, False)]:
+    lobpcg.V_xG = lobpcg.gd.empty(3)
+    lobpcg.V_xG[:] = np.random.random(lobpcg.V_xG.shape)
+    if x == 1:
+        lobpcg.V_xG[2] = lobpcg.V_xG[0] - 2 * lobpcg.V_xG[1]
+    elif x == 2:
+        lobpcg.V_xG[2] = 0.0
+    lobpcg.HV_xG = 2 * lobpcg.V_xG
+    C_mm, eps_m = lobpcg.rayleigh_ritz(None, {}, {}, 3)
+    if independent:
+        assert abs(eps_m - 2).max() < 1e-10
+    else:
+        assert C_mm is None and eps_m is None
+
+a = 4.05
+d = a / 2**0.5
+bulk = Atoms([Atom('Al', (0, 0, 0)),
+              Atom('Al', (0.5, 0.5, 0.5))], pbc=True)
+bulk.set_cell((d, d, a), scale_atoms=True)
+h = 0.25
+calc = GPAW(h=h,
+            nbands=2*8,
+            kpts=(2, 2, 2),
+            convergence={'eigenstates': 1e-10, 'energy': 1e-5})
+bulk.set_calculator(calc)
+e0 = bulk.get_potential_energy()
+
+# Block eigensolvers and the largest number of SCF iterations they may
+# need (Davidson needs 22-27 for the same convergence criteria):
+for eigensolver, maxiter in [('lobpcg', 30),
+                             (LOBPCG(niter=2, blocksize=5), 30),
+                             ('chebyshev', 35),
+                             (ChebyshevFilter(degree=6, blocksize=5), 40)]:
+    calc = GPAW(h=h,
+                nbands=2*8,
+                kpts=(2, 2, 2),
+                convergence={'eigenstates': 1e-10,
+                             'energy': 1e-5,
+                             'bands': 5},
+                eigensolver=eigensolver)
+    bulk.set_calculator(calc)
+    e1 = bulk.get_potential_energy()
+    niter1 = calc.get_number_of_iterations()
+    print eigensolver, e1, niter1
+    equal(e0, e1, 5.0e-5)
+    assert niter1 <= maxiter, (eigensolver, niter1)
@@ -0,0 +1,46 @@
+"""Test chunked and compressed restart files."""
+
+import os
+import numpy as np
+from ase import Atoms
+from ase.parallel import rank, barrier
+from gpaw import GPAW
+from gpaw.io import open as gpaw_open
+from gpaw.test import equal
+
+H2 = Atoms('H2', positions=[(0, 0, 0), (0, 0, 0.74)])
+H2.center(vacuum=2.0)
+calc = GPAW(nbands=2, convergence={'eigenstates': 1e-3})
+H2.set_calculator(calc)
+H2.get_potential_energy()
+
+calc.write('H2.gpw', 'all')
+calc.write('H2.gpwz', 'all', chunksize=10000)
+calc.write('H2-single.gpwz', 'all', single_precision=True)
+
+r1 = gpaw_open('H2.gpw', 'r')
+r2 = gpaw_open('H2.gpwz', 'r')
+for name in ['Projections', 'PseudoElectronDensity', 'PseudoWaveFunctions']:
+    assert abs(r1.get(name) - r2.get(name)).max() == 0.0, name
+a_G = r1.get('PseudoWaveFunctions', 0, 0, 1)
+assert (r2.get('PseudoWaveFunctions', 0, 0, 1, slice(2, 5)) == a_G[2:5]).all()
+r1.close()
+r2.close()
+if rank == 0:
+    print os.path.getsize('H2.gpw'), os.path.getsize('H2.gpwz'),
+    print os.path.getsize('H2-single.gpwz')
+
+E0 = GPAW('H2.gpw',
+          convergence={'eigenstates': 1e-5}).get_atoms().get_potential_energy()
+E1 = GPAW('H2.gpwz',
+          convergence={'eigenstates': 1e-5}).get_atoms().get_potential_energy()
+E2 = GPAW('H2-single.gpwz',
+          convergence={'eigenstates': 1e-5}).get_atoms().get_potential_energy()
+print E0, E1, E2
+equal(E0, E1, 1e-12)
+equal(E0, E2, 1e-5)
+
+barrier()
+if rank == 0:
+    for name in ['H2.gpw', 'H2.gpwz', 'H2-single.gpwz']:
+        os.remove(name)
@@ -1,5 +1,6 @@
 from ase import Atom, Atoms
 from gpaw import GPAW
+from gpaw.eigensolvers import Davidson
 from gpaw.test import equal
 
 a = 4.05
@@ -27,9 +28,25 @@ e1 = bulk.get_potential_energy()
 niter1 = calc.get_number_of_iterations()
 equal(e0, e1, 5.0e-5)
 
+# Skip updates of converged bands:
+calc = GPAW(h=h,
+            nbands=2*8,
+            kpts=(2, 2, 2),
+            convergence={'eigenstates': 1e-10,
+                         'energy': 1e-5,
+                         'bands': 5 },
+            eigensolver=Davidson(freeze=0.1))
+bulk.set_calculator(calc)
+e2 = bulk.get_potential_energy()
+niter2 = calc.get_number_of_iterations()
+nskipped = calc.wfs.eigensolver.nskipped
+equal(e1, e2, 5.0e-5)
+
 energy_tolerance = 0.00004
 niter_tolerance = 0
 equal(e0, -6.97626, energy_tolerance)
 assert 14 <= niter0 <= 21, niter0
 equal(e1, -6.976265, energy_tolerance)
 assert 22 <= niter1 <= 27, niter1
+assert nskipped > 0, nskipped
+assert niter2 <= niter1 + 3, (niter1, niter2)
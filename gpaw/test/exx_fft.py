@@ -0,0 +1,63 @@
+import numpy as np
+from ase import Atoms
+from gpaw import GPAW
+from gpaw.grid_descriptor import GridDescriptor
+from gpaw.mpi import world
+from gpaw.test import equal
+from gpaw.utilities.gauss import Gaussian
+from gpaw.xc.hybrid import HybridXC
+
+# The distributed FFT Coulomb solver on a doubled grid must reproduce
+# the analytic potential of a gaussian charge
+gd = GridDescriptor((24, 24, 24), (8.0, 8.0, 8.0), False, world)
+gauss = Gaussian(gd)
+exx = HybridXC('EXX', coulomb='fft')
+exx.gd = exx.finegd = gd
+exx.initialize_fft()
+v_g = exx.calculate_pair_potentials(0, [(0, 1)],
+                                    np.array([-gauss.get_gauss(0)]))[0]
+error = world.max(abs(v_g - gauss.get_gauss_pot(0)).max())
+print 'gauss', error
+assert error < 1e-6
+
+# ... and agree with the multigrid Poisson solver for an isolated
+# molecule
+loa = Atoms('Be2',
+            [(0, 0, 0), (2.45, 0, 0)],
+            cell=[5.9, 4.8, 5.0])
+loa.center()
+
+calc = GPAW(h=0.3,
+            xc='PBE',
+            nbands=4,
+            convergence={'eigenstates': 1e-4},
+            txt=None)
+loa.set_calculator(calc)
+loa.get_potential_energy()
+
+dexx = calc.get_xc_difference(HybridXC('EXX'))
+dexx_fft = calc.get_xc_difference(HybridXC('EXX', coulomb='fft'))
+print dexx, dexx_fft
+equal(dexx, dexx_fft, 1e-3)
+
+# small batches and no stored potentials
+exx = HybridXC('EXX', memory=1)
+dexx2 = calc.get_xc_difference(exx)
+assert len(exx.vt_pg) == 0
+equal(dexx, dexx2, 1e-6)
+exx_s = exx.exx_s.copy()
+
+# stored potentials: the first call starts from zero and the second
+# one from the stored potentials (perturbed, so that the solver has
+# something to do)
+exx = HybridXC('EXX')
+dexx3 = calc.get_xc_difference(exx)
+npairs = len(exx.vt_pg)
+assert npairs > 0
+equal(dexx, dexx3, 1e-6)
+for vt_g in exx.vt_pg.values():
+    vt_g *= 0.9
+exx.calculate_exx()
+assert len(exx.vt_pg) == npairs
+print exx_s, exx.exx_s
+assert abs(exx.exx_s - exx_s).max() < 1e-8
@@ -13,7 +13,7 @@ from gpaw.mpi import rank, world
 from gpaw.test import equal
 from gpaw.gauss import Gauss
 from gpaw.lrtddft import LrTDDFT, photoabsorption_spectrum
-from gpaw.lrtddft.kssingle import KSSingles
+from gpaw.lrtddft.kssingle import KSSingles, KSSingle
 from cStringIO import StringIO
 
 L = 10.0
@@ -63,6 +63,13 @@ for obj in [KSSingles, LrTDDFT]:
         el.diagonalize(energy_range=8)
         assert len(el) == 4
 
+# batched and single transition augmentation contributions
+kss = KSSingles(calc, istart=3, jend=6, txt=txt)
+for ks in kss:
+    ks1 = KSSingle(ks.i, ks.j, ks.pspin, calc.wfs.kpt_u[ks.spin], calc)
+    assert abs(ks1.mur - ks.mur).max() < 1e-12
+    assert abs(ks1.muv - ks.muv).max() < 1e-12
+
 lr = LrTDDFT(calc, nspins=2)
 lr.write('lrtddft3.dat.gz')
 lr.diagonalize()
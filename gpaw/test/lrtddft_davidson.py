@@ -0,0 +1,31 @@
+from ase import Atom, Atoms
+from gpaw import GPAW
+from gpaw.test import equal
+from gpaw.lrtddft import LrTDDFT
+
+R = 0.7 # approx. experimental bond length
+a = 3.0
+c = 4.0
+H2 = Atoms([Atom('H', (a / 2, a / 2, (c - R) / 2)),
+            Atom('H', (a / 2, a / 2, (c + R) / 2))],
+           cell=(a, a, c))
+calc = GPAW(xc='PBE', nbands=4, spinpol=False, txt=None)
+H2.set_calculator(calc)
+H2.get_potential_energy()
+
+for xc in ['LDA', None]:
+    lr = LrTDDFT(calc, xc=xc)
+    lr.diagonalize()
+    lr2 = LrTDDFT(calc, xc=xc)
+    lr2.diagonalize(nexcitations=2)
+    assert len(lr2) == 2
+    for i in range(2):
+        print xc, i, lr[i], lr2[i]
+        equal(lr[i].get_energy(), lr2[i].get_energy(), 1.e-7)
+
+# RPA without the Omega matrix
+lr3 = LrTDDFT(calc, direct=True)
+lr3.diagonalize(nexcitations=2)
+for i in range(2):
+    print 'direct', i, lr[i], lr3[i]
+    equal(lr[i].get_energy(), lr3[i].get_energy(), 1.e-5)
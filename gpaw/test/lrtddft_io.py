@@ -0,0 +1,62 @@
+import os
+import numpy as np
+from ase import Atom, Atoms
+from gpaw import GPAW
+from gpaw.test import equal
+from gpaw.lrtddft import LrTDDFT
+from gpaw.mpi import world
+
+R = 0.7 # approx. experimental bond length
+a = 3.0
+c = 4.0
+H2 = Atoms([Atom('H', (a / 2, a / 2, (c - R) / 2)),
+            Atom('H', (a / 2, a / 2, (c + R) / 2))],
+           cell=(a, a, c))
+calc = GPAW(xc='PBE', nbands=3, spinpol=False, txt=None)
+H2.set_calculator(calc)
+H2.get_potential_energy()
+
+lr = LrTDDFT(calc, xc='LDA')
+lr.diagonalize()
+
+# binary file
+fname = 'lr_binary.dat.gz'
+lr.write(fname, binary=True)
+world.barrier()
+lr2 = LrTDDFT(fname)
+assert abs(lr2.Om.full - lr.Om.full).max() < 1e-14
+lr2.diagonalize()
+for ex, ex2 in zip(lr, lr2):
+    equal(ex.get_energy(), ex2.get_energy(), 1e-12)
+
+# rows written during the calculation
+rowfile = 'lr_rows.dat'
+if world.rank == 0 and os.path.isfile(rowfile):
+    os.remove(rowfile)
+world.barrier()
+lr3 = LrTDDFT(calc, xc='LDA', restart=rowfile)
+assert abs(lr3.Om.full - lr.Om.full).max() < 1e-12
+f = open(rowfile, 'rb')
+header = f.readline()
+M_snn = np.load(f)
+f.close()
+assert np.isfinite(M_snn.diagonal(axis1=1, axis2=2)).all()
+
+# rows of another functional are not used
+try:
+    LrTDDFT(calc, xc='RPA', restart=rowfile)
+except RuntimeError:
+    pass
+else:
+    raise AssertionError('RPA run accepted LDA rows')
+
+# forget half of the rows and calculate them again
+if world.rank == 0:
+    M_snn[:, ::2] = np.nan
+    f = open(rowfile, 'wb')
+    f.write(header)
+    np.save(f, M_snn)
+    f.close()
+world.barrier()
+lr4 = LrTDDFT(calc, xc='LDA', restart=rowfile)
+assert abs(lr4.Om.full - lr.Om.full).max() < 1e-12
@@ -0,0 +1,36 @@
+import numpy as np
+from gpaw.grid_descriptor import GridDescriptor
+from gpaw.mpi import world, serial_comm
+from gpaw.wavefunctions.pw import PWDescriptor
+
+# Compare distributed and serial plane-wave FFT's:
+N_c = np.array([12, 10, 14])
+cell_cv = [[4.0, 0.0, 0.0], [0.5, 3.5, 0.0], [0.0, 0.0, 4.5]]
+kpts = [(0, 0, 0), (0.25, -0.25, 0.5)]
+ecut = 10.0
+
+gd = GridDescriptor(N_c, cell_cv, True, world)
+gd0 = GridDescriptor(N_c, cell_cv, True, serial_comm)
+pd = PWDescriptor(ecut, gd, kpts)
+pd0 = PWDescriptor(ecut, gd0, kpts)
+assert pd.ngtot == len(pd0.Q_G)
+
+# My G-vectors in the serial descriptor:
+G_G = np.searchsorted(pd0.Q_G, pd.Q_G)
+assert (pd0.Q_G[G_G] == pd.Q_G).all()
+assert abs(pd.G2_qG - pd0.G2_qG[:, G_G]).max() < 1e-10
+
+np.random.seed(42)
+a_xG = np.random.random((3, len(pd0.Q_G))) + 1j
+b_xR = np.random.random((3,) + tuple(N_c))
+
+a_xR = gd.collect(pd.ifft(a_xG[:, G_G]), broadcast=True)
+error = abs(a_xR - pd0.ifft(a_xG)).max()
+print 'ifft', error
+assert error < 1e-13
+
+b_xG = pd.fft(b_xR[[Ellipsis] + gd.get_slice()])
+error = abs(b_xG - pd0.fft(b_xR)[:, G_G]).max() if len(G_G) else 0.0
+error = world.max(error)
+print 'fft', error
+assert error < 1e-10
@@ -0,0 +1,47 @@
+"""Compare distributed and serial vdW-DF FFT convolutions."""
+import numpy as np
+from gpaw import extra_parameters
+from gpaw.grid_descriptor import GridDescriptor
+from gpaw.mpi import world, serial_comm
+from gpaw.xc.vdw import FFTVDWFunctional
+
+N_c = np.array([10, 12, 11])
+cell_cv = [[4.0, 0.0, 0.0], [0.5, 4.5, 0.0], [0.0, 0.0, 4.2]]
+
+# Domain communicators: all of world and, if possible, half of world
+# (the two halves then share the alphas):
+comms = [world]
+if world.size > 1 and world.size % 2 == 0:
+    half = world.size // 2
+    comm1 = world.new_communicator(range(half))
+    comm2 = world.new_communicator(range(half, world.size))
+    if world.rank < half:
+        comms.append(comm1)
+    else:
+        comms.append(comm2)
+
+
+def check(pbc_c):
+    gd0 = GridDescriptor(N_c, cell_cv, pbc_c, serial_comm)
+    np.random.seed(17)
+    n0_sg = 0.02 + 0.3 * np.random.random(gd0.zeros(1).shape)
+    v0_sg = gd0.zeros(1)
+    xc0 = FFTVDWFunctional('vdW-DF', world=serial_comm)
+    e0 = xc0.calculate(gd0, n0_sg, v0_sg)
+    for comm in comms:
+        gd = GridDescriptor(N_c, cell_cv, pbc_c, comm)
+        n_sg = n0_sg[[Ellipsis] + gd.get_slice()].copy()
+        v_sg = gd.zeros(1)
+        xc = FFTVDWFunctional('vdW-DF', world=world)
+        e = xc.calculate(gd, n_sg, v_sg)
+        v_sg = gd.collect(v_sg, broadcast=True)
+        print pbc_c, comm.size, xc.alphacomm.size, e - e0
+        assert abs(e - e0) < 1e-11
+        assert abs(v_sg - v0_sg).max() < 1e-11
+
+for vdw0 in [False, True]:
+    extra_parameters['vdw0'] = vdw0
+    check((1, 1, 1))
+    check((0, 0, 0))
+    check((1, 0, 1))
+del extra_parameters['vdw0']
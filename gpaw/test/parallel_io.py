@@ -0,0 +1,62 @@
+"""Test parallel writing and reading of .gpw files."""
+
+import os
+import numpy as np
+from ase import Atoms
+from ase.parallel import rank, barrier
+from gpaw import GPAW
+from gpaw.io import open as gpaw_open
+from gpaw.io.tar import Writer, Reader
+from gpaw.mpi import world
+from gpaw.test import equal
+
+H2 = Atoms('H2', positions=[(0, 0, 0), (0, 0, 0.74)])
+H2.center(vacuum=2.0)
+calc = GPAW(nbands=2, convergence={'eigenstates': 1e-3})
+H2.set_calculator(calc)
+H2.get_potential_energy()
+
+calc.write('serial.gpw', 'all')
+calc.write('parallel.gpw', 'all', parallel=True)
+
+# The two files must hold exactly the same data:
+r1 = gpaw_open('serial.gpw', 'r')
+r2 = gpaw_open('parallel.gpw', 'r', parallel=True)
+for name in ['Projections', 'AtomicDensityMatrices', 'PseudoElectronDensity',
+             'PseudoPotential', 'PseudoWaveFunctions']:
+    assert abs(r1.get(name) - r2.get(name)).max() == 0.0, name
+a_G = r1.get('PseudoWaveFunctions', 0, 0, 1)
+assert (r2.get('PseudoWaveFunctions', 0, 0, 1, slice(2, 5), slice(1, None, 2))
+        == a_G[2:5, 1::2]).all()
+r1.close()
+r2.close()
+
+E1 = GPAW('serial.gpw',
+          convergence={'eigenstates': 1e-5}).get_atoms().get_potential_energy()
+E2 = GPAW('parallel.gpw',
+          convergence={'eigenstates': 1e-5}).get_atoms().get_potential_energy()
+print E1, E2
+equal(E1, E2, 1e-12)
+
+# Fills without indices append to the array (as GLLB does, one spin
+# at a time, on the master only):
+a_sG = np.arange(24.0).reshape((2, 3, 4))
+w = Writer('fill.gpw', world, parallel=True)
+w.dimension('nspins', 2)
+w.dimension('ngptsx', 3)
+w.dimension('ngptsy', 4)
+w.add('A', ('nspins', 'ngptsx', 'ngptsy'), dtype=float)
+if rank == 0:
+    for a_G in a_sG:
+        w.fill(a_G)
+w.close()
+barrier()
+r = Reader('fill.gpw')
+assert (r.get('A') == a_sG).all()
+r.close()
+
+barrier()
+if rank == 0:
+    os.remove('serial.gpw')
+    os.remove('parallel.gpw')
+    os.remove('fill.gpw')
@@ -0,0 +1,17 @@
+import numpy as np
+from gpaw.xc.vdw import phi, phi_array, write_table_file, read_table_file
+from gpaw.test import equal
+
+d_x = np.array([0.6, 2.0, 1.4])
+dp_x = np.array([0.6, 1.0, 0.0])
+phi_x = phi_array(d_x, dp_x)
+for d, dp, phi1 in zip(d_x, dp_x, phi_x):
+    phi0 = phi(d, dp)
+    print d, dp, phi0, phi1
+    equal(phi0, phi1, 1e-6)
+
+write_table_file('phi.vdw', np.outer(phi_x, d_x))
+equal(abs(read_table_file('phi.vdw') - np.outer(phi_x, d_x)).max(), 0, 0)
+data = open('phi.vdw', 'rb').read()
+open('phi.vdw', 'wb').write(data[:-8] + np.ones(1).tostring())
+assert read_table_file('phi.vdw') is None
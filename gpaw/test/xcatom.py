@@ -46,3 +46,13 @@ for xc in ['LDA', 'PBE']:
     Em = s.xc_correction.calculate(xc, D_sp, H_sp)
     print dE, dE - 0.5 * (Ep - Em) / x
     equal(dE, 0.5 * (Ep - Em) / x, 1e-6)
+
+    # Several atoms and all Lebedev points in one go:
+    D_asp = np.array([D_sp, D_sp + dD_sp, 0.1 * ra.random((2, nii)) + 0.2])
+    H_asp = np.zeros_like(D_asp)
+    E_a = s.xc_correction.calculate_many(xc, D_asp, H_asp)
+    for D_sp, H_sp, E in zip(D_asp, H_asp, E_a):
+        H0_sp = np.zeros_like(H_sp)
+        E0 = s.xc_correction.calculate_point_by_point(xc, D_sp, H0_sp)
+        equal(E, E0, 1e-12)
+        equal(abs(H_sp - H0_sp).max(), 0.0, 1e-12)
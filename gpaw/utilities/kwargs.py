@@ -9,6 +9,8 @@ from gpaw.occupations import FermiDirac, ZeroKelvin
 from gpaw.eigensolvers.rmm_diis import RMM_DIIS
 from gpaw.eigensolvers.cg import CG
 from gpaw.eigensolvers.davidson import Davidson
+from gpaw.eigensolvers.lobpcg import LOBPCG
+from gpaw.eigensolvers.chebyshev import ChebyshevFilter
 from gpaw.lcao.eigensolver import LCAO
 
 
@@ -0,0 +1,160 @@
+"""Parallel FFT of real arrays on a domain-decomposed grid."""
+
+import numpy as np
+
+
+class ParallelFFT:
+    """Real-to-complex 3-d FFT of a slab-decomposed grid.
+
+    Real-space arrays are distributed over gd.comm in slabs along the
+    first axis, Fourier-space arrays (of shape (N0, N1, N2 // 2 + 1))
+    in slabs along the second axis.  Two-dimensional FFTs are done on
+    the slabs and the data is transposed between the two layouts with
+    point-to-point communication.  The slabs of the zero-padded grid
+    are filled directly from the domains of gd, so no process ever
+    holds a global array."""
+    
+    def __init__(self, shape, gd):
+        self.shape = N0, N1, N2 = tuple(shape)
+        self.gd = gd
+        self.comm = comm = gd.comm
+        P = comm.size
+        self.x_r = [N0 * r // P for r in range(P + 1)]
+        self.y_r = [N1 * r // P for r in range(P + 1)]
+        self.x1, self.x2 = self.x_r[comm.rank:comm.rank + 2]
+        self.y1, self.y2 = self.y_r[comm.rank:comm.rank + 2]
+        self.kshape = (N0, self.y2 - self.y1, N2 // 2 + 1)
+
+        # Boxes of the global array held by the domains of gd:
+        begs_cp = [n_p - n_p[0] for n_p in gd.n_cp]
+        self.box_r = []
+        for n0 in range(gd.parsize_c[0]):
+            for n1 in range(gd.parsize_c[1]):
+                for n2 in range(gd.parsize_c[2]):
+                    self.box_r.append([(begs_cp[c][n], begs_cp[c][n + 1])
+                                       for c, n in enumerate([n0, n1, n2])])
+        self.size_c = gd.get_size_of_global_array()
+        self.nx = max(0, min(self.x2, self.size_c[0]) - self.x1)
+
+    def rfftn(self, a_xyz):
+        """Forward transform of array (only the part of the slab that
+        is not zero-padding needs to be given).
+
+        Leading dimensions of a_xyz (batches of arrays) are kept and
+        all arrays are moved between the processes in one go."""
+        n0, n1, n2 = a_xyz.shape[-3:]
+        b_xyz = np.zeros(a_xyz.shape[:-3] + (self.x2 - self.x1,) +
+                         self.shape[1:])
+        b_xyz[..., :n0, :n1, :n2] = a_xyz
+        b_xyz = np.fft.rfft2(b_xyz)
+        return np.fft.fft(self.transpose(b_xyz, True), axis=-3)
+
+    def irfftn(self, a_k):
+        """Inverse transform.  Returns real-space slab."""
+        b_xyz = self.transpose(np.fft.ifft(a_k, axis=-3), False)
+        return np.fft.irfft2(b_xyz, self.shape[1:])
+
+    def transpose(self, a, forward):
+        if self.comm.size == 1:
+            return a
+        N0, N1 = self.shape[:2]
+        batch = a.shape[:-3]
+        n2 = a.shape[-1]
+        if forward:
+            b = np.empty(batch + self.kshape, complex)
+        else:
+            b = np.empty(batch + (self.x2 - self.x1, N1, n2), complex)
+        requests = []
+        buffers = []
+        for r in range(self.comm.size):
+            x1, x2 = self.x_r[r:r + 2]
+            y1, y2 = self.y_r[r:r + 2]
+            if forward:
+                a_xyz = a[..., :, y1:y2, :].copy()
+                b_xyz = b[..., x1:x2, :, :]
+            else:
+                a_xyz = a[..., x1:x2, :, :].copy()
+                b_xyz = b[..., :, y1:y2, :]
+            if r == self.comm.rank:
+                b_xyz[:] = a_xyz
+                continue
+            if a_xyz.size > 0:
+                requests.append(self.comm.send(a_xyz, r, 117, block=False))
+            buf_xyz = np.empty(b_xyz.shape, complex)
+            if buf_xyz.size > 0:
+                requests.append(self.comm.receive(buf_xyz, r, 117,
+                                                  block=False))
+            buffers.append((a_xyz, buf_xyz, b_xyz))
+        self.comm.waitall(requests)
+        for a_xyz, buf_xyz, b_xyz in buffers:
+            b_xyz[:] = buf_xyz
+        return b
+
+    def domain_to_slab(self, a_g):
+        """Move array from the domains of gd to our slab.
+
+        The result has shape (nx, M1, M2), where M1 and M2 are the sizes
+        of the global array and nx is the number of our x-planes that
+        are not zero-padding.  Leading dimensions of a_g are kept."""
+        M0, M1, M2 = self.size_c
+        batch = a_g.shape[:-3]
+        b_xg = np.empty(batch + (self.nx, M1, M2))
+        if self.comm.size == 1:
+            b_xg[:] = a_g
+            return b_xg
+        requests = []
+        buffers = []
+        (bx1, bx2), (by1, by2), (bz1, bz2) = self.box_r[self.comm.rank]
+        for r in range(self.comm.size):
+            x1 = max(bx1, self.x_r[r])
+            x2 = min(bx2, self.x_r[r + 1])
+            if x2 > x1:
+                a_xg = a_g[..., x1 - bx1:x2 - bx1, :, :].copy()
+                requests.append(self.comm.send(a_xg, r, 118, block=False))
+                buffers.append(a_xg)
+            (cx1, cx2), (cy1, cy2), (cz1, cz2) = self.box_r[r]
+            x1 = max(cx1, self.x1)
+            x2 = min(cx2, self.x1 + self.nx)
+            if x2 > x1:
+                b_xyz = b_xg[..., x1 - self.x1:x2 - self.x1,
+                             cy1:cy2, cz1:cz2]
+                buf_xyz = np.empty(b_xyz.shape)
+                requests.append(self.comm.receive(buf_xyz, r, 118,
+                                                  block=False))
+                buffers.append((buf_xyz, b_xyz))
+        self.comm.waitall(requests)
+        for buf in buffers:
+            if isinstance(buf, tuple):
+                buf[1][:] = buf[0]
+        return b_xg
+
+    def slab_to_domain(self, b_xg):
+        """Move array from our slab back to the domains of gd."""
+        if self.comm.size == 1:
+            return b_xg
+        a_g = self.gd.empty(b_xg.shape[:-3])
+        requests = []
+        buffers = []
+        (bx1, bx2), (by1, by2), (bz1, bz2) = self.box_r[self.comm.rank]
+        for r in range(self.comm.size):
+            (cx1, cx2), (cy1, cy2), (cz1, cz2) = self.box_r[r]
+            x1 = max(cx1, self.x1)
+            x2 = min(cx2, self.x1 + self.nx)
+            if x2 > x1:
+                b_xyz = b_xg[..., x1 - self.x1:x2 - self.x1,
+                             cy1:cy2, cz1:cz2].copy()
+                requests.append(self.comm.send(b_xyz, r, 119, block=False))
+                buffers.append(b_xyz)
+            x1 = max(bx1, self.x_r[r])
+            x2 = min(bx2, self.x_r[r + 1])
+            if x2 > x1:
+                a_xg = a_g[..., x1 - bx1:x2 - bx1, :, :]
+                buf_xg = np.empty(a_xg.shape)
+                requests.append(self.comm.receive(buf_xg, r, 119,
+                                                  block=False))
+                buffers.append((buf_xg, a_xg))
+        self.comm.waitall(requests)
+        for buf in buffers:
+            if isinstance(buf, tuple):
+                buf[1][:] = buf[0]
+        return a_g
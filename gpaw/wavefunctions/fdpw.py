@@ -247,14 +247,17 @@ class FDPWWaveFunctions(WaveFunctions):
             hdf5 = False
         else:
             hdf5 = isinstance(writer, HDF5Writer)
-            
-        if self.world.rank == 0 or hdf5:
+        # Parallel tar-file writer:
+        pwrite = getattr(writer, 'parallel', False)
+        parallel = hdf5 or pwrite
+
+        if self.world.rank == 0 or parallel:
             writer.add('PseudoWaveFunctions',
                        ('nspins', 'nibzkpts', 'nbands',
                         'ngptsx', 'ngptsy', 'ngptsz'),
-                       dtype=self.dtype)
+                       dtype=self.dtype, parallel=pwrite)
 
-        if hdf5:
+        if parallel:
             for kpt in self.kpt_u:
                 indices = [kpt.s, kpt.k]
                 indices.append(self.bd.get_slice())
@@ -3,40 +3,130 @@ from numpy.fft import fftn, ifftn
 import ase.units as units
 
 from gpaw.lfc import LocalizedFunctionsCollection as LFC
+from gpaw.spherical_harmonics import Y
 from gpaw.wavefunctions.fdpw import FDPWWaveFunctions
 from gpaw.hs_operators import MatrixOperator
 
 
 class PWDescriptor:
+    """Plane-wave descriptor.
+
+    With domain decomposition, the G-vectors are distributed over the
+    domain communicator by planes along the first axis, and the 3D FFT's
+    are done in parallel: 2D FFT's of the local planes, an all-to-all
+    transpose to slabs along the second axis, 1D FFT's along the first
+    axis, and finally redistribution of the slabs to the domains of the
+    real-space grid descriptor."""
+
     def __init__(self, ecut, gd, ibzk_qc=[(0, 0, 0)]):
-        assert gd.pbc_c.all() and gd.comm.size == 1
+        assert gd.pbc_c.all()
 
         self.ecut = ecut
 
         assert 0.5 * np.pi**2 / (gd.h_cv**2).sum(1).max() >= ecut
         
-        # Calculate reciprocal lattice vectors:
+        # Distribution of planes along the first and second axes
+        # over the domain communicator:
+        comm = gd.comm
         N_c = gd.N_c
-        i_Qc = np.indices(N_c).transpose((1, 2, 3, 0))
+        self.n0_r = N_c[0] * np.arange(comm.size + 1) // comm.size
+        self.n1_r = N_c[1] * np.arange(comm.size + 1) // comm.size
+        b0, e0 = self.n0_r[comm.rank:comm.rank + 2]
+
+        # Calculate reciprocal lattice vectors:
+        i_Qc = np.indices(N_c).transpose((1, 2, 3, 0))[b0:e0]
         i_Qc += N_c // 2
         i_Qc %= N_c
         i_Qc -= N_c // 2
         B_cv = 2.0 * np.pi * gd.icell_cv
         G_Qv = np.dot(i_Qc, B_cv).reshape((-1, 3))
         G2_Q = (G_Qv**2).sum(axis=1)
-        self.Q_G = np.arange(len(G2_Q))[G2_Q <= 2 * ecut]
-        K_qv = np.dot(ibzk_qc, B_cv)
-        G_Gv = G_Qv[self.Q_G]
+        # Indices into the local planes and into the full grid:
+        self.myQ_G = np.arange(len(G2_Q))[G2_Q <= 2 * ecut]
+        self.Q_G = self.myQ_G + b0 * N_c[1] * N_c[2]
+        self.K_qv = np.dot(ibzk_qc, B_cv)
+        self.G_Gv = G_Qv[self.myQ_G]
         self.G2_qG = np.zeros((len(ibzk_qc), len(self.Q_G)))
-        for q, K_v in enumerate(K_qv):
-            self.G2_qG[q] = ((G_Gv + K_v)**2).sum(1)
+        for q, K_v in enumerate(self.K_qv):
+            self.G2_qG[q] = ((self.G_Gv + K_v)**2).sum(1)
         
         self.gd = gd
         self.dv = gd.dv / N_c.prod()
-        self.comm = gd.comm
+        self.comm = comm
+        self.ngtot = comm.sum(len(self.Q_G))
 
         self.n_c = self.Q_G  # used by hs_operators.py XXX
-        
+
+        # Work array for ifft().  Only the Q_G elements are ever
+        # written to, so the rest stays zero:
+        self.tmp_xQ = None
+
+        if comm.size > 1:
+            self.initialize_transposes()
+
+    def initialize_transposes(self):
+        """Find the pieces to exchange in the parallel FFT's.
+
+        A piece is (rank, send slice, receive slice) for the direction
+        real space to plane waves.  For the other direction, the two
+        slices are swapped."""
+        comm = self.comm
+        gd = self.gd
+        n0_r = self.n0_r
+        n1_r = self.n1_r
+        b1, e1 = n1_r[comm.rank:comm.rank + 2]
+
+        # Planes along the first axis <-> slabs along the second axis:
+        self.transpose_pieces = []
+        for r in range(comm.size):
+            self.transpose_pieces.append(
+                (r,
+                 (Ellipsis, slice(n0_r[r], n0_r[r + 1]), slice(None),
+                  slice(None)),
+                 (Ellipsis, slice(None), slice(n1_r[r], n1_r[r + 1]),
+                  slice(None))))
+
+        # Domains of the grid descriptor <-> slabs along the second axis:
+        self.domain_pieces = []
+        for r in range(comm.size):
+            p_c = np.unravel_index(r, gd.parsize_c)
+            beg_c = [gd.n_cp[c][p_c[c]] for c in range(3)]
+            end_c = [gd.n_cp[c][p_c[c] + 1] for c in range(3)]
+            # Send the part of my domain that is in slab r:
+            y1 = max(gd.beg_c[1], n1_r[r])
+            y2 = max(y1, min(gd.end_c[1], n1_r[r + 1]))
+            send = (Ellipsis, slice(None),
+                    slice(y1 - gd.beg_c[1], y2 - gd.beg_c[1]), slice(None))
+            # Receive the part of domain r that is in my slab:
+            y1 = max(beg_c[1], b1)
+            y2 = max(y1, min(end_c[1], e1))
+            recv = (Ellipsis, slice(beg_c[0], end_c[0]),
+                    slice(y1 - b1, y2 - b1), slice(beg_c[2], end_c[2]))
+            self.domain_pieces.append((r, send, recv))
+
+    def exchange(self, a_x, b_x, pieces, reverse=False):
+        """Send pieces of a_x to the other ranks and receive into b_x."""
+        comm = self.comm
+        requests = []
+        buffers = []
+        for r, send, recv in pieces:
+            if reverse:
+                send, recv = recv, send
+            if r == comm.rank:
+                b_x[recv] = a_x[send]
+                continue
+            sbuf_x = a_x[send].copy()
+            if sbuf_x.size > 0:
+                requests.append(comm.send(sbuf_x, r, 303, block=False))
+            rbuf_x = np.empty(b_x[recv].shape, b_x.dtype)
+            if rbuf_x.size > 0:
+                requests.append(comm.receive(rbuf_x, r, 303, block=False))
+            # Keep the buffers alive until the requests are done:
+            buffers.append((sbuf_x, recv, rbuf_x))
+        comm.waitall(requests)
+        for sbuf_x, recv, rbuf_x in buffers:
+            b_x[recv] = rbuf_x
+
     def bytecount(self, dtype=float):
         return len(self.Q_G) * np.array(1, dtype).itemsize
     
@@ -55,14 +145,57 @@ class PWDescriptor:
         return np.empty(shape, complex)
     
     def fft(self, a_xR):
+        """Transform one or more functions to plane waves."""
+        if self.comm.size > 1:
+            return self.parallel_fft(a_xR)
         a_xQ = fftn(a_xR, axes=(-3, -2, -1))
-        return a_xQ.reshape(a_xR.shape[:-3] + (-1,))[..., self.Q_G].copy()
+        return a_xQ.reshape(a_xR.shape[:-3] + (-1,)).take(self.Q_G, axis=-1)
 
     def ifft(self, a_xG):
+        """Transform one or more functions to the real-space grid.
+
+        Transforming a block of functions with one call is much faster
+        than doing them one by one."""
+        if self.comm.size > 1:
+            return self.parallel_ifft(a_xG)
+        xshape = a_xG.shape[:-1]
+        nx = int(np.prod(xshape))
+        if self.tmp_xQ is None or len(self.tmp_xQ) < nx:
+            self.tmp_xQ = self.gd.zeros(nx, complex)
+        a_xQ = self.tmp_xQ[:nx].reshape(xshape + (-1,))
+        a_xQ[..., self.Q_G] = a_xG
+        return ifftn(a_xQ.reshape(xshape + tuple(self.gd.N_c)),
+                     axes=(-3, -2, -1))
+
+    def parallel_fft(self, a_xR):
+        xshape = a_xR.shape[:-3]
+        rank = self.comm.rank
+        N0, N1, N2 = self.gd.N_c
+        n1 = self.n1_r[rank + 1] - self.n1_r[rank]
+        n0 = self.n0_r[rank + 1] - self.n0_r[rank]
+        a_xQ = np.empty(xshape + (N0, n1, N2), complex)
+        self.exchange(a_xR, a_xQ, self.domain_pieces)
+        a_xQ = fftn(a_xQ, axes=(-3,))
+        b_xQ = np.empty(xshape + (n0, N1, N2), complex)
+        self.exchange(a_xQ, b_xQ, self.transpose_pieces)
+        b_xQ = fftn(b_xQ, axes=(-2, -1))
+        return b_xQ.reshape(xshape + (-1,)).take(self.myQ_G, axis=-1)
+
+    def parallel_ifft(self, a_xG):
         xshape = a_xG.shape[:-1]
-        a_xQ = self.gd.zeros(xshape, complex)
-        a_xQ.reshape(xshape + (-1,))[..., self.Q_G] = a_xG
-        return ifftn(a_xQ, axes=(-3, -2, -1)).copy()
+        rank = self.comm.rank
+        N0, N1, N2 = self.gd.N_c
+        n1 = self.n1_r[rank + 1] - self.n1_r[rank]
+        n0 = self.n0_r[rank + 1] - self.n0_r[rank]
+        b_xQ = np.zeros(xshape + (n0 * N1 * N2,), complex)
+        b_xQ[..., self.myQ_G] = a_xG
+        b_xQ = ifftn(b_xQ.reshape(xshape + (n0, N1, N2)), axes=(-2, -1))
+        a_xQ = np.empty(xshape + (N0, n1, N2), complex)
+        self.exchange(b_xQ, a_xQ, self.transpose_pieces, reverse=True)
+        a_xQ = ifftn(a_xQ, axes=(-3,))
+        a_xR = self.gd.empty(xshape, complex)
+        self.exchange(a_xQ, a_xR, self.domain_pieces, reverse=True)
+        return a_xR
 
 
 class Preconditioner:
@@ -75,6 +208,9 @@ class Preconditioner:
 
 
 class PWWaveFunctions(FDPWWaveFunctions):
+    # Number of bands to transform together:
+    fft_blocksize = 8
+
     def __init__(self, ecut, diagksl, orthoksl, initksl,
                  gd, nvalence, setups, bd,
                  world, kd, timer):
@@ -94,12 +230,12 @@ class PWWaveFunctions(FDPWWaveFunctions):
         self.pd = PWDescriptor(self.ecut, self.gd, self.kd.ibzk_qc)
         pt = LFC(self.gd, [setup.pt_j for setup in setups],
                  self.kpt_comm, dtype=self.dtype, forces=True)
-        self.pt = PWLFC(pt, self.pd)
+        self.pt = PWLFC(pt, self.pd, [setup.pt_j for setup in setups])
         FDPWWaveFunctions.set_setups(self, setups)
 
     def summary(self, fd):
         fd.write('Mode: Plane waves (%d, ecut=%.3f eV)\n' %
-                 (len(self.pd.Q_G), self.pd.ecut * units.Hartree))
+                 (self.pd.ngtot, self.pd.ecut * units.Hartree))
         
     def make_preconditioner(self, block=1):
         return Preconditioner(self.pd)
@@ -107,14 +243,22 @@ class PWWaveFunctions(FDPWWaveFunctions):
     def apply_pseudo_hamiltonian(self, kpt, hamiltonian, psit_xG, Htpsit_xG):
         """Apply the non-pseudo Hamiltonian i.e. without PAW corrections."""
         Htpsit_xG[:] = 0.5 * self.pd.G2_qG[kpt.q] * psit_xG
-        for psit_G, Htpsit_G in zip(psit_xG, Htpsit_xG):
-            psit_R = self.pd.ifft(psit_G)
-            Htpsit_G += self.pd.fft(psit_R * hamiltonian.vt_sG[kpt.s])
+        vt_R = hamiltonian.vt_sG[kpt.s]
+        for x1 in range(0, len(psit_xG), self.fft_blocksize):
+            x2 = x1 + self.fft_blocksize
+            psit_xR = self.pd.ifft(psit_xG[x1:x2])
+            psit_xR *= vt_R
+            Htpsit_xG[x1:x2] += self.pd.fft(psit_xR)
 
     def add_to_density_from_k_point_with_occupation(self, nt_sR, kpt, f_n):
         nt_R = nt_sR[kpt.s]
-        for f, psit_G in zip(f_n, kpt.psit_nG):
-            nt_R += f * abs(self.pd.ifft(psit_G))**2
+        for n1 in range(0, len(f_n), self.fft_blocksize):
+            n2 = n1 + self.fft_blocksize
+            psit_nR = self.pd.ifft(kpt.psit_nG[n1:n2])
+            n2 = n1 + len(psit_nR)
+            nt_R += np.dot(f_n[n1:n2],
+                           (psit_nR.real**2 + psit_nR.imag**2).reshape(
+                               (n2 - n1, -1))).reshape(nt_R.shape)
 
     def initialize_wave_functions_from_basis_functions(self, basis_functions,
                                                        density, hamiltonian,
@@ -126,10 +270,94 @@ class PWWaveFunctions(FDPWWaveFunctions):
             kpt.psit_nG = self.pd.fft(kpt.psit_nG)
 
 
+def spherical_bessel(l, x_x):
+    """Spherical Bessel function j_l(x) for an array of x >= 0."""
+    x_x = np.asarray(x_x, float)
+    j_x = np.empty_like(x_x)
+
+    # Power series for small x (the closed forms are unstable there):
+    small_x = x_x < 1.0
+    x2_x = x_x[small_x]**2
+    term_x = x_x[small_x]**l / np.prod(np.arange(1, 2 * l + 2, 2))
+    j_x[small_x] = term_x
+    for k in range(1, 15):
+        term_x = term_x * (-0.5 * x2_x / (k * (2 * l + 2 * k + 1)))
+        j_x[small_x] += term_x
+
+    # Upward recurrence from j_0 and j_1:
+    x_x = x_x[~small_x]
+    ja_x = np.sin(x_x) / x_x
+    if l == 0:
+        j_x[~small_x] = ja_x
+        return j_x
+    jb_x = (ja_x - np.cos(x_x)) / x_x
+    for n in range(1, l):
+        ja_x, jb_x = jb_x, (2 * n + 1) / x_x * jb_x - ja_x
+    j_x[~small_x] = jb_x
+    return j_x
+
+
+def fourier_bessel_transform(spline, qmax, dq=0.001, ng=500):
+    """Radial Fourier-Bessel transform of spline.
+
+    Returns the grid q_x and::
+
+                   rc
+              1    /  2+l             
+      f(q) = ---   | r    f(r) j (qr) dr
+              l    /            l
+             q     0
+
+    on that grid.  Dividing by q^l keeps f(q) finite at q=0 - the
+    missing q^l is included with the solid spherical harmonic."""
+
+    l = spline.get_angular_momentum_number()
+    r_g = np.linspace(0.0, spline.get_cutoff(), ng)
+    dr = r_g[1]
+    w_g = spline.map(r_g) * r_g**(2 + l) * dr
+    w_g[[0, -1]] *= 0.5
+    q_x = np.arange(int(qmax / dq) + 2) * dq
+    f_x = np.empty(len(q_x))
+    f_x[0] = np.dot(w_g, r_g**l) / np.prod(np.arange(1, 2 * l + 2, 2))
+    f_x[1:] = np.dot(spherical_bessel(l, np.outer(q_x[1:], r_g)),
+                     w_g) / q_x[1:]**l
+    return q_x, f_x
+
+
 class PWLFC:
-    def __init__(self, lfc, pd):
+    """PAW projector functions in reciprocal space.
+
+    The projector functions of each species are Fourier-Bessel
+    transformed once and tabulated for all G+k vectors of every k-point::
+
+       a            l               ^       -i(G+k).R
+      p (G+k) = 4pi(-i) f(|G+k|) Y (G+k) e          a
+       i                          L
+
+    so that add() and integrate() become matrix products with the
+    plane-wave coefficients - no FFT's needed.  The real-space LFC
+    object is kept for dict() and atom distribution.
+
+    With domain decomposition, every rank holds a part of the
+    G-vectors for all atoms, and the projections are summed over the
+    domain communicator."""
+
+    def __init__(self, lfc, pd, spline_aj):
         self.lfc = lfc
         self.pd = pd
+        self.spline_aj = spline_aj
+        self.comm = pd.comm
+
+        # Offsets of the atoms in an array of all projections:
+        ni_a = [sum([2 * spline.get_angular_momentum_number() + 1
+                     for spline in spline_j])
+                for spline_j in spline_aj]
+        self.I_a = np.cumsum([0] + ni_a)
+
+        # Number of grid points and volume element.  The transforms
+        # in PWDescriptor are unnormalized:
+        self.N = pd.gd.N_c.prod()
+        self.dv = pd.gd.dv
 
     def dict(self, shape=(), derivative=False, zero=False):
         return self.lfc.dict(shape, derivative, zero)
@@ -137,22 +365,73 @@ class PWLFC:
     def set_positions(self, spos_ac):
         self.lfc.set_positions(spos_ac)
         self.my_atom_indices = self.lfc.my_atom_indices
+        self.pos_av = np.dot(spos_ac, self.pd.gd.cell_cv)
         
     def set_k_points(self, ibzk_qc):
         self.lfc.set_k_points(ibzk_qc)
-        N_c = self.pd.gd.N_c
-        self.expikr_qR = np.exp(2j * np.pi * np.dot(np.indices(N_c).T,
-                                                    (ibzk_qc / N_c).T).T)
+
+        # Species are identified by their list of splines:
+        spline_sj = dict((id(spline_j), spline_j)
+                         for spline_j in self.spline_aj)
+        self.s_a = [id(spline_j) for spline_j in self.spline_aj]
+
+        pd = self.pd
+        qmax = (2 * pd.ecut)**0.5 + max([(K_v**2).sum()**0.5
+                                         for K_v in pd.K_qv]) + 0.01
+        self.Gk_qGv = [pd.G_Gv + K_v for K_v in pd.K_qv]
+        self.f_qsGi = [{} for K_v in pd.K_qv]
+        for s, spline_j in spline_sj.items():
+            for spline in spline_j:
+                q_x, f_x = fourier_bessel_transform(spline, qmax)
+                l = spline.get_angular_momentum_number()
+                for q, Gk_Gv in enumerate(self.Gk_qGv):
+                    f_G = 4 * np.pi * (-1j)**l * np.interp(pd.G2_qG[q]**0.5,
+                                                           q_x, f_x)
+                    f_iG = [f_G * Y(L, *Gk_Gv.T)
+                            for L in range(l**2, (l + 1)**2)]
+                    self.f_qsGi[q].setdefault(s, []).extend(f_iG)
+        for f_sGi in self.f_qsGi:
+            for s, f_iG in f_sGi.items():
+                f_sGi[s] = np.array(f_iG).T.copy()
+
+    def get_projectors(self, a, q):
+        """Projector functions of atom a at k-point q."""
+        eikR_G = np.exp(-1j * np.dot(self.Gk_qGv[q], self.pos_av[a]))
+        return self.f_qsGi[q][self.s_a[a]] * eikR_G[:, None]
 
     def add(self, a_xG, C_axi, q):
-        a_xR = self.pd.gd.zeros(a_xG.shape[:-1], complex)
-        self.lfc.add(a_xR, C_axi, q)
-        a_xG[:] += self.pd.fft(a_xR / self.expikr_qR[q])
+        if self.comm.size == 1:
+            for a, C_xi in C_axi.items():
+                p_Gi = self.get_projectors(a, q)
+                a_xG += np.dot(C_xi, p_Gi.T) / self.dv
+            return
+
+        # All ranks need the coefficients of all atoms:
+        C_xI = np.zeros(a_xG.shape[:-1] + (self.I_a[-1],), complex)
+        for a, C_xi in C_axi.items():
+            C_xI[..., self.I_a[a]:self.I_a[a + 1]] = C_xi
+        self.comm.sum(C_xI)
+        for a in range(len(self.spline_aj)):
+            p_Gi = self.get_projectors(a, q)
+            a_xG += np.dot(C_xI[..., self.I_a[a]:self.I_a[a + 1]],
+                           p_Gi.T) / self.dv
 
     def integrate(self, a_xG, C_axi, q):
-        a_xR = self.pd.ifft(a_xG) * self.expikr_qR[q]
-        C_axi[0][:] = 0.0  # XXXXX
-        self.lfc.integrate(a_xR, C_axi, q)
+        if self.comm.size == 1:
+            for a, C_xi in C_axi.items():
+                p_Gi = self.get_projectors(a, q)
+                C_xi[:] = np.dot(a_xG, p_Gi.conj()) / self.N
+            return
+
+        C_xI = np.empty(a_xG.shape[:-1] + (self.I_a[-1],), complex)
+        for a in range(len(self.spline_aj)):
+            p_Gi = self.get_projectors(a, q)
+            C_xI[..., self.I_a[a]:self.I_a[a + 1]] = np.dot(a_xG,
+                                                            p_Gi.conj())
+        self.comm.sum(C_xI)
+        C_xI /= self.N
+        for a, C_xi in C_axi.items():
+            C_xi[:] = C_xI[..., self.I_a[a]:self.I_a[a + 1]]
 
 
 class PW: ####### use mode='pw'?  ecut=???
@@ -72,6 +72,40 @@ class GGA(LDA):
         v_sg += vv_sg
         return rgd.integrate(e_g), rd_vsg, dedsigma_xg
 
+    def calculate_radial_expansion(self, rgd, n_sLg, Y_nL, v_sng,
+                                   dndr_sLg, rnablaY_nLv):
+        nspins = len(n_sLg)
+        n_sng = np.rollaxis(np.dot(Y_nL, n_sLg), 0, -1).copy()
+        rd_vsng = np.rollaxis(np.dot(rnablaY_nLv.transpose((2, 0, 1)),
+                                     n_sLg), 1, -1)
+        sigma_xng = np.empty((2 * nspins - 1,) + n_sng.shape[1:])
+        sigma_xng[::2] = (rd_vsng**2).sum(0)
+        if nspins == 2:
+            sigma_xng[1] = (rd_vsng[:, 0] * rd_vsng[:, 1]).sum(0)
+        sigma_xng[..., 1:] /= rgd.r_g[1:]**2
+        sigma_xng[..., 0] = sigma_xng[..., 1]
+        d_sng = np.rollaxis(np.dot(Y_nL, dndr_sLg), 0, -1)
+        sigma_xng[::2] += d_sng**2
+        if nspins == 2:
+            sigma_xng[1] += d_sng[0] * d_sng[1]
+        e_ng = np.empty(n_sng.shape[1:])
+        dedsigma_xng = np.zeros_like(sigma_xng)
+        self.kernel.calculate(e_ng, n_sng, v_sng, sigma_xng, dedsigma_xng)
+        vv_sng = sigma_xng[:nspins]  # reuse array
+        for s in range(nspins):
+            rgd.derivative2(-2 * rgd.dv_g * dedsigma_xng[2 * s] * d_sng[s],
+                            vv_sng[s])
+        if nspins == 2:
+            v_ng = sigma_xng[2]
+            rgd.derivative2(rgd.dv_g * dedsigma_xng[1] * d_sng[1], v_ng)
+            vv_sng[0] -= v_ng
+            rgd.derivative2(rgd.dv_g * dedsigma_xng[1] * d_sng[0], v_ng)
+            vv_sng[1] -= v_ng
+        vv_sng[..., 1:] /= rgd.dv_g[1:]
+        vv_sng[..., 0] = vv_sng[..., 1]
+        v_sng += vv_sng
+        return np.dot(e_ng, rgd.dv_g), rd_vsng, dedsigma_xng
+
     def calculate_spherical(self, rgd, n_sg, v_sg, e_g=None):
         dndr_sg = np.empty_like(n_sg)
         for n_g, dndr_g in zip(n_sg, dndr_sg):
@@ -5,6 +5,8 @@
 evaluation of exact exchange.
 """
 
+from math import pi
+
 import numpy as np
 
 from gpaw.xc import XC
@@ -12,7 +14,10 @@ from gpaw.xc.kernel import XCNull
 from gpaw.xc.functional import XCFunctional
 from gpaw.poisson import PoissonSolver
 from gpaw.utilities import hartree, pack, pack2, unpack, unpack2, packed_index
+from gpaw.utilities import erf
 from gpaw.utilities.tools import symmetrize
+from gpaw.utilities.ewald import madelung
+from gpaw.utilities.parallel_fft import ParallelFFT
 from gpaw.atom.configurations import core_states
 from gpaw.lfc import LFC
 from gpaw.utilities.blas import gemm
@@ -21,7 +26,8 @@ from gpaw.gaunt import make_gaunt
 
 class HybridXC(XCFunctional):
     orbital_dependent = True
-    def __init__(self, name, hybrid=None, xc=None, finegrid=False):
+    def __init__(self, name, hybrid=None, xc=None, finegrid=False,
+                 coulomb=None, memory=2**28):
         """Mix standard functionals with exact exchange.
 
         name: str
@@ -32,6 +38,14 @@ class HybridXC(XCFunctional):
             Standard DFT functional with scaled down exchange.
         finegrid: boolean
             Use fine grid for energy functional evaluations?
+        coulomb: None or str
+            Use 'fft' to get the potentials of batches of pair densities
+            with FFT's (on a doubled grid for non-periodic cells).  The
+            default is the multigrid Poisson solver, starting from the
+            pair potentials of the previous iteration.
+        memory: int
+            Number of bytes to use for batches of pair densities and
+            for stored pair potentials.
         """
 
         if name == 'EXX':
@@ -54,6 +68,10 @@ class HybridXC(XCFunctional):
         self.xc = xc
         self.type = xc.type
         self.finegrid = finegrid
+        self.coulomb = coulomb
+        self.memory = memory
+        self.vt_pg = {}
+        self.C_sii = {}
 
         XCFunctional.__init__(self, name)
 
@@ -65,6 +83,11 @@ class HybridXC(XCFunctional):
                          tau_sg=None, dedtau_sg=None):
         return self.xc.calculate_radial(rgd, n_sLg, Y_L, v_sg,
                                         dndr_sLg, rnablaY_Lv)
+
+    def calculate_radial_expansion(self, rgd, n_sLg, Y_nL, v_sng,
+                                   dndr_sLg=None, rnablaY_nLv=None):
+        return self.xc.calculate_radial_expansion(rgd, n_sLg, Y_nL, v_sng,
+                                                  dndr_sLg, rnablaY_nLv)
     
     def initialize(self, density, hamiltonian, wfs, occupations):
         assert wfs.gamma
@@ -92,6 +115,126 @@ class HybridXC(XCFunctional):
                             integral=np.sqrt(4 * np.pi), forces=True)
         self.gd = density.gd
         self.finegd = self.ghat.gd
+        self.vt_pg = {}
+        self.C_sii = {}
+        if self.coulomb == 'fft':
+            self.initialize_fft()
+        else:
+            assert self.coulomb is None
+
+    def initialize_fft(self):
+        """Coulomb kernel for FFT solutions of the pair potentials.
+
+        Non-periodic cells are doubled in all directions, so that the
+        1/r kernel does not couple periodic images.  The FFT's are
+        distributed over the domains and every process holds only its
+        slab of the kernel."""
+        gd = self.finegd
+        self.N_c = gd.get_size_of_global_array()
+        if gd.pbc_c.all():
+            self.shape = tuple(self.N_c)
+            self.madelung = madelung(gd.cell_cv)
+        elif not gd.pbc_c.any():
+            self.shape = tuple(2 * self.N_c)
+        else:
+            raise NotImplementedError('Mixed boundary conditions')
+
+        self.fft = pfft = ParallelFFT(self.shape, gd)
+
+        # Squared G-vectors of our slab of the Fourier grid.  On the
+        # Nyquist planes G and -G are different vectors for skewed cells,
+        # so kernels are averaged over both:
+        i_c = [np.arange(self.shape[0]),
+               np.arange(pfft.y1, pfft.y2),
+               np.arange(self.shape[2] // 2 + 1)]
+        G2_sk = []
+        for sign in [1, -1]:
+            G_vk = 0.0
+            for c, i in enumerate(i_c):
+                M = self.shape[c]
+                i = (sign * i + M // 2) % M - M // 2
+                B_v = 2 * pi * np.linalg.inv(gd.h_cv).T[c] / M
+                G_vk = G_vk + (B_v[:, np.newaxis, np.newaxis, np.newaxis] *
+                               i.reshape([-1 if c2 == c else 1
+                                          for c2 in range(3)]))
+            G2_sk.append((G_vk**2).sum(0))
+        zero_k = G2_sk[0] == 0.0
+        for G2_k in G2_sk:
+            G2_k[zero_k] = 1.0
+
+        def average(kernel):
+            return 0.5 * (kernel(G2_sk[0]) + kernel(G2_sk[1]))
+
+        if gd.pbc_c.all():
+            self.K_k = average(lambda G2_k: 4 * pi / G2_k)
+            self.K_k[zero_k] = 0.0
+            return
+
+        # 1/r = erf(r/a)/r + erfc(r/a)/r: the smooth long range part is
+        # sampled on our slab of the doubled grid and the short range
+        # part is added in reciprocal space
+        a = 2.5 * ((gd.h_cv**2).sum(1)**0.5).max()
+        i_cx = np.indices((pfft.x2 - pfft.x1,) + self.shape[1:])
+        i_cx[0] += pfft.x1
+        for c, M in enumerate(self.shape):
+            i_cx[c] = (i_cx[c] + M // 2) % M - M // 2
+        r_x = np.sqrt((np.dot(i_cx.reshape((3, -1)).T, gd.h_cv)**2).sum(1))
+        r_x = r_x.reshape(i_cx.shape[1:])
+        origin_x = r_x == 0.0
+        r_x[origin_x] = 1.0
+        K_x = 1.0 / r_x
+        close_x = r_x < 8 * a
+        K_x[close_x] *= erf(r_x[close_x] / a)
+        K_x[origin_x] = 2 / np.sqrt(pi) / a
+        S_k = average(lambda G2_k:
+                       4 * pi * (1 - np.exp(-G2_k * a**2 / 4)) / G2_k)
+        S_k[zero_k] = pi * a**2
+        self.K_k = pfft.rfftn(K_x).real * gd.dv + S_k
+
+    def get_pairs_per_batch(self):
+        """Number of pair densities that fit in self.memory bytes."""
+        nbytes = 8 * (self.gd.n_c.prod() + 2 * self.finegd.n_c.prod())
+        if self.coulomb == 'fft':
+            # work arrays on our slab
+            nbytes += 3 * 16 * np.prod(self.fft.kshape)
+        return max(1, self.memory // nbytes)
+
+    def calculate_pair_potentials(self, s, pairs, rhot_xg):
+        """Potentials of -rhot_xg for the pairs (n1, n2).
+
+        With FFT's, the whole batch is moved to the slabs and
+        transformed with the distributed FFT in one go.  Without FFT's, every pair is solved with the
+        multigrid Poisson solver starting from its potential of the last
+        call, as far as these fit in self.memory bytes."""
+        gd = self.finegd
+        vt_xg = gd.zeros(len(pairs))
+        if self.coulomb == 'fft':
+            pfft = self.fft
+            N0, N1, N2 = self.N_c
+            rho_xx = pfft.domain_to_slab(-rhot_xg)
+            v_xx = pfft.irfftn(pfft.rfftn(rho_xx) * self.K_k)
+            vt_xg[:] = pfft.slab_to_domain(v_xx[:, :pfft.nx, :N1, :N2])
+            if gd.pbc_c.all():
+                # same shift as the multigrid solver for charged pairs
+                for vt_g, (n1, n2) in zip(vt_xg, pairs):
+                    if n1 == n2:
+                        vt_g -= self.madelung
+            return vt_xg
+
+        nstore = self.memory // (2 * 8 * gd.n_c.prod())
+        for vt_g, rhot_g, (n1, n2) in zip(vt_xg, rhot_xg, pairs):
+            vt0_g = self.vt_pg.get((s, n1, n2))
+            if vt0_g is not None:
+                vt_g[:] = vt0_g
+            self.poissonsolver.solve(vt_g, -rhot_g,
+                                     charge=-float(n1 == n2),
+                                     eps=1e-12,
+                                     zero_initial_phi=vt0_g is None)
+            if vt0_g is not None:
+                vt0_g[:] = vt_g
+            elif len(self.vt_pg) < nstore:
+                self.vt_pg[(s, n1, n2)] = vt_g.copy()
+        return vt_xg
 
     def set_positions(self, spos_ac):
         if not self.finegrid:
@@ -118,7 +261,6 @@ class HybridXC(XCFunctional):
         P_ani = kpt.P_ani
         setups = self.setups
 
-        vt_g = self.finegd.empty()
         if self.gd is not self.finegd:
             vt_G = self.gd.empty()
 
@@ -137,23 +279,31 @@ class HybridXC(XCFunctional):
         exx = 0.0
         ekin = 0.0
 
-        # Determine pseudo-exchange
-        for n1 in range(nocc):
-            psit1_G = psit_nG[n1]
-            for n2 in range(n1, nocc):
+        # Determine pseudo-exchange for batches of pairs
+        pairs = [(n1, n2) for n1 in range(nocc) for n2 in range(n1, nocc)]
+        npairs = self.get_pairs_per_batch()
+        for p0 in range(0, len(pairs), npairs):
+            batch = pairs[p0:p0 + npairs]
+            nt_xG = self.gd.empty(len(batch))
+            rhot_xg = self.finegd.empty(len(batch))
+            for nt_G, rhot_g, (n1, n2) in zip(nt_xG, rhot_xg, batch):
+                nt_G[:], rhot_g[:] = self.calculate_pair_density(
+                    n1, n2, psit_nG, P_ani)
+            vt_xg = self.calculate_pair_potentials(kpt.s, batch, rhot_xg)
+            vt_xg *= hybrid
+            if Htpsit_nG is not None:
+                v_axL = self.ghat.dict(len(batch))
+                self.ghat.integrate(vt_xg, v_axL)
+
+            for x, (n1, n2) in enumerate(batch):
+                nt_G = nt_xG[x]
+                rhot_g = rhot_xg[x]
+                vt_g = vt_xg[x]
+                psit1_G = psit_nG[n1]
                 psit2_G = psit_nG[n2]
 
                 # Double count factor:
                 dc = (1 + (n1 != n2)) * deg
-                
-                nt_G, rhot_g = self.calculate_pair_density(n1, n2, psit_nG,
-                                                           P_ani)
-                vt_g[:] = 0.0
-                iter = self.poissonsolver.solve(vt_g, -rhot_g,
-                                                charge=-float(n1 == n2),
-                                                eps=1e-12,
-                                                zero_initial_phi=True)
-                vt_g *= hybrid
 
                 if self.gd is self.finegd:
                     vt_G = vt_g
@@ -176,10 +326,8 @@ class HybridXC(XCFunctional):
                     # Update the vxx_uni and vxx_unii vectors of the nuclei,
                     # used to determine the atomic hamiltonian, and the 
                     # residuals
-                    v_aL = self.ghat.dict()
-                    self.ghat.integrate(vt_g, v_aL)
-                    for a, v_L in v_aL.items():
-                        v_ii = unpack(np.dot(setups[a].Delta_pL, v_L))
+                    for a, v_xL in v_axL.items():
+                        v_ii = unpack(np.dot(setups[a].Delta_pL, v_xL[x]))
                         v_ni = kpt.vxx_ani[a]
                         v_nii = kpt.vxx_anii[a]
                         P_ni = P_ani[a]
@@ -210,19 +358,14 @@ class HybridXC(XCFunctional):
             # --
             # >  D   C     D
             # --  ii  iiii  ii
-            for i1 in range(ni):
-                for i2 in range(ni):
-                    A = 0.0
-                    for i3 in range(ni):
-                        p13 = packed_index(i1, i3, ni)
-                        for i4 in range(ni):
-                            p24 = packed_index(i2, i4, ni)
-                            A += setup.M_pp[p13, p24] * D_ii[i3, i4]
-                    p12 = packed_index(i1, i2, ni)
-                    if Htpsit_nG is not None:
-                        dH_p[p12] -= 2 * hybrid / deg * A / ((i1 != i2) + 1)
-                    ekin += 2 * hybrid / deg * D_ii[i1, i2] * A
-                    exx -= hybrid / deg * D_ii[i1, i2] * A
+            A_ii = np.dot(self.get_exchange_tensor(setup),
+                          D_ii.ravel()).reshape((ni, ni))
+            if Htpsit_nG is not None:
+                i1_p, i2_p = np.triu_indices(ni)
+                dH_p -= hybrid / deg * (A_ii + A_ii.T)[i1_p, i2_p]
+            DA = np.vdot(D_ii, A_ii)
+            ekin += 2 * hybrid / deg * DA
+            exx -= hybrid / deg * DA
             
             # Add valence-core exchange energy
             # --
@@ -241,6 +384,20 @@ class HybridXC(XCFunctional):
         self.exx_s[kpt.s] = self.gd.comm.sum(exx)
         self.ekin_s[kpt.s] = self.gd.comm.sum(ekin)
 
+    def get_exchange_tensor(self, setup):
+        """Unpacked M_pp as a (i1 i2, i3 i4) matrix.
+
+        C_i1i2i3i4 = M_p13p24.  The tensors are shared by atoms of the
+        same setup."""
+        if setup not in self.C_sii:
+            ni = setup.ni
+            p_ii = np.array([[packed_index(i1, i2, ni) for i2 in range(ni)]
+                             for i1 in range(ni)])
+            C_iiii = setup.M_pp[p_ii[:, np.newaxis, :, np.newaxis],
+                                p_ii[np.newaxis, :, np.newaxis, :]]
+            self.C_sii[setup] = C_iiii.reshape((ni**2, ni**2))
+        return self.C_sii[setup]
+
     def correct_hamiltonian_matrix(self, kpt, H_nn):
         if not hasattr(kpt, 'vxx_ani'):
             return
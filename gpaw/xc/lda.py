@@ -31,6 +31,18 @@ class LDA(XCFunctional):
         self.kernel.calculate(e_g, n_sg, v_sg)
         return rgd.integrate(e_g)
 
+    def calculate_radial_expansion(self, rgd, n_sLg, Y_nL, v_sng,
+                                   dndr_sLg=None, rnablaY_nLv=None):
+        """Evaluate kernel for all expansion points in one go.
+
+        ``n_sLg`` may have extra axes between s and L (several atoms).
+        They end up in front of the n-axis of ``v_sng`` and of the
+        returned array of radial integrals of the energy density."""
+        n_sng = np.rollaxis(np.dot(Y_nL, n_sLg), 0, -1).copy()
+        e_ng = np.empty(n_sng.shape[1:])
+        self.kernel.calculate(e_ng, n_sng, v_sng)
+        return np.dot(e_ng, rgd.dv_g)
+
     def calculate_spherical(self, rgd, n_sg, v_sg, e_g=None):
         return self.calculate_radial(rgd, n_sg[:, np.newaxis], [1.0], v_sg,
                                      e_g=e_g)
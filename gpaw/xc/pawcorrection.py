@@ -89,6 +89,7 @@ class PAWXCCorrection:
                 p += 1
             i1 += 1
         self.B_pqL = B_Lqp.T.copy()
+        self.B_Lqp = B_Lqp
 
         #
         self.n_qg = np.zeros((njj, ng))
@@ -118,6 +119,18 @@ class PAWXCCorrection:
         if type == 'GLLB':
             return xc.calculate_energy_and_derivatives(D_sp, dH_sp, a)
 
+        if type in ['LDA', 'GGA']:
+            return self.calculate_many(xc, D_sp[np.newaxis],
+                                       dH_sp[np.newaxis],
+                                       addcoredensity=addcoredensity)[0]
+
+        return self.calculate_point_by_point(xc, D_sp, dH_sp, addcoredensity)
+
+    def calculate_point_by_point(self, xc, D_sp, dH_sp, addcoredensity=True):
+        """Calculate correction one Lebedev point at a time.
+
+        Used for MGGA and as reference for calculate_many()."""
+        type = xc.type
         nspins = len(D_sp)
         de = 0.0
         D_sLq = np.inner(D_sp, self.B_pqL.T)
@@ -183,6 +196,87 @@ class PAWXCCorrection:
             de -= self.Exc0
         return de
 
+    def calculate_many(self, xc, D_asp, dH_asp, a_x=None,
+                       addcoredensity=True):
+        """Calculate corrections for several atoms sharing this setup.
+
+        ``D_asp`` and ``dH_asp`` are arrays of shape (natoms, nspins,
+        nii).  The corrections to the Hamiltonians are added to
+        ``dH_asp`` and the energies are returned as an array.  For LDA
+        and GGA, the densities of all Lebedev points (and of blocks of
+        atoms) are stacked so that the kernel is called only once per
+        block.  Other functionals are done one atom at a time
+        (``a_x`` holds the atom indices)."""
+
+        if xc.type not in ['LDA', 'GGA']:
+            if a_x is None:
+                a_x = [None] * len(D_asp)
+            return np.array([self.calculate(xc, D_sp, dH_sp, a,
+                                            addcoredensity)
+                             for D_sp, dH_sp, a in zip(D_asp, dH_asp, a_x)])
+
+        natoms, nspins = D_asp.shape[:2]
+        e_a = np.empty(natoms)
+        # Keep the (nspins, natoms, npoints, ng) arrays below 2**20 numbers:
+        mynatoms = max(1, 2**20 // (nspins * len(self.Y_nL) * self.ng))
+        for a1 in range(0, natoms, mynatoms):
+            a2 = min(a1 + mynatoms, natoms)
+            e_a[a1:a2] = self.calculate_expansion(
+                xc, D_asp[a1:a2].transpose((1, 0, 2)),
+                dH_asp[a1:a2], addcoredensity)
+        return e_a
+
+    def calculate_expansion(self, xc, D_sap, dH_asp, addcoredensity):
+        nspins = len(D_sap)
+        gga = xc.type == 'GGA'
+        D_saLq = np.inner(D_sap, self.B_pqL.T)
+        dH_sap = 0.0
+        e_a = 0.0
+        sign = 1
+        for n_qg, nc_g in [(self.n_qg, self.nc_g), (self.nt_qg, self.nct_g)]:
+            n_saLg = np.dot(D_saLq, n_qg)
+            if addcoredensity:
+                n_saLg[:, :, 0] += sqrt(4 * pi) / nspins * nc_g
+            if self.nc_corehole_g is not None and nspins == 2 and sign == 1:
+                n_saLg[0, :, 0] -= 0.5 * sqrt(4 * pi) * self.nc_corehole_g
+                n_saLg[1, :, 0] += 0.5 * sqrt(4 * pi) * self.nc_corehole_g
+            v_sang = np.zeros(n_saLg.shape[:2] + (len(self.Y_nL), self.ng))
+            w_n = sign * weight_n
+            if gga:
+                dndr_saLg = np.empty_like(n_saLg)
+                self.rgd.derivative(n_saLg, dndr_saLg)
+                e_an, rd_vsang, dedsigma_xang = xc.calculate_radial_expansion(
+                    self.rgd, n_saLg, self.Y_nL, v_sang,
+                    dndr_saLg, self.rnablaY_nLv)
+            else:
+                e_an = xc.calculate_radial_expansion(self.rgd, n_saLg,
+                                                     self.Y_nL, v_sang)
+            e_a += np.dot(e_an, w_n)
+
+            # Project the potential back on the spherical harmonics:
+            v_sagL = np.tensordot(v_sang, w_n[:, np.newaxis] * self.Y_nL,
+                                  axes=([2], [0]))
+            v_sagL *= self.dv_g[:, np.newaxis]
+            if gga:
+                v_vsang = dedsigma_xang[::2] * rd_vsang
+                if nspins == 2:
+                    v_vsang += 0.5 * dedsigma_xang[1] * rd_vsang[:, ::-1]
+                rnablaY_nLv = (8 * pi * w_n[:, np.newaxis, np.newaxis] *
+                               self.rnablaY_nLv)
+                vv_sagL = np.tensordot(v_vsang, rnablaY_nLv,
+                                       axes=([0, 3], [2, 0]))
+                vv_sagL *= self.rgd.dr_g[:, np.newaxis]
+                v_sagL += vv_sagL
+            dH_saLq = np.inner(v_sagL.transpose((0, 1, 3, 2)), n_qg)
+            dH_sap += np.dot(dH_saLq.reshape(dH_saLq.shape[:2] + (-1,)),
+                             self.B_Lqp.reshape((-1, self.nii)))
+            sign = -1
+
+        dH_asp += dH_sap.transpose((1, 0, 2))
+        if addcoredensity:
+            e_a -= self.Exc0
+        return e_a
+
     def four_phi_integrals(self, D_sp, fxc):
         """Calculate four-phi integrals.
 
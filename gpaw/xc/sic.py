@@ -200,6 +200,11 @@ class SIC(XCFunctional):
                          tau_sg=None, dedtau_sg=None):
         return self.xc.calculate_radial(rgd, n_sLg, Y_L, v_sg,
                                         dndr_sLg, rnablaY_Lv)
+
+    def calculate_radial_expansion(self, rgd, n_sLg, Y_nL, v_sng,
+                                   dndr_sLg=None, rnablaY_nLv=None):
+        return self.xc.calculate_radial_expansion(rgd, n_sLg, Y_nL, v_sng,
+                                                  dndr_sLg, rnablaY_nLv)
     
     def set_positions(self, spos_ac):
         if not self.finegrid:
@@ -14,17 +14,17 @@ XC-functional.  There are two implementations:
 import os
 import sys
 import pickle
-from math import sin, cos, exp, pi, log, sqrt, ceil
+from math import pi, log, sqrt, ceil
 
 import numpy as np
-from numpy.fft import fft, rfftn, irfftn
+from numpy.fft import fft
 
 from gpaw.utilities.timing import nulltimer
 from gpaw.xc.libxc import LibXC
 from gpaw.xc.gga import GGA
-from gpaw.grid_descriptor import GridDescriptor
-from gpaw.utilities.tools import construct_reciprocal
+from gpaw.utilities.tools import md5_array
 from gpaw.fd_operators import Gradient
+from gpaw.utilities.parallel_fft import ParallelFFT
 from gpaw import setup_paths, extra_parameters
 import gpaw.mpi as mpi
 import _gpaw
@@ -35,13 +35,13 @@ def T(w, x, y, z):
                   (1.0 / ((w + y) * (x + z)) + 1.0 / ((w + z) * (y + x)))) 
 
 def W(a, b): 
-    return 2 * ((3 - a**2) * b * cos(b) * sin(a) + 
-                (3 - b**2) * a * cos(a) * sin(b) + 
-                (a**2 + b**2 - 3) * sin(a) * sin(b) - 
-                3 * a * b * cos(a) * cos(b)) / (a * b)**3 
+    return 2 * ((3 - a**2) * b * np.cos(b) * np.sin(a) + 
+                (3 - b**2) * a * np.cos(a) * np.sin(b) + 
+                (a**2 + b**2 - 3) * np.sin(a) * np.sin(b) - 
+                3 * a * b * np.cos(a) * np.cos(b)) / (a * b)**3 
 eta = 8 * pi / 9 
 def nu(y, d): 
-    return 0.5 * y**2 / (1 - exp(-0.5 * eta * (y / d)**2))
+    return 0.5 * y**2 / (1 - np.exp(-0.5 * eta * (y / d)**2))
 
 def f(a, b, d, dp): 
     va = nu(a, d) 
@@ -58,6 +58,36 @@ def phi(d, dp):
     return quad(lambda y: quad(f, 0, cut, (y, d, dp), **kwargs)[0],
                 0, cut, **kwargs)[0]
 
+def gauss_legendre(n, xmin, xmax):
+    """Abscissas and weights for n-point Gauss-Legendre quadrature."""
+    k = np.arange(1, n)
+    b_k = k / np.sqrt(4.0 * k**2 - 1)
+    x_n, U_nn = np.linalg.eigh(np.diag(b_k, 1) + np.diag(b_k, -1))
+    return (0.5 * (xmax - xmin) * (x_n + 1) + xmin,
+            (xmax - xmin) * U_nn[0]**2)
+
+def phi_array(d_x, dp_x, n=128, blocksize=16):
+    """vdW-DF kernel for arrays of d and d' values.
+
+    Same double integral as in phi(), but done with an n-point
+    Gauss-Legendre rule in both directions for blocks of (d, d')
+    pairs at a time.  n=128 gives the kernel to better than 1e-8."""
+    cut = 35
+    a_y, w_y = gauss_legendre(n, 0, cut)
+    awW_yy = (2 / pi**2 * np.outer(a_y**2 * w_y, a_y**2 * w_y) *
+              W(a_y[:, np.newaxis], a_y))
+    phi_x = np.empty(len(d_x))
+    olderr = np.seterr(divide='ignore')  # d' = 0 for delta = 1
+    for x1 in range(0, len(d_x), blocksize):
+        x2 = min(x1 + blocksize, len(d_x))
+        va_xy = nu(a_y, np.asarray(d_x[x1:x2])[:, np.newaxis])
+        vpa_xy = nu(a_y, np.asarray(dp_x[x1:x2])[:, np.newaxis])
+        T_xyy = T(va_xy[:, :, np.newaxis], va_xy[:, np.newaxis],
+                  vpa_xy[:, :, np.newaxis], vpa_xy[:, np.newaxis])
+        phi_x[x1:x2] = np.dot(T_xyy.reshape((x2 - x1, -1)), awW_yy.ravel())
+    np.seterr(**olderr)
+    return phi_x
+
 C = 12 * (4 * pi / 9)**3
 def phi_asymptotic(d, dp):
     """Asymptotic behavior of vdW-DF kernel."""
@@ -80,6 +110,45 @@ def hRPS(x, xc=1.0):
     return xc * (1.0 - y), z * y
 
 
+# Kernel tables (and Fourier transformed kernels) are shared by all
+# vdW-DF objects in the same process:
+cache = {}
+
+table_path = os.path.join(os.path.expanduser('~'), '.gpaw', 'vdw')
+table_version = 1
+
+def write_table_file(filename, phi_ij):
+    """Write kernel table to binary file.
+
+    The file has a one-line header with the format version, the shape
+    and an MD5 checksum of the data.  The file is written under a
+    temporary name and then renamed, so that other processes never see
+    a half-written table."""
+    phi_ij = np.asarray(phi_ij, '<f8')
+    tmpname = '%s.%d' % (filename, os.getpid())
+    fd = open(tmpname, 'wb')
+    fd.write('gpaw-vdw-table %d %d %d %s\n' %
+             ((table_version,) + phi_ij.shape + (md5_array(phi_ij),)))
+    fd.write(phi_ij.tostring())
+    fd.close()
+    os.rename(tmpname, filename)
+
+def read_table_file(filename):
+    """Read kernel table from binary file.
+
+    Returns None if the version or the checksum is wrong."""
+    fd = open(filename, 'rb')
+    words = fd.readline().split()
+    if (len(words) != 5 or words[0] != 'gpaw-vdw-table' or
+        int(words[1]) != table_version):
+        return None
+    phi_ij = np.fromstring(fd.read(), '<f8')
+    if (len(phi_ij) != int(words[2]) * int(words[3]) or
+        md5_array(phi_ij) != words[4]):
+        return None
+    return phi_ij.reshape((int(words[2]), int(words[3]))).astype(float)
+
+
 class VDWFunctional(GGA):
     """Base class for vdW-DF."""
     def __init__(self, name, world=None, q0cut=5.0,
@@ -232,71 +301,97 @@ class VDWFunctional(GGA):
         else:
             dEcnl = 0.0
             
-        # Distribute density and q0 to all processors:
-        n_g = gd.collect(n_g, broadcast=True)
-        q0_g = gd.collect(q0_g, broadcast=True)
-
         if not self.energy_only:
-            self.dhdx_g = gd.collect(dhdx_g, broadcast=True)
+            self.dhdx_g = dhdx_g
 
         Ecnl = self.calculate_6d_integral(n_g, q0_g, a2_g, e_LDAc_g, v_LDAc_g,
                                           v_g, deda2_g)
         return Ecnl + dEcnl    
 
     def read_table(self):
-        name = ('phi-%.3f-%.3f-%.3f-%d-%d.pckl' %
+        """Get kernel table from cache, file or by calculating it.
+
+        Tables are kept in memory for the lifetime of the process, so
+        that all vdW-DF objects with the same parameters share one
+        table."""
+        
+        key = ('phi', self.phi0, self.ds, self.D_j[-1],
+               len(self.delta_i), len(self.D_j))
+        if key in cache:
+            self.phi_ij = cache[key]
+            return
+
+        name = ('phi-%.3f-%.3f-%.3f-%d-%d' %
                 (self.phi0, self.ds, self.D_j[-1],
                  len(self.delta_i), len(self.D_j)))
         
         if 'GPAW_VDW' in os.environ:
             print 'Use of GPAW_VDW is deprecated.'
-            print 'Put', name, 'in your GPAW_SETUP_PATH directory.'
+            print 'Put', name + '.vdw', 'in your GPAW_SETUP_PATH directory.'
             dirs = [os.environ['GPAW_VDW']]
         else:
-            dirs = setup_paths + ['.']
+            dirs = setup_paths + [table_path, '.']
 
         for dir in dirs:
-            filename = os.path.join(dir, name)
+            filename = os.path.join(dir, name + '.vdw')
             if os.path.isfile(filename):
-                self.phi_ij = pickle.load(open(filename))
-                if self.verbose:
-                    print 'VDW: using', filename
-                return
-            
-        print 'VDW: Could not find table file:', name
-        self.make_table(name)
+                phi_ij = read_table_file(filename)
+                if phi_ij is not None and phi_ij.shape == (len(self.delta_i),
+                                                           len(self.D_j)):
+                    break
+                print 'VDW: Ignoring bad table file:', filename
+            filename = os.path.join(dir, name + '.pckl')
+            if os.path.isfile(filename):
+                phi_ij = pickle.load(open(filename))
+                break
+        else:
+            print 'VDW: Could not find table file:', name + '.vdw'
+            self.make_table(name)
+            cache[key] = self.phi_ij
+            return
+
+        if self.verbose:
+            print 'VDW: using', filename
+        self.phi_ij = cache[key] = phi_ij
             
     def make_table(self, name):
         print 'VDW: Generating vdW-DF kernel ...'
-        print 'VDW:',
         ndelta = len(self.delta_i)
         nD = len(self.D_j)
         self.phi_ij = np.zeros((ndelta, nD))
-        for i in range(self.world.rank, ndelta, self.world.size):
-            print ndelta - i,
-            sys.stdout.flush()
-            delta = self.delta_i[i]
-            for j in range(nD - 1, -1, -1):
-                D = self.D_j[j]
-                d = D * (1.0 + delta)
-                dp = D * (1.0 - delta)
-                if d**2 + dp**2 > self.ds**2:
-                    self.phi_ij[i, j] = phi(d, dp)
-                else:
-                    P = np.polyfit([0, self.D_j[j + 1]**2, self.D_j[j + 2]**2],
-                                   [self.phi0,
-                                    self.phi_ij[i, j + 1],
-                                    self.phi_ij[i, j + 2]],
-                                   2)
-                    self.phi_ij[i, :j + 3] = np.polyval(P, self.D_j[:j + 3]**2)
-                    break
+        myi = range(self.world.rank, ndelta, self.world.size)
+        d_ij = np.outer(1.0 + self.delta_i, self.D_j)
+        dp_ij = np.outer(1.0 - self.delta_i, self.D_j)
+        mine_i = np.zeros(ndelta, bool)
+        mine_i[myi] = True
+        big_ij = d_ij**2 + dp_ij**2 > self.ds**2
+        big_ij &= mine_i[:, np.newaxis]
+        # All (d, d') pairs outside the soft core in one go:
+        self.phi_ij[big_ij] = phi_array(d_ij[big_ij], dp_ij[big_ij])
+
+        # Smooth polynomial inside the soft core:
+        for i in myi:
+            j = big_ij[i].argmax() - 1
+            P = np.polyfit([0, self.D_j[j + 1]**2, self.D_j[j + 2]**2],
+                           [self.phi0,
+                            self.phi_ij[i, j + 1],
+                            self.phi_ij[i, j + 2]],
+                           2)
+            self.phi_ij[i, :j + 3] = np.polyval(P, self.D_j[:j + 3]**2)
 
         self.world.sum(self.phi_ij)
         
-        print
         print 'VDW: Done!'
         if self.world.rank == 0:
-            pickle.dump(self.phi_ij, open(name, 'w'), pickle.HIGHEST_PROTOCOL)
+            for dir in [table_path, '.']:
+                try:
+                    if not os.path.isdir(dir):
+                        os.makedirs(dir)
+                    write_table_file(os.path.join(dir, name + '.vdw'),
+                                     self.phi_ij)
+                except (IOError, OSError):
+                    continue
+                break
 
     def make_prl_plot(self, multiply_by_4_pi_D_squared=True):
         import pylab as plt
@@ -317,33 +412,32 @@ class VDWFunctional(GGA):
         """Kernel function.
 
         Uses bi-linear interpolation and returns zero for D > Dmax.
+        Works for arrays of d and d' values too.
         """
         
         P = self.phi_ij
+        d = np.asarray(d, float)
         D = (d + dp) / 2.0
-        if D < 1e-14:
-            return P[0, 0]
-        if D >= self.D_j[-1]:
-            return 0.0
-        
-        delta = abs((d - dp) / (2 * D))
+        small = D < 1e-14
+        delta = abs((d - dp) / (2 * np.where(small, 1.0, D)))
         ddelta = self.delta_i[1]
         x = delta / ddelta
-        i = int(x)
-        if i == len(self.delta_i) - 1:
-            i -= 1
-            x = 1.0
-        else:
-            x -= i
+        i = np.minimum(x.astype(int), len(self.delta_i) - 2)
+        x -= i
 
         dD = self.D_j[1]
         y = D / dD
-        j = int(y)
+        j = np.minimum(y.astype(int), len(self.D_j) - 2)
         y -= j
-        return (x * (y * P[i + 1, j + 1] +
-                     (1 - y) * P[i + 1, j]) +
-                (1 - x) * (y * P[i, j + 1] +
-                           (1 - y) * P[i, j]))
+        phi = (x * (y * P[i + 1, j + 1] +
+                    (1 - y) * P[i + 1, j]) +
+               (1 - x) * (y * P[i, j + 1] +
+                          (1 - y) * P[i, j]))
+        phi = np.where(D >= self.D_j[-1], 0.0, phi)
+        phi = np.where(small, P[0, 0], phi)
+        if phi.ndim == 0:
+            return float(phi)
+        return phi
 
 
 class RealSpaceVDWFunctional(VDWFunctional):
@@ -371,6 +465,11 @@ class RealSpaceVDWFunctional(VDWFunctional):
         if not gd.orthogonal:
             raise NotImplementedError('Real-space vdW calculations require ' +
                                       'an orthogonal cell.')
+
+        # Distribute density and q0 to all processors:
+        n_g = gd.collect(n_g, broadcast=True)
+        q0_g = gd.collect(q0_g, broadcast=True)
+
         n_c = n_g.shape
         R_gc = np.empty(n_c + (3,))
         h_c = gd.h_cv.diagonal()
@@ -458,22 +557,8 @@ class FFTVDWFunctional(VDWFunctional):
         
         self.C_aip = None
         self.phi_aajp = None
+        self.fft = None
 
-        if Nalpha < self.world.size:
-            rstride = self.world.size // Nalpha
-            newranks = range(0, self.world.size, rstride)[:Nalpha]
-            self.vdwcomm = self.world.new_communicator(newranks)
-            # self.vdwcomm will be None for those ranks not in the communicator
-        else:
-            self.vdwcomm = self.world
-
-        if self.vdwcomm is not None:
-            self.alphas = [a for a in range(self.Nalpha)
-                           if (a * self.vdwcomm.size // self.Nalpha ==
-                               self.vdwcomm.rank)]
-        else:
-            self.alphas = []
-        
     def construct_cubic_splines(self):
         """Construc interpolating splines for q0.
 
@@ -541,7 +626,7 @@ class FFTVDWFunctional(VDWFunctional):
             qa = self.q_a[a]
             for b in range(a, self.Nalpha):
                 qb = self.q_a[b]
-                phi_g = [self.phi(qa * r, qb * r) for r in r_g]
+                phi_g = self.phi(qa * r_g, qb * r_g)
                 phi_j = (fft(r_g * phi_g * 1j).real[:M // 2] *
                          (rcut / M * 4 * pi))
                 phi_j[0] = np.dot(r_g, r_g * phi_g) * (rcut / M * 4 * pi)
@@ -564,20 +649,31 @@ class FFTVDWFunctional(VDWFunctional):
         else:
             self.shape = np.array(self.size)
             
-        scale_c1 = (self.shape / (1.0 * gd.N_c))[:, np.newaxis]
-        gdfft = GridDescriptor(self.shape, gd.cell_cv * scale_c1, True)
-        k_k = construct_reciprocal(gdfft)[0][:,
-                                             :,
-                                             :self.shape[2] // 2 + 1]**0.5
-        k_k[0, 0, 0] = 0.0
+        self.fft = ParallelFFT(self.shape, gd)
+        self.alphacomm = self.create_alpha_communicator(gd.comm)
 
+        # Lengths of the k-vectors in our slab of the Fourier grid:
+        scale_c1 = (self.shape / (1.0 * gd.N_c))[:, np.newaxis]
+        B_cv = 2 * pi * np.linalg.inv(gd.cell_cv * scale_c1).T
+        i_c = [np.arange(self.shape[0]),
+               np.arange(self.fft.y1, self.fft.y2),
+               np.arange(self.shape[2] // 2 + 1)]
+        k_vk = 0.0
+        for c, i in enumerate(i_c):
+            N = self.shape[c]
+            i = (i + N // 2) % N - N // 2
+            k_vk = k_vk + (B_cv[c][:, np.newaxis, np.newaxis, np.newaxis] *
+                           i.reshape([-1 if c2 == c else 1
+                                      for c2 in range(3)]))
+        k_k = (k_vk**2).sum(0)**0.5
 
         self.dj_k = k_k / (2 * pi / self.rcut)
         self.j_k = self.dj_k.astype(int)
         self.dj_k -= self.j_k
         self.dj_k *= 2 * pi / self.rcut
 
-        assert self.j_k.max() < self.Nr // 2, 'Use larger Nr.'
+        assert self.j_k.size == 0 or self.j_k.max() < self.Nr // 2, \
+               'Use larger Nr.'
  
         if self.verbose:
             print 'VDW: density array size:', gd.get_size_of_global_array()
@@ -585,166 +681,155 @@ class FFTVDWFunctional(VDWFunctional):
             print ('VDW: maximum kinetic energy: %.3f Hartree' %
                    (0.5 * k_k.max()**2))
 
+    def create_alpha_communicator(self, comm):
+        """Communicator for the processes that hold the same domain.
+
+        The processes of self.world that are not distributed over comm
+        (k-points, bands) share the work for the different alphas."""
+        world = self.world
+        if world.size == comm.size:
+            return mpi.serial_comm
+        assert world.size % comm.size == 0
+        domainrank_r = np.empty(world.size, int)
+        world.all_gather(np.array([comm.rank]), domainrank_r)
+        alphacomm = None
+        for rank in range(comm.size):
+            ranks = np.arange(world.size)[domainrank_r == rank]
+            newcomm = world.new_communicator(ranks)
+            if rank == comm.rank:
+                alphacomm = newcomm
+        return alphacomm
+
     def calculate_6d_integral(self, n_g, q0_g,
                               a2_g=None, e_LDAc_g=None, v_LDAc_g=None,
                               v_g=None, deda2_g=None):
+        """FFT convolution on a slab-decomposed grid.
+
+        The theta arrays are Fourier transformed one alpha at a time and
+        added to the F_ak arrays for all alphas right away.  Only our
+        slab of the Fourier grid is stored.  The alphas are distributed
+        over the processes that hold the same slab (self.alphacomm)."""
+        
         self.timer.start('VdW-DF integral')
         self.timer.start('splines')
         if self.C_aip is None:
             self.construct_cubic_splines()
-            self.construct_fourier_transformed_kernels()
+            key = ('phi_aajp', self.phi0, self.ds, self.D_j[-1],
+                   len(self.delta_i), len(self.D_j),
+                   self.Nalpha, self.lambd, self.q0cut, self.rcut, self.Nr)
+            if key not in cache:
+                self.construct_fourier_transformed_kernels()
+                cache[key] = self.phi_aajp
+            self.phi_aajp = cache[key]
         self.timer.stop('splines')
 
-        gd = self.gd
         N = self.Nalpha
+        pfft = self.fft
+        alphacomm = self.alphacomm
+        myalphas = [a for a in range(N)
+                    if a * alphacomm.size // N == alphacomm.rank]
+        vdw0 = extra_parameters.get('vdw0')
+
+        self.timer.start('redistribute')
+        n_x = pfft.domain_to_slab(n_g)
+        q0_x = pfft.domain_to_slab(q0_g)
+        self.timer.stop('redistribute')
+        i_x = (np.log(q0_x / self.q_a[1] * (self.lambd - 1) + 1) /
+               log(self.lambd)).astype(int)
+        dq0_x = q0_x - self.q_a[i_x]
+        del q0_x
 
-        world = self.world
-        vdwcomm = self.vdwcomm
-
-        if self.alphas:
-            self.timer.start('hmm1')
-            i_g = (np.log(q0_g / self.q_a[1] * (self.lambd - 1) + 1) /
-                   log(self.lambd)).astype(int)
-            dq0_g = q0_g - self.q_a[i_g]
-            self.timer.stop('hmm1')
-        else:
-            i_g = None
-            dq0_g = None
-        
         if self.verbose:
             print 'VDW: fft:',
-            
-        theta_ak = {}
-        p_ag = {}
-        for a in self.alphas:
-            self.timer.start('hmm2')
-            C_pg = self.C_aip[a, i_g].transpose((3, 0, 1, 2))
-            pa_g = (C_pg[0] + dq0_g *
-                    (C_pg[1] + dq0_g *
-                     (C_pg[2] + dq0_g * C_pg[3])))
-            self.timer.stop('hmm2')
-            del C_pg
+
+        F_ak = np.zeros((N,) + pfft.kshape, complex)
+        theta0_a = np.zeros(N)
+        for b in myalphas:
             self.timer.start('FFT')
-            theta_ak[a] = rfftn(n_g * pa_g, self.shape).copy()
-            if extra_parameters.get('vdw0'):
-                theta_ak[a][0, 0, 0] = 0.0
+            theta_x = n_x * self.p_array(b, i_x, dq0_x)
+            theta0_a[b] = theta_x.sum()
+            theta_k = pfft.rfftn(theta_x)
+            del theta_x
+            if vdw0 and pfft.y1 == 0 and theta_k.size > 0:
+                theta_k[0, 0, 0] = 0.0
             self.timer.stop()
-            
-            if not self.energy_only:
-                p_ag[a] = pa_g
-            del pa_g
-            if self.verbose:
-                print a,
-                sys.stdout.flush()
-        
-        if self.energy_only:
-            del i_g
-            del dq0_g
-        
-        if self.verbose:
-            print
-            print 'VDW: convolution:',
-
-        F_ak = {}
-        dj_k = self.dj_k
-        energy = 0.0
-        for a in range(N):
-            if vdwcomm is not None:
-                vdw_ranka = a * vdwcomm.size // N
-                F_k = np.zeros((self.shape[0],
-                                self.shape[1],
-                                self.shape[2] // 2 + 1), complex)
             self.timer.start('Convolution')
-            for b in self.alphas:
-                _gpaw.vdw2(self.phi_aajp[a, b], self.j_k, dj_k,
-                           theta_ak[b], F_k)
+            for a in range(N):
+                _gpaw.vdw2(self.phi_aajp[a, b], self.j_k, self.dj_k,
+                           theta_k, F_ak[a])
             self.timer.stop()
-            
-            if vdwcomm is not None:
-                self.timer.start('gather')
-                vdwcomm.sum(F_k, vdw_ranka)
-                self.timer.stop('gather')
-
-            if vdwcomm is not None and vdwcomm.rank == vdw_ranka:
-                if not self.energy_only:
-                    F_ak[a] = F_k
-                energy += np.vdot(theta_ak[a][:, :, 0], F_k[:, :, 0]).real
-                energy += np.vdot(theta_ak[a][:, :, -1], F_k[:, :, -1]).real
-                energy += 2 * np.vdot(theta_ak[a][:, :, 1:-1],
-                                      F_k[:, :, 1:-1]).real
-
             if self.verbose:
-                print a,
+                print b,
                 sys.stdout.flush()
-
-        del theta_ak
+        if myalphas:
+            del theta_k
+        pfft.comm.sum(theta0_a)
+        alphacomm.sum(theta0_a)
+        self.timer.start('gather')
+        for a in range(N):
+            alphacomm.sum(F_ak[a], a * alphacomm.size // N)
+        self.timer.stop('gather')
 
         if self.verbose:
             print
 
         if not self.energy_only:
-            F_ag = {}
-            for a in self.alphas:
-                n1, n2, n3 = gd.get_size_of_global_array()
-                self.timer.start('iFFT')
-                F_ag[a] = irfftn(F_ak[a]).real[:n1, :n2, :n3].copy()
-                self.timer.stop()
-            del F_ak
+            self.timer.start('redistribute')
+            a2_x = pfft.domain_to_slab(a2_g)
+            e_LDAc_x = pfft.domain_to_slab(e_LDAc_g)
+            v_LDAc_x = pfft.domain_to_slab(v_LDAc_g)
+            dhdx_x = pfft.domain_to_slab(self.dhdx_g)
+            self.timer.stop('redistribute')
+            dq0dn_x = ((pi / 3 / n_x)**(2.0 / 3.0) +
+                       4 * pi / 3 * (e_LDAc_x / n_x - v_LDAc_x) / n_x +
+                       7 * self.Zab / 108 / (3 * pi**2)**(1.0 / 3.0) * a2_x *
+                       n_x**(-10.0 / 3.0))
+            dq0da2_x = -(self.Zab / 36 / (3 * pi**2)**(1.0 / 3.0) /
+                         n_x**(7.0 / 3.0))
+            del a2_x, e_LDAc_x, v_LDAc_x
+            v0_x = np.zeros_like(n_x)
+            deda20_x = np.zeros_like(n_x)
 
-            self.timer.start('potential')
-            self.calculate_potential(n_g, a2_g, i_g, dq0_g, p_ag, F_ag,
-                                     e_LDAc_g, v_LDAc_g,
-                                     v_g, deda2_g)
+        energy = 0.0
+        nx, n1, n2 = n_x.shape
+        for a in myalphas:
+            self.timer.start('iFFT')
+            F_x = pfft.irfftn(F_ak[a])
             self.timer.stop()
+            if vdw0:
+                energy -= theta0_a[a] * F_x.sum() / self.shape.prod()
+            F_x = F_x[:nx, :n1, :n2]
+            pa_x = self.p_array(a, i_x, dq0_x)
+            energy += np.vdot(n_x * pa_x, F_x)
+            if not self.energy_only:
+                self.timer.start('potential')
+                C_px = self.C_aip[a, i_x].transpose((3, 0, 1, 2))
+                dpadq0_x = C_px[1] + dq0_x * (2 * C_px[2] +
+                                              3 * dq0_x * C_px[3])
+                del C_px
+                dthetatmp_x = n_x * dpadq0_x * dhdx_x
+                v0_x += (pa_x + dq0dn_x * dthetatmp_x) * F_x
+                deda20_x += dq0da2_x * dthetatmp_x * F_x
+                self.timer.stop()
+            del F_x
 
-        self.timer.stop()
-        return 0.5 * world.sum(energy) * gd.dv / self.shape.prod()
-
-    def calculate_potential(self, n_g, a2_g, i_g, dq0_g, p_ag, F_ag,
-                            e_LDAc_g, v_LDAc_g, v_g, deda2_g):
-        N = self.Nalpha
-        world = self.world
+        if not self.energy_only:
+            alphacomm.sum(v0_x)
+            alphacomm.sum(deda20_x)
+            self.timer.start('redistribute')
+            v_g += pfft.slab_to_domain(v0_x)
+            deda2_g += pfft.slab_to_domain(deda20_x)
+            self.timer.stop('redistribute')
 
-        self.timer.start('collect')
-        a2_g = self.gd.collect(a2_g, broadcast=True)
-        e_LDAc_g = self.gd.collect(e_LDAc_g, broadcast=True)
-        v_LDAc_g = self.gd.collect(v_LDAc_g, broadcast=True)
-        self.timer.stop('collect')
-        if self.alphas:
-            self.timer.start('p1')
-            dq0dn_g = ((pi / 3 / n_g)**(2.0 / 3.0) +
-                       4 * pi / 3 * (e_LDAc_g / n_g - v_LDAc_g) / n_g +
-                       7 * self.Zab / 108 / (3 * pi**2)**(1.0 / 3.0) * a2_g *
-                       n_g**(-10.0 / 3.0))
-            dq0da2_g = -(self.Zab / 36 / (3 * pi**2)**(1.0 / 3.0) /
-                         n_g**(7.0 / 3.0))
-            self.timer.stop('p1')
-        
-        v0_g = np.zeros_like(n_g)
-        deda20_g = np.zeros_like(n_g)
-
-        for a in self.alphas:
-            self.timer.start('p2')
-            C_pg = self.C_aip[a, i_g].transpose((3, 0, 1, 2))
-            dpadq0_g = C_pg[1] + dq0_g * (2 * C_pg[2] + 3 * dq0_g * C_pg[3])
-            del C_pg
-            dthetatmp_g = n_g * dpadq0_g * self.dhdx_g
-            dthetaadn_g = p_ag[a] + dq0dn_g * dthetatmp_g
-            v0_g += dthetaadn_g * F_ag[a]
-            del dthetaadn_g
-            dthetaada2_g = dq0da2_g * dthetatmp_g
-            del dthetatmp_g
-            deda20_g += dthetaada2_g * F_ag[a]
-            del dthetaada2_g
-            self.timer.stop('p2')
-
-        self.timer.start('sum')
-        world.sum(v0_g)
-        world.sum(deda20_g)
-        self.timer.stop('sum')
-        slice = self.gd.get_slice()
-        v_g += v0_g[slice]
-        deda2_g += deda20_g[slice]
+        self.timer.stop()
+        energy = alphacomm.sum(pfft.comm.sum(energy))
+        return 0.5 * energy * self.gd.dv
+
+    def p_array(self, alpha, i_x, dq0_x):
+        """Interpolating spline for q0-values in array."""
+        C_px = self.C_aip[alpha, i_x].transpose((3, 0, 1, 2))
+        return C_px[0] + dq0_x * (C_px[1] + dq0_x * (C_px[2] +
+                                                     dq0_x * C_px[3]))
 
 
 def spline(x, y):